@@ -1,295 +1,2382 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import sys
+import glob
+import errno
+import select
+import signal
+import socket
+import struct
+import ctypes
+import mmap
+import random
+import fcntl
+import pwd
+import contextlib
+import subprocess
+import codecs
+import queue
+import re
+import json
+import gzip
+import lzma
+import hashlib
+import ipaddress
 import time
 import tempfile
 import threading
+import concurrent.futures
+import urllib.request
 import xml.etree.ElementTree as ET
 from gi.repository import GLib
 from pydbus import SystemBus
+from pydbus.generic import signal as dbus_signal
 
 
 BUS_NAME = "de.beaerlin.GadgetController"
-GADGETFS = "/sys/kernel/config/usb_gadget/"
+# configfs root, UDC class dir and systemd unit dir can be pointed at a
+# stand-in tree (see FakeConfigFS and the "bench" mode)
+GADGETFS = os.environ.get("GADGETCONTROLLER_CONFIGFS", "/sys/kernel/config/usb_gadget/")
+UDCDIR = os.environ.get("GADGETCONTROLLER_UDC", "/sys/class/udc")
+SYSTEMDDIR = os.environ.get("GADGETCONTROLLER_SYSTEMD", "/etc/systemd/system")
+# print every configfs attribute write
+TRACE = os.environ.get("GADGETCONTROLLER_TRACE", "") not in ("", "0")
+NETDIR = "/sys/class/net"
+NETLINK_ROUTE = 0
+NETLINK_KOBJECT_UEVENT = 15
+NLMSG_ERROR = 2
+NLM_F_REQUEST = 0x1
+NLM_F_ACK = 0x4
+NLM_F_REPLACE = 0x100
+NLM_F_CREATE = 0x400
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_NEWADDR = 20
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFF_UP = 0x1
+IFLA_IFNAME = 3
+IFLA_MTU = 4
+IFLA_MASTER = 10
+IFLA_LINKINFO = 18
+IFLA_INFO_KIND = 1
+# bridge over the RNDIS and NCM interfaces of the dual config
+NETBRIDGE = "usbbr0"
+# ioctls for overlay images, reflink clones and loop devices
+FICLONE = 0x40049409
+LOOP_SET_FD = 0x4C00
+LOOP_CLR_FD = 0x4C01
+LOOP_CTL_GET_FREE = 0x4C82
+IN_MODIFY = 0x2
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+# seconds to wait for usb0/hidg/ttyGS0 after binding and for the host
+# to configure the gadget
+READY_TIMEOUT = 5.0
+CONFIGURED_TIMEOUT = 1.0
+# LUNs per mass_storage function (FSG_MAX_LUNS on older kernels)
+MAX_LUNS = 8
+# per LUN tunables of add_storage/set_media and their defaults, mode is
+# cdrom, disk or auto (disk for hybrid ISOs), read_ahead_kb 0 keeps the
+# setting of the disk holding the image, cache is "", ram or pin
+LUN_DEFAULTS = {
+    "nofua": False,
+    "removable": True,
+    "inquiry": "",
+    "mode": "auto",
+    "read_ahead_kb": 0,
+    "cache": "",
+}
+# tmpfs for RAM copies of LUN images, and the memory RAM copies and pinned
+# regions may use together in MiB, 0 is a quarter of the RAM
+RAMDIR = os.environ.get("GADGETCONTROLLER_RAMDIR", "/dev/shm/gadgetcontroller")
+CACHE_BUDGET_MB = int(os.environ.get("GADGETCONTROLLER_CACHE_BUDGET", "0"))
+# pinned at both ends of every image: MBR/GPT, boot loader gap, backup GPT
+CACHE_HEAD = 1024 * 1024
+CACHE_TAIL = 64 * 1024
+# ISO9660 files boot loaders read, by name prefix and suffix
+ISO_HOT_FILES = (
+    "VMLINU",
+    "LINUX",
+    "BZIMAGE",
+    "KERNEL",
+    "INITRD",
+    "INITRAMFS",
+    "ISOLINUX",
+    "LDLINUX",
+    "SYSLINUX",
+    "EFIBOOT",
+    "BOOT",
+    "GRUB",
+)
+ISO_HOT_SUFFIXES = (".EFI", ".CFG", ".C32")
+ISO_MAX_DEPTH = 3
+ISO_MAX_DIRS = 256
+# bytes preallocated between progress reports when creating images
+IMAGE_CHUNK = 256 * 1024 * 1024
+IMAGE_ALLOC = ("sparse", "fallocate")
+# mkfs command up to its label option (exfatprogs takes -L, dosfstools -n)
+IMAGE_FS = {"": None, "vfat": ["mkfs.vfat", "-I", "-n"], "exfat": ["mkfs.exfat", "-L"]}
+# block size of image imports, writes go out in blocks of this size
+IMPORT_BUFSIZE = 4 * 1024 * 1024
+IMPORT_COMPRESSED = (".xz", ".gz", ".zst")
+IMPORT_SCHEMES = ("http", "https")
+# a D-Bus caller may only import to, create or verify images below these
+# directories of ~/.gadget, and only if polkit allows the action
+IMAGE_SUBDIRS = ("iso", "image")
+POLKIT_IMAGES = BUS_NAME + ".manage-images"
+# run as the D-Bus caller, opens argv[2] and passes the fd back over the
+# socket argv[1], or the errno
+OPEN_AS_HELPER = """
+import os, socket, sys
+sock = socket.socket(fileno=int(sys.argv[1]))
+try:
+    fd = os.open(sys.argv[2], os.O_RDONLY)
+except OSError as e:
+    sock.send(str(e.errno).encode())
+else:
+    socket.send_fds(sock, [b"ok"], [fd])
+"""
+# the storage benchmark issues commands like a Linux host (max_sectors
+# 240) and f_mass_storage moves them in FSG_BUFLEN pieces
+STORAGE_BENCH_SEQ = 120 * 1024
+STORAGE_BENCH_RAND = 4096
+FSG_BUFLEN = 16 * 1024
+STORAGE_BENCH_INQUIRY = "GCBench StorageBench    0001"
+# configfs name (and dhcpd pid file) of the benchmark gadgets, never
+# those of the live GADGETNAME one
+BENCH_GADGET = "gcbench"
+# image checksum results by (device, inode, size, mtime)
+VERIFYCACHE = os.environ.get(
+    "GADGETCONTROLLER_VERIFY_CACHE", "/var/cache/gadgetcontroller/verify.json"
+)
+VERIFY_BUFSIZE = 4 * 1024 * 1024
+# sidecar extensions and manifests next to an image, by hash
+VERIFY_SIDECARS = ((".sha256", "sha256"), (".b2", "blake2b"))
+VERIFY_MANIFESTS = (("SHA256SUMS", "sha256"), ("B2SUMS", "blake2b"))
+# ioprio_set(2) has no wrapper, syscall numbers by machine
+IOPRIO_SYSCALL = {"x86_64": 251, "i686": 289, "aarch64": 30, "armv7l": 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+# seconds stop() may take before giving up on the remaining steps
+STOP_DEADLINE = 30.0
+# seconds a HID report may wait for the host to poll it
+HID_TIMEOUT = 1.0
+# Unix socket streaming HID reports, empty to disable
+HIDSOCKET = os.environ.get(
+    "GADGETCONTROLLER_HID_SOCKET", "/run/gadgetcontroller/hid.sock"
+)
+# peer port and namespace of the network benchmark (bench --net)
+NETBENCH_PORT = 5201
+NETBENCH_NETNS = "gcbench"
+NETBENCH_BUFSIZE = 128 * 1024
 GADGETNAME = "gc1"
 TEMPDIR = os.path.join(tempfile.gettempdir(), "GadgetController")
 if not os.path.isdir(TEMPDIR):
     os.makedirs(TEMPDIR)
 
 
-class Descriptors:
-    def KeyboardLength(self):
-        return "8"
-
-    def Keyboard(self):
-        return bytes(
-            [
-                0x05,
-                0x01,
-                0x09,
-                0x06,
-                0xA1,
-                0x01,
-                0x05,
-                0x07,
-                0x19,
-                0xE0,
-                0x29,
-                0xE7,
-                0x15,
-                0x00,
-                0x25,
-                0x01,
-                0x75,
-                0x01,
-                0x95,
-                0x08,
-                0x81,
-                0x02,
-                0x95,
-                0x01,
-                0x75,
-                0x08,
-                0x81,
-                0x03,
-                0x95,
-                0x05,
-                0x75,
-                0x01,
-                0x05,
-                0x08,
-                0x19,
-                0x01,
-                0x29,
-                0x05,
-                0x91,
-                0x02,
-                0x95,
-                0x01,
-                0x75,
-                0x03,
-                0x91,
-                0x03,
-                0x95,
-                0x06,
-                0x75,
-                0x08,
-                0x15,
-                0x00,
-                0x25,
-                0x65,
-                0x05,
-                0x07,
-                0x19,
-                0x00,
-                0x29,
-                0x65,
-                0x81,
-                0x00,
-                0xC0,
-            ]
+# main item flags
+HID_CONST = 0x01
+HID_VAR = 0x02
+HID_REL = 0x04
+HID_NULL = 0x40
+HID_MAIN = {"input": 0x80, "output": 0x90, "feature": 0xB0}
+HID_COLLECTIONS = {"physical": 0x00, "application": 0x01, "logical": 0x02}
+
+# Report descriptor specs. An application collection with a usage page
+# and usage, holding fields and nested collections. A field is an input
+# (default), output or feature item of count x size bits; data fields
+# name their usages (list or range), logical (and optionally physical,
+# unit) range. Global items are only emitted when they change.
+HID_SPECS = {
+    "keyboard": {
+        "page": 0x01,
+        "usage": 0x06,
+        "fields": [
+            # modifiers, reserved byte
+            {
+                "page": 0x07,
+                "range": (0xE0, 0xE7),
+                "logical": (0, 1),
+                "size": 1,
+                "count": 8,
+                "flags": HID_VAR,
+            },
+            {"size": 8, "count": 1, "flags": HID_CONST | HID_VAR},
+            # LEDs
+            {
+                "main": "output",
+                "page": 0x08,
+                "range": (1, 5),
+                "logical": (0, 1),
+                "size": 1,
+                "count": 5,
+                "flags": HID_VAR,
+            },
+            {"main": "output", "size": 3, "count": 1, "flags": HID_CONST | HID_VAR},
+            # 6 keys
+            {
+                "page": 0x07,
+                "range": (0, 0x65),
+                "logical": (0, 0x65),
+                "size": 8,
+                "count": 6,
+                "flags": 0,
+            },
+        ],
+    },
+    "mouse": {
+        "page": 0x01,
+        "usage": 0x02,
+        "fields": [
+            {
+                "collection": "physical",
+                "usage": 0x01,
+                "fields": [
+                    {
+                        "page": 0x09,
+                        "range": (1, 3),
+                        "logical": (0, 1),
+                        "size": 1,
+                        "count": 3,
+                        "flags": HID_VAR,
+                    },
+                    {"size": 5, "count": 1, "flags": HID_CONST | HID_VAR},
+                    # x, y, wheel
+                    {
+                        "page": 0x01,
+                        "usages": (0x30, 0x31, 0x38),
+                        "logical": (-127, 127),
+                        "size": 8,
+                        "count": 3,
+                        "flags": HID_VAR | HID_REL,
+                    },
+                ],
+            },
+        ],
+    },
+    "joystick": {
+        "page": 0x01,
+        "usage": 0x04,
+        "fields": [
+            # throttle
+            {
+                "page": 0x02,
+                "usages": (0xBB,),
+                "logical": (-127, 127),
+                "size": 8,
+                "count": 1,
+                "flags": HID_VAR,
+            },
+            {
+                "collection": "physical",
+                "page": 0x01,
+                "usage": 0x01,
+                "fields": [
+                    {
+                        "usages": (0x30, 0x31),
+                        "logical": (-127, 127),
+                        "size": 8,
+                        "count": 2,
+                        "flags": HID_VAR,
+                    },
+                ],
+            },
+            # hat switch, 4 positions over 270 degrees
+            {
+                "usages": (0x39,),
+                "logical": (0, 3),
+                "physical": (0, 270),
+                "unit": 0x14,
+                "size": 4,
+                "count": 1,
+                "flags": HID_VAR,
+            },
+            {
+                "page": 0x09,
+                "range": (1, 4),
+                "logical": (0, 1),
+                "physical": (0, 0),
+                "unit": 0,
+                "size": 1,
+                "count": 4,
+                "flags": HID_VAR,
+            },
+        ],
+    },
+    "media": {
+        "page": 0x0C,
+        "usage": 0x01,
+        "fields": [
+            # one consumer control usage (volume, play/pause, ...)
+            {
+                "range": (0, 0x3FF),
+                "logical": (0, 0x3FF),
+                "size": 16,
+                "count": 1,
+                "flags": 0,
+            },
+        ],
+    },
+}
+# one hid function carrying several devices under report ids 1, 2, ...
+HID_COMPOSITES = {"composite": ("keyboard", "media", "mouse")}
+
+# compiled descriptors by spec hash
+_hid_descriptors = {}
+
+
+def _hid_item(tag, value, signed=False):
+    for size, code in ((1, 1), (2, 2), (4, 3)):
+        limit = 1 << (8 * size - (1 if signed else 0))
+        if (-limit if signed else 0) <= value < limit:
+            return bytes([tag | code]) + value.to_bytes(size, "little", signed=signed)
+    raise ValueError("HID item value %d out of range" % value)
+
+
+def _hid_fits(lmin, lmax, size):
+    if lmin >= 0:
+        return lmax < 1 << size
+    return -(1 << (size - 1)) <= lmin and lmax < 1 << (size - 1)
+
+
+def _hid_compile(specs):
+    ids = len(specs) > 1
+    if len(specs) > 255:
+        raise ValueError("too many HID report ids")
+    desc = bytearray()
+    state = {}
+    reports = {}
+    length = 0
+
+    def put(key, tag, value, signed=False):
+        # global items stay in effect until changed
+        if state.get(key) != value:
+            state[key] = value
+            desc.extend(_hid_item(tag, value, signed))
+
+    def field(name, spec, bits):
+        main = spec.get("main", "input")
+        size = spec["size"]
+        count = spec["count"]
+        flags = spec.get("flags", 0)
+        if main not in HID_MAIN or size < 1 or count < 1:
+            raise ValueError("%s: bad field %s" % (name, spec))
+        if "page" in spec:
+            put("page", 0x04, spec["page"])
+        if not flags & HID_CONST:
+            lmin, lmax = spec["logical"]
+            if lmin > lmax or not _hid_fits(lmin, lmax, size):
+                raise ValueError(
+                    "%s: logical %d..%d does not fit %d bits" % (name, lmin, lmax, size)
+                )
+            put("lmin", 0x14, lmin, True)
+            put("lmax", 0x24, lmax, True)
+            if "physical" in spec:
+                put("pmin", 0x34, spec["physical"][0], True)
+                put("pmax", 0x44, spec["physical"][1], True)
+            if "unit" in spec:
+                put("exponent", 0x54, spec.get("exponent", 0))
+                put("unit", 0x64, spec["unit"])
+            if "range" in spec:
+                umin, umax = spec["range"]
+                if umin > umax:
+                    raise ValueError("%s: usage range %d..%d" % (name, umin, umax))
+                desc.extend(_hid_item(0x18, umin) + _hid_item(0x28, umax))
+            elif spec.get("usages"):
+                for usage in spec["usages"]:
+                    desc.extend(_hid_item(0x08, usage))
+            else:
+                raise ValueError("%s: data field without usages" % name)
+        put("size", 0x74, size)
+        put("count", 0x94, count)
+        desc.extend(_hid_item(HID_MAIN[main], flags))
+        bits[main] += size * count
+
+    def collection(name, spec, kind, bits):
+        if "page" in spec:
+            put("page", 0x04, spec["page"])
+        desc.extend(_hid_item(0x08, spec["usage"]))
+        desc.extend(_hid_item(0xA0, HID_COLLECTIONS[kind]))
+        if kind == "application" and ids:
+            put("id", 0x84, reports[name][0])
+        for item in spec["fields"]:
+            if "fields" in item:
+                collection(name, item, item.get("collection", "physical"), bits)
+            else:
+                field(name, item, bits)
+        desc.append(0xC0)
+
+    for num, (name, spec) in enumerate(specs, 1):
+        if name in reports:
+            raise ValueError("%s: duplicate HID device" % name)
+        reports[name] = (num if ids else 0, 0)
+        bits = dict.fromkeys(HID_MAIN, 0)
+        collection(name, spec, "application", bits)
+        for main, nbits in bits.items():
+            if nbits % 8:
+                raise ValueError(
+                    "%s: %s report of %d bits is not byte aligned" % (name, main, nbits)
+                )
+            if nbits and main != "feature":
+                length = max(length, nbits // 8 + ids)
+        reports[name] = (reports[name][0], bits["input"] // 8)
+    return bytes(desc), length, reports
+
+
+def hid_descriptor(specs):
+    """Compile [(name, spec)] to (report_desc, report_length, reports)
+
+    reports maps each device name to (report id, input report size).
+    """
+    key = hashlib.sha1(json.dumps(specs, sort_keys=True).encode()).hexdigest()
+    if key not in _hid_descriptors:
+        _hid_descriptors[key] = _hid_compile(specs)
+    return _hid_descriptors[key]
+
+
+KEY_MOD_LSHIFT = 0x02
+KEY_MOD_RALT = 0x40
+# usage ids the layout rows are given for: letters, digits, then the
+# US - = [ ] \ keys, non-US #, ; ' ` , . / and non-US \ (ISO <>)
+KEYMAP_KEYS = bytes(range(0x04, 0x28)) + bytes(
+    [0x2D, 0x2E, 0x2F, 0x30, 0x31, 0x32, 0x33, 0x34, 0x35, 0x36, 0x37, 0x38, 0x64]
+)
+KEYMAP_COMMON = {"\n": 0x28, "\x1b": 0x29, "\b": 0x2A, "\t": 0x2B, " ": 0x2C}
+# a keycode directly followed by the same keycode
+KEY_REPEAT = re.compile(rb"(.)(?=\1)", re.S)
+
+
+class _Untypeable(dict):
+    # str.translate table dropping characters a layout cannot type
+    def __missing__(self, key):
+        return None
+
+
+class Keymap:
+    """Precompiled text to keyboard report encoder for one host layout.
+
+    Every typeable character gets a one byte index. Encoding translates
+    the text to indexes, the indexes to modifier and keycode bytes and
+    scatters those into the 8 byte report slots, so no Python code runs
+    per character. Pressing the next key releases the previous one, a
+    release report is only inserted where a key repeats and at the end.
+    Dead keys are not typed.
+    """
+
+    def __init__(self, name, normal, shift, altgr=None):
+        self.name = name
+        keys = {char: (0, code) for char, code in KEYMAP_COMMON.items()}
+        for mod, row in (
+            (0, zip(KEYMAP_KEYS, normal)),
+            (KEY_MOD_LSHIFT, zip(KEYMAP_KEYS, shift)),
+            (KEY_MOD_RALT, (altgr or {}).items()),
+        ):
+            for code, char in row:
+                if char != "\0":
+                    keys.setdefault(char, (mod, code))
+        assert len(keys) <= 256, name
+
+        self.chars = _Untypeable((ord(char), i) for i, char in enumerate(keys))
+        mods = bytearray(256)
+        codes = bytearray(256)
+        for i, (mod, code) in enumerate(keys.values()):
+            mods[i] = mod
+            codes[i] = code
+        self.mods = bytes(mods)
+        self.codes = bytes(codes)
+
+    def encode(self, text):
+        """Keyboard reports typing text as one bytearray"""
+        index = text.translate(self.chars).encode("latin-1")
+        if not index:
+            return bytearray()
+        mods = index.translate(self.mods)
+        codes = index.translate(self.codes)
+        breaks = [m.end() for m in KEY_REPEAT.finditer(codes)]
+
+        out = bytearray(8 * (len(codes) + len(breaks) + 1))
+        slot = 0
+        start = 0
+        for end in breaks + [len(codes)]:
+            stop = 8 * (slot + end - start)
+            out[8 * slot : stop : 8] = mods[start:end]
+            out[8 * slot + 2 : stop : 8] = codes[start:end]
+            # the slot after each run stays a release report
+            slot += end - start + 1
+            start = end
+        return out
+
+
+KEYMAPS = {
+    keymap.name: keymap
+    for keymap in (
+        Keymap(
+            "us",
+            "abcdefghijklmnopqrstuvwxyz1234567890-=[]\\\0;'`,./\0",
+            'ABCDEFGHIJKLMNOPQRSTUVWXYZ!@#$%^&*()_+{}|\0:"~<>?\0',
+        ),
+        Keymap(
+            "de",
+            "abcdefghijklmnopqrstuvwxzy1234567890ß\0ü+\0#öä\0,.-<",
+            "ABCDEFGHIJKLMNOPQRSTUVWXZY!\"§$%&/()=?\0Ü*\0'ÖÄ°;:_>",
+            {
+                0x14: "@",
+                0x08: "€",
+                0x10: "µ",
+                0x1F: "²",
+                0x20: "³",
+                0x24: "{",
+                0x25: "[",
+                0x26: "]",
+                0x27: "}",
+                0x2D: "\\",
+                0x30: "~",
+                0x64: "|",
+            },
+        ),
+        Keymap(
+            "fr",
+            "qbcdefghijkl,noparstuvzxyw&é\"'(-è_çà)=\0$\0*mù²;:!<",
+            "QBCDEFGHIJKL?NOPARSTUVZXYW1234567890°+\0£\0µM%\0./§>",
+            {
+                0x08: "€",
+                0x20: "#",
+                0x21: "{",
+                0x22: "[",
+                0x23: "|",
+                0x25: "\\",
+                0x26: "^",
+                0x27: "@",
+                0x2D: "]",
+                0x2E: "}",
+                0x30: "¤",
+            },
+        ),
+    )
+}
+
+
+class UeventMonitor:
+    """Waits for gadget device nodes using kernel uevents.
+
+    The netlink socket is opened before the UDC is bound so no event can
+    be missed; conditions are re-checked on every event and polled if
+    the socket is not available.
+    """
+
+    POLL_INTERVAL = 0.05
+
+    def __init__(self):
+        self.sock = None
+        try:
+            self.sock = socket.socket(
+                socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT
+            )
+            self.sock.bind((0, 1))
+        except (AttributeError, OSError) as e:
+            print("uevent socket not available, polling:", e)
+            self.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _next_event(self, timeout):
+        if self.sock is None:
+            time.sleep(min(timeout, self.POLL_INTERVAL))
+            return
+        ready, _, _ = select.select([self.sock], [], [], timeout)
+        if ready:
+            self.sock.recv(16384)
+
+    def wait(self, paths, exist=True, timeout=READY_TIMEOUT):
+        """Wait until all paths exist (or are gone), returns the pending ones"""
+        deadline = time.monotonic() + timeout
+        while True:
+            pending = [p for p in paths if os.path.exists(p) != exist]
+            left = deadline - time.monotonic()
+            if not pending or left <= 0:
+                return pending
+            self._next_event(left)
+
+    def wait_udc(self, statefile, state="configured", timeout=CONFIGURED_TIMEOUT):
+        """Wait for the UDC state attribute (sysfs_notify'd), returns the last state"""
+        deadline = time.monotonic() + timeout
+        try:
+            with open(statefile, "r") as sf:
+                poller = select.poll()
+                poller.register(sf, select.POLLPRI | select.POLLERR)
+                while True:
+                    sf.seek(0)
+                    current = sf.read().strip()
+                    left = deadline - time.monotonic()
+                    if current == state or left <= 0:
+                        return current
+                    poller.poll(left * 1000)
+        except OSError as e:
+            print("UDC state not readable:", e)
+            return None
+
+
+class Inotify:
+    """Minimal inotify(7) binding, the fd can be added to a GLib main loop."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.watches = {}
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        self.watches[wd] = path
+        return wd
+
+    def read(self):
+        """Returns the pending events as (path, mask, name) tuples"""
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = struct.unpack_from("=iIII", data, offset)
+            offset += 16
+            name = data[offset : offset + length].rstrip(b"\0").decode()
+            offset += length
+            events.append((self.watches.get(wd), mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Host:
+    """Side effects outside configfs: processes, systemd units and usb0.
+
+    Everything is done in-process (systemd over D-Bus, rtnetlink for the
+    interface), only programs without an API are spawned and counted.
+    """
+
+    def __init__(self):
+        self.spawned = 0
+        self._systemd = None
+
+    def run(self, argv):
+        self.spawned += 1
+        return subprocess.call(argv)
+
+    def systemd(self):
+        if self._systemd is None:
+            self._systemd = SystemBus().get(".systemd1")
+        return self._systemd
+
+    def start_unit(self, unit):
+        self.systemd().StartUnit(unit, "replace")
+
+    def stop_unit(self, unit):
+        self.systemd().StopUnit(unit, "replace")
+
+    def kill(self, pid):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            print("process %s not running" % pid)
+
+    def _rtnl(self, msgtype, flags, payload):
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE) as sock:
+            sock.bind((0, 0))
+            header = struct.pack(
+                "=LHHLL",
+                16 + len(payload),
+                msgtype,
+                flags | NLM_F_REQUEST | NLM_F_ACK,
+                1,
+                0,
+            )
+            sock.send(header + payload)
+            reply = sock.recv(4096)
+        _, rtype = struct.unpack_from("=LH", reply)
+        if rtype == NLMSG_ERROR:
+            (error,) = struct.unpack_from("=i", reply, 16)
+            if error:
+                raise OSError(-error, os.strerror(-error))
+
+    def add_address(self, ifname, address, prefixlen):
+        index = socket.if_nametoindex(ifname)
+        addr = socket.inet_aton(address)
+        ifaddrmsg = struct.pack("=BBBBI", socket.AF_INET, prefixlen, 0, 0, index)
+        attrs = struct.pack("=HH", 8, IFA_LOCAL) + addr
+        attrs += struct.pack("=HH", 8, IFA_ADDRESS) + addr
+        self._rtnl(RTM_NEWADDR, NLM_F_CREATE | NLM_F_REPLACE, ifaddrmsg + attrs)
+
+    def link_up(self, ifname):
+        index = socket.if_nametoindex(ifname)
+        ifinfomsg = struct.pack("=BxHiII", socket.AF_UNSPEC, 0, index, IFF_UP, IFF_UP)
+        self._rtnl(RTM_NEWLINK, 0, ifinfomsg)
+
+    def _rtattr(self, rtype, data):
+        attr = struct.pack("=HH", 4 + len(data), rtype) + data
+        return attr + bytes(-len(attr) % 4)
+
+    def _setlink(self, ifname, attrs):
+        index = socket.if_nametoindex(ifname)
+        ifinfomsg = struct.pack("=BxHiII", socket.AF_UNSPEC, 0, index, 0, 0)
+        self._rtnl(RTM_NEWLINK, 0, ifinfomsg + attrs)
+
+    def set_mtu(self, ifname, mtu):
+        self._setlink(ifname, self._rtattr(IFLA_MTU, struct.pack("=I", mtu)))
+
+    def set_master(self, ifname, master):
+        index = socket.if_nametoindex(master)
+        self._setlink(ifname, self._rtattr(IFLA_MASTER, struct.pack("=I", index)))
+
+    def add_bridge(self, ifname):
+        ifinfomsg = struct.pack("=BxHiII", socket.AF_UNSPEC, 0, 0, 0, 0)
+        attrs = self._rtattr(IFLA_IFNAME, ifname.encode() + b"\0")
+        attrs += self._rtattr(IFLA_LINKINFO, self._rtattr(IFLA_INFO_KIND, b"bridge"))
+        self._rtnl(RTM_NEWLINK, NLM_F_CREATE, ifinfomsg + attrs)
+
+    def del_link(self, ifname):
+        try:
+            index = socket.if_nametoindex(ifname)
+        except OSError:
+            return
+        ifinfomsg = struct.pack("=BxHiII", socket.AF_UNSPEC, 0, index, 0, 0)
+        self._rtnl(RTM_DELLINK, 0, ifinfomsg)
+
+    def set_read_ahead(self, image, kb):
+        """Set read_ahead_kb of the disk holding image, returns the old value"""
+        st = os.stat(image)
+        dev = "/sys/dev/block/%d:%d" % (os.major(st.st_dev), os.minor(st.st_dev))
+        if not os.path.isdir(os.path.join(dev, "queue")):
+            # a partition, the queue belongs to the disk
+            dev = os.path.join(dev, "..")
+        path = os.path.join(dev, "queue", "read_ahead_kb")
+        with open(path, "r") as sysfs:
+            old = int(sysfs.read())
+        with open(path, "w") as sysfs:
+            sysfs.write(str(kb))
+        return old
+
+    def loop_attach(self, path, readonly=False):
+        """Back a free loop device with path, the device is read-only if
+        the file is opened so"""
+        flags = os.O_RDONLY if readonly else os.O_RDWR
+        backing = os.open(path, flags)
+        try:
+            for _ in range(3):
+                ctl = os.open("/dev/loop-control", os.O_RDWR)
+                try:
+                    dev = "/dev/loop%d" % fcntl.ioctl(ctl, LOOP_CTL_GET_FREE)
+                finally:
+                    os.close(ctl)
+                loop = os.open(dev, flags)
+                try:
+                    fcntl.ioctl(loop, LOOP_SET_FD, backing)
+                    return dev
+                except OSError as e:
+                    # taken by someone else in between
+                    if e.errno != errno.EBUSY:
+                        raise
+                finally:
+                    os.close(loop)
+            raise OSError(errno.EBUSY, "no free loop device")
+        finally:
+            os.close(backing)
+
+    def loop_detach(self, dev):
+        loop = os.open(dev, os.O_RDONLY)
+        try:
+            fcntl.ioctl(loop, LOOP_CLR_FD)
+        finally:
+            os.close(loop)
+
+
+class ConfigFS:
+    """Directory operations on the usb_gadget configfs tree.
+
+    On the kernel configfs mkdir/rmdir create and drop the attributes and
+    default groups of an item, so these are the only calls that need a
+    stand-in when running against a plain directory tree.
+    """
+
+    def __init__(self, root=GADGETFS, trace=TRACE):
+        self.root = root
+        self.trace = trace
+        self.writes = 0
+        self.write_time = 0.0
+
+    def mkdir(self, path):
+        os.makedirs(path)
+
+    def rmdir(self, path):
+        os.rmdir(path)
+
+    def write(self, path, attrs):
+        """Write {attribute: value} below the item at path in one pass.
+
+        The item directory is opened once and every attribute is opened
+        relative to it, a failing attribute raises OSError naming it.
+        """
+        t = time.perf_counter()
+        dirfd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            for name, value in attrs.items():
+                if isinstance(value, str):
+                    value = value.encode()
+                try:
+                    fd = os.open(name, os.O_WRONLY | os.O_TRUNC, dir_fd=dirfd)
+                    try:
+                        os.write(fd, value)
+                    finally:
+                        os.close(fd)
+                except OSError as e:
+                    raise OSError(
+                        e.errno,
+                        "%s (writing %r)" % (e.strerror, value),
+                        os.path.join(path, name),
+                    ) from e
+                if self.trace:
+                    print("configfs: %s/%s = %r" % (path, name, value))
+        finally:
+            os.close(dirfd)
+            self.writes += len(attrs)
+            self.write_time += time.perf_counter() - t
+
+
+LUN_ITEMS = {
+    "file": None,
+    "ro": None,
+    "cdrom": None,
+    "nofua": None,
+    "removable": None,
+    "inquiry_string": None,
+    "forced_eject": None,
+}
+
+NET_ITEMS = {
+    "dev_addr": None,
+    "host_addr": None,
+    "qmult": None,
+    "ifname": None,
+}
+
+UAC_ITEMS = {
+    "c_chmask": None,
+    "c_srate": None,
+    "c_ssize": None,
+    "p_chmask": None,
+    "p_srate": None,
+    "p_ssize": None,
+    "req_number": None,
+}
+
+
+class FakeConfigFS(ConfigFS):
+    """ConfigFS stand-in on a tmpfs (or any) directory.
+
+    mkdir populates the attribute files and default groups the kernel
+    would create, rmdir drops them again and fails like configfs if
+    user created items are left behind.
+    """
+
+    GADGET = {
+        "UDC": None,
+        "idVendor": None,
+        "idProduct": None,
+        "bcdDevice": None,
+        "bcdUSB": None,
+        "bDeviceClass": None,
+        "bDeviceSubClass": None,
+        "bDeviceProtocol": None,
+        "bMaxPacketSize0": None,
+        "max_speed": None,
+        "functions": {},
+        "configs": {},
+        "strings": {},
+        "os_desc": {"use": None, "b_vendor_code": None, "qw_sign": None},
+    }
+    STRINGS = {"serialnumber": None, "manufacturer": None, "product": None}
+    CONFIG = {"MaxPower": None, "bmAttributes": None, "strings": {}}
+    CONFIG_STRINGS = {"configuration": None}
+    FUNCTIONS = {
+        "acm": {"port_num": None},
+        "rndis": dict(
+            NET_ITEMS,
+            **{
+                "class": None,
+                "subclass": None,
+                "protocol": None,
+                "os_desc": {
+                    "interface.rndis": {
+                        "compatible_id": None,
+                        "sub_compatible_id": None,
+                    }
+                },
+            },
+        ),
+        "ecm": NET_ITEMS,
+        "ncm": dict(NET_ITEMS, max_segment_size=None),
+        "eem": NET_ITEMS,
+        "hid": {
+            "protocol": None,
+            "subclass": None,
+            "report_length": None,
+            "report_desc": None,
+            "no_out_endpoint": None,
+            "dev": None,
+        },
+        "mass_storage": {"stall": None, "lun.0": LUN_ITEMS},
+        "uac1": UAC_ITEMS,
+        "uac2": UAC_ITEMS,
+    }
+
+    def __init__(self, root):
+        super().__init__(root)
+        self.defaults = set()
+
+    def _items(self, path):
+        parts = os.path.relpath(path, self.root).split(os.sep)
+        if len(parts) == 1:
+            return self.GADGET
+        if len(parts) == 3 and parts[1] == "strings":
+            return self.STRINGS
+        if len(parts) == 3 and parts[1] == "configs":
+            return self.CONFIG
+        if len(parts) == 5 and parts[1] == "configs" and parts[3] == "strings":
+            return self.CONFIG_STRINGS
+        if len(parts) == 3 and parts[1] == "functions":
+            return self.FUNCTIONS.get(parts[2].split(".")[0], {})
+        if len(parts) == 4 and parts[3].startswith("lun."):
+            return LUN_ITEMS
+        return {}
+
+    def _populate(self, path, items):
+        for name, sub in items.items():
+            item = os.path.join(path, name)
+            if sub is None:
+                open(item, "w").close()
+            else:
+                os.mkdir(item)
+                self.defaults.add(item)
+                self._populate(item, sub)
+
+    def mkdir(self, path):
+        path = os.path.normpath(path)
+        os.makedirs(path)
+        self._populate(path, self._items(path))
+
+    def rmdir(self, path):
+        path = os.path.normpath(path)
+        for entry in os.scandir(path):
+            if entry.is_symlink():
+                continue
+            if entry.is_file():
+                os.remove(entry.path)
+            elif entry.path in self.defaults:
+                self.rmdir(entry.path)
+        os.rmdir(path)
+        self.defaults.discard(path)
+
+
+# IN endpoints, OUT endpoints (besides ep0) and interfaces of a function
+FUNCTION_COST = {
+    "add_serial": (2, 1, 2),
+    "add_net": (2, 1, 2),
+    # EEM has no notification endpoint and one interface
+    "add_net:eem": (1, 1, 1),
+    "add_uac": (1, 1, 3),
+    "add_hid": (1, 1, 1),
+    "add_storage": (1, 1, 1),
+}
+# IN/OUT endpoints of known UDC drivers, others get the USB maximum
+UDC_ENDPOINTS = {
+    "musb-hdrc": (5, 5),
+    "dwc2": (7, 7),
+    "dwc3": (15, 15),
+    "ci_hdrc": (15, 15),
+    "dummy_udc": (15, 15),
+}
+USB_MAX_ENDPOINTS = (15, 15)
+# MAX_CONFIG_INTERFACES of the composite framework
+MAX_INTERFACES = 16
+
+
+def run_steps(steps, deadline, workers=4):
+    """Run {name: (func, deps)} on a thread pool, each step once its deps are done.
+
+    Returns ({name: exception} of the failed steps, names of the steps
+    not finished when the deadline in seconds ran out).
+    """
+    done = set()
+    errors = {}
+    running = {}
+    t0 = time.monotonic()
+
+    def timed(name, func):
+        t = time.monotonic()
+        try:
+            func()
+        finally:
+            print("Step %s took %.1f ms" % (name, (time.monotonic() - t) * 1000))
+
+    pool = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="step")
+    try:
+        while len(done) < len(steps):
+            for name, (func, deps) in steps.items():
+                if name in done or name in running.values():
+                    continue
+                if all(dep in done for dep in deps):
+                    running[pool.submit(timed, name, func)] = name
+            finished, _ = concurrent.futures.wait(
+                running,
+                timeout=max(0, deadline - (time.monotonic() - t0)),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            if not finished:
+                break
+            for future in finished:
+                name = running.pop(future)
+                done.add(name)
+                if future.exception() is not None:
+                    errors[name] = future.exception()
+                    print("Step %s failed: %s" % (name, errors[name]))
+    finally:
+        # a step stuck in the kernel keeps its thread, we do not wait for it
+        pool.shutdown(wait=False, cancel_futures=True)
+    return errors, [name for name in steps if name not in done]
+
+
+class Planner:
+    """Fits a layout into the endpoints and interfaces the UDC offers.
+
+    Runs before configfs is touched. If the layout as configured does not
+    fit, storage images are packed as LUNs into fewer mass_storage
+    functions, then HID devices are merged into one composite function;
+    if it still does not fit plan() raises ValueError with the reason.
+    """
+
+    def __init__(self, udcdir=UDCDIR):
+        self.udc = None
+        self.driver = None
+        self.speed = ""
+        self.endpoints = USB_MAX_ENDPOINTS
+        udcs = sorted(os.listdir(udcdir)) if os.path.isdir(udcdir) else []
+        if udcs:
+            self.udc = udcs[0]
+            path = os.path.join(udcdir, self.udc)
+            driver = os.path.join(path, "device/driver")
+            if os.path.exists(driver):
+                self.driver = os.path.basename(os.path.realpath(driver))
+                self.endpoints = UDC_ENDPOINTS.get(self.driver, USB_MAX_ENDPOINTS)
+            with contextlib.suppress(OSError), open(
+                os.path.join(path, "maximum_speed")
+            ) as f:
+                self.speed = f.read().strip()
+
+    def cost(self, layout, luns_per_function):
+        """(IN endpoints, OUT endpoints, interfaces) the layout needs"""
+        storage = sum(1 for method, _ in layout if method == "add_storage")
+        counts = [
+            "%s:%s" % (method, kwargs.get("ntype"))
+            for method, kwargs in layout
+            if method != "add_storage"
+        ]
+        counts += ["add_storage"] * -(-storage // luns_per_function)
+        ins = outs = interfaces = 0
+        for method in counts:
+            # the dual config is budgeted by its first config, the second
+            # only holds NCM, serial and storage
+            i, o, n = FUNCTION_COST.get(method, FUNCTION_COST[method.split(":")[0]])
+            ins += i
+            outs += o
+            interfaces += n
+        return ins, outs, interfaces
+
+    def _problem(self, layout, luns_per_function):
+        ins, outs, interfaces = self.cost(layout, luns_per_function)
+        name = self.driver or self.udc or "the UDC"
+        if ins > self.endpoints[0]:
+            return "needs %d IN endpoints, %s has %d" % (ins, name, self.endpoints[0])
+        if outs > self.endpoints[1]:
+            return "needs %d OUT endpoints, %s has %d" % (
+                outs,
+                name,
+                self.endpoints[1],
+            )
+        if interfaces > MAX_INTERFACES:
+            return "needs %d interfaces, at most %d" % (interfaces, MAX_INTERFACES)
+        return None
+
+    def _merge_hid(self, layout):
+        # all HID devices in one composite function, a device type can
+        # only be in it once so duplicates stay separate functions
+        names = []
+        merged = []
+        first = None
+        for method, kwargs in layout:
+            if method == "add_hid":
+                htype = kwargs["htype"]
+                parts = HID_COMPOSITES.get(htype, htype.split("+"))
+                if not set(parts) & set(names):
+                    if first is None:
+                        first = len(merged)
+                        merged.append(None)
+                    names += parts
+                    continue
+            merged.append((method, kwargs))
+        if first is None:
+            return layout
+        merged[first] = ("add_hid", {"htype": "+".join(names)})
+        return merged
+
+    def plan(self, layout, luns_per_function=1):
+        """(layout, luns_per_function) fitting the UDC, ValueError if none does"""
+        storage = sum(1 for method, _ in layout if method == "add_storage")
+        packed = max(luns_per_function, min(storage, MAX_LUNS))
+        candidates = [
+            (layout, luns_per_function),
+            (layout, packed),
+            (self._merge_hid(layout), packed),
+        ]
+        for candidate, luns in candidates:
+            problem = self._problem(candidate, luns)
+            if problem is None:
+                if (candidate, luns) != candidates[0]:
+                    print("Packed layout to fit the UDC: %s LUNs/function" % luns)
+                return candidate, luns
+        raise ValueError(problem)
+
+    def describe(self, layout, luns_per_function):
+        ins, outs, interfaces = self.cost(layout, luns_per_function)
+        return "IN %d/%d OUT %d/%d interfaces %d/%d (%s %s)" % (
+            ins,
+            self.endpoints[0],
+            outs,
+            self.endpoints[1],
+            interfaces,
+            MAX_INTERFACES,
+            self.driver or self.udc or "no UDC",
+            self.speed or "unknown speed",
         )
 
-    def MouseLength(self):
-        return "8"
-
-    def Mouse(self):
-        return bytes(
-            [
-                0x05,
-                0x01,
-                0x09,
-                0x02,
-                0xA1,
-                0x01,
-                0x09,
-                0x01,
-                0xA1,
-                0x00,
-                0x05,
-                0x09,
-                0x19,
-                0x01,
-                0x29,
-                0x03,
-                0x15,
-                0x00,
-                0x25,
-                0x01,
-                0x95,
-                0x03,
-                0x75,
-                0x01,
-                0x81,
-                0x02,
-                0x95,
-                0x01,
-                0x75,
-                0x05,
-                0x81,
-                0x03,
-                0x05,
-                0x01,
-                0x09,
-                0x30,
-                0x09,
-                0x31,
-                0x09,
-                0x38,
-                0x15,
-                0x81,
-                0x25,
-                0x7F,
-                0x75,
-                0x08,
-                0x95,
-                0x03,
-                0x81,
-                0x06,
-                0xC0,
-                0xC0,
-            ]
+
+DHCP_MAGIC = b"\x63\x82\x53\x63"
+DHCPDISCOVER = 1
+DHCPOFFER = 2
+DHCPREQUEST = 3
+DHCPDECLINE = 4
+DHCPACK = 5
+DHCPNAK = 6
+DHCPRELEASE = 7
+DHCPINFORM = 8
+DHCP_SUBNET_MASK = 1
+DHCP_REQUESTED_IP = 50
+DHCP_LEASE_TIME = 51
+DHCP_MESSAGE_TYPE = 53
+DHCP_SERVER_ID = 54
+
+
+class DhcpServer:
+    """In-process DHCP server for the host at the other end of usb0.
+
+    Serves the same 10.0.0.10-100 pool as the dhcpd.conf, leases are kept
+    in memory by client MAC. handle() turns a request into a reply and
+    serve() answers one datagram of any socket like object, so it can be
+    driven by a fake socket or over a veth pair; start() opens the real
+    socket bound to the interface and serves it from the GLib main loop.
+    """
+
+    def __init__(
+        self,
+        ifname="usb0",
+        server="10.0.0.1",
+        pool=("10.0.0.10", "10.0.0.100"),
+        netmask="255.255.255.0",
+        lease_time=600,
+        sock=None,
+    ):
+        self.ifname = ifname
+        self.server = ipaddress.IPv4Address(server)
+        first, last = (ipaddress.IPv4Address(a) for a in pool)
+        self.pool = [ipaddress.IPv4Address(a) for a in range(int(first), int(last) + 1)]
+        self.netmask = ipaddress.IPv4Address(netmask)
+        self.lease_time = lease_time
+        # MAC -> (address, expiry)
+        self.leases = {}
+        self.sock = sock
+        self.source = None
+
+    def start(self):
+        if self.sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                sock.setsockopt(
+                    socket.SOL_SOCKET, socket.SO_BINDTODEVICE, self.ifname.encode()
+                )
+                sock.bind(("", 67))
+            except OSError:
+                sock.close()
+                raise
+            self.sock = sock
+        self.source = GLib.io_add_watch(
+            self.sock.fileno(), GLib.IO_IN, lambda fd, condition: self.serve() or True
+        )
+        print("DHCP server on", self.ifname)
+
+    def close(self):
+        if self.source is not None:
+            GLib.source_remove(self.source)
+            self.source = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def serve(self):
+        # anything escaping the GLib callback would remove the watch and
+        # end DHCP, one bad datagram must not do that
+        try:
+            data, _ = self.sock.recvfrom(1500)
+            reply = self.handle(data)
+            if reply is not None:
+                self.sock.sendto(*reply)
+        except Exception as e:
+            print("DHCP message dropped:", e)
+
+    def _address(self, mac, requested=None):
+        now = time.monotonic()
+        lease = self.leases.get(mac)
+        if lease is not None:
+            return lease[0]
+        taken = {ip for m, (ip, expiry) in self.leases.items() if expiry > now}
+        if requested in self.pool and requested not in taken:
+            return requested
+        for ip in self.pool:
+            if ip not in taken:
+                return ip
+        return None
+
+    def handle(self, data):
+        """(reply, (address, port)) for a client message, None to ignore it"""
+        if len(data) < 240 or data[0] != 1 or data[236:240] != DHCP_MAGIC:
+            return None
+        xid, flags, ciaddr = struct.unpack_from("!IxxH4s", data, 4)
+        hlen = min(data[2], 16)
+        mac = bytes(data[28 : 28 + hlen])
+
+        options = {}
+        i = 240
+        while i < len(data) and data[i] != 255:
+            if data[i] == 0:
+                i += 1
+                continue
+            if i + 2 > len(data) or i + 2 + data[i + 1] > len(data):
+                # truncated option
+                return None
+            options[data[i]] = bytes(data[i + 2 : i + 2 + data[i + 1]])
+            i += 2 + data[i + 1]
+        msgtype = options.get(DHCP_MESSAGE_TYPE, b"\0")[:1]
+        if not msgtype:
+            return None
+        msgtype = msgtype[0]
+        server_id = options.get(DHCP_SERVER_ID)
+        if server_id is not None and server_id != self.server.packed:
+            # the host chose another server
+            return None
+        requested = options.get(DHCP_REQUESTED_IP)
+        if requested is not None and len(requested) != 4:
+            return None
+        requested = ipaddress.IPv4Address(requested or ciaddr)
+
+        yiaddr = None
+        if msgtype == DHCPDISCOVER:
+            yiaddr = self._address(mac, requested)
+            if yiaddr is None:
+                print("DHCP pool exhausted")
+                return None
+            reply = DHCPOFFER
+        elif msgtype == DHCPREQUEST:
+            if self._address(mac, requested) == requested:
+                yiaddr = requested
+                expiry = time.monotonic() + self.lease_time
+                self.leases[mac] = (yiaddr, expiry)
+                print("DHCP lease %s to %s" % (yiaddr, mac.hex(":")))
+                reply = DHCPACK
+            else:
+                reply = DHCPNAK
+        elif msgtype in (DHCPRELEASE, DHCPDECLINE):
+            self.leases.pop(mac, None)
+            return None
+        elif msgtype == DHCPINFORM:
+            reply = DHCPACK
+        else:
+            return None
+
+        out = bytearray(240)
+        struct.pack_into(
+            "!BBBBIHH4s4s4s",
+            out,
+            0,
+            2,
+            data[1],
+            data[2],
+            0,
+            xid,
+            0,
+            flags,
+            ciaddr if msgtype == DHCPINFORM else bytes(4),
+            yiaddr.packed if yiaddr is not None else bytes(4),
+            self.server.packed,
         )
+        out[28:44] = data[28:44]
+        out[236:240] = DHCP_MAGIC
+        out += bytes([DHCP_MESSAGE_TYPE, 1, reply, DHCP_SERVER_ID, 4])
+        out += self.server.packed
+        if reply != DHCPNAK:
+            out += bytes([DHCP_SUBNET_MASK, 4]) + self.netmask.packed
+        if yiaddr is not None:
+            out += bytes([DHCP_LEASE_TIME, 4]) + struct.pack("!I", self.lease_time)
+        out.append(255)
+
+        # the host has no address yet unless it is renewing
+        if ciaddr != bytes(4) and reply != DHCPNAK:
+            dest = socket.inet_ntoa(ciaddr)
+        else:
+            dest = "255.255.255.255"
+        return bytes(out), (dest, 68)
 
-    def JoystickLength(self):
-        return "4"
-
-    def Joystick(self):
-        return bytes(
-            [
-                0x05,
-                0x01,
-                0x15,
-                0x00,
-                0x09,
-                0x04,
-                0xA1,
-                0x01,
-                0x05,
-                0x02,
-                0x09,
-                0xBB,
-                0x15,
-                0x81,
-                0x25,
-                0x7F,
-                0x75,
-                0x08,
-                0x95,
-                0x01,
-                0x81,
-                0x02,
-                0x05,
-                0x01,
-                0x09,
-                0x01,
-                0xA1,
-                0x00,
-                0x09,
-                0x30,
-                0x09,
-                0x31,
-                0x95,
-                0x02,
-                0x81,
-                0x02,
-                0xC0,
-                0x09,
-                0x39,
-                0x15,
-                0x00,
-                0x25,
-                0x03,
-                0x35,
-                0x00,
-                0x46,
-                0x0E,
-                0x01,
-                0x65,
-                0x14,
-                0x75,
-                0x04,
-                0x95,
-                0x01,
-                0x81,
-                0x02,
-                0x05,
-                0x09,
-                0x19,
-                0x01,
-                0x29,
-                0x04,
-                0x15,
-                0x00,
-                0x25,
-                0x01,
-                0x75,
-                0x01,
-                0x95,
-                0x04,
-                0x55,
-                0x00,
-                0x65,
-                0x00,
-                0x81,
-                0x02,
-                0xC0,
-            ]
+
+def inspect_iso(path):
+    """File systems and boot records of an ISO image.
+
+    hybrid is an isohybrid MBR or GPT in the system area, such images
+    boot from a (removable) disk as well and are not bound to the CD-ROM
+    emulation.
+    """
+    info = {"iso9660": False, "udf": False, "eltorito": False, "hybrid": False}
+    try:
+        with open(path, "rb") as image:
+            head = image.read(32 * 2048)
+    except OSError:
+        return info
+    info["hybrid"] = (head[510:512] == b"\x55\xaa" and any(head[450:510:16])) or (
+        head[512:520] == b"EFI PART"
+    )
+    # volume descriptors and the UDF recognition sequence from sector 16
+    for offset in range(16 * 2048, len(head) - 2047, 2048):
+        ident = head[offset + 1 : offset + 6]
+        if ident == b"CD001":
+            info["iso9660"] = True
+            if head[offset + 7 : offset + 30] == b"EL TORITO SPECIFICATION":
+                info["eltorito"] = True
+        elif ident in (b"NSR02", b"NSR03"):
+            info["udf"] = True
+    return info
+
+
+def iso_hot_regions(path):
+    """(offset, length) of what booting an ISO reads, most important first.
+
+    The El Torito boot catalog and boot images, then kernels, initrds and
+    boot loader files from the ISO9660 directory tree and the directories
+    themselves. Empty for anything that is not an ISO.
+    """
+    regions = []
+    files = []
+    dirs = []
+    try:
+        with open(path, "rb") as image:
+
+            def read(sector, size):
+                image.seek(sector * 2048)
+                return image.read(size)
+
+            pvd = None
+            for sector in range(16, 32):
+                desc = read(sector, 2048)
+                if desc[1:6] != b"CD001" or desc[0] == 255:
+                    break
+                if desc[0] == 1 and pvd is None:
+                    pvd = desc
+                elif desc[0] == 0 and desc[7:30] == b"EL TORITO SPECIFICATION":
+                    (catalog,) = struct.unpack_from("<I", desc, 0x47)
+                    regions.append((catalog * 2048, 2048))
+                    entries = read(catalog, 2048)
+                    # the validation entry, then boot entries and section
+                    # headers (0x90/0x91), only entries have 0x88 or 0x00
+                    for e in range(32, len(entries) - 31, 32):
+                        if entries[e] in (0x00, 0x88):
+                            count, rba = struct.unpack_from("<HI", entries, e + 6)
+                            if rba:
+                                regions.append((rba * 2048, max(count * 512, 2048)))
+            if pvd is None:
+                return regions
+            pending = [(pvd[156:190], 0)]
+            while pending and len(dirs) < ISO_MAX_DIRS:
+                record, depth = pending.pop(0)
+                extent, size = struct.unpack_from("<I4xI", record, 2)
+                data = read(extent, min(size, 1024 * 1024))
+                dirs.append((extent * 2048, len(data)))
+                offset = 0
+                while offset < len(data):
+                    length = data[offset]
+                    if length == 0:
+                        # records do not cross sector boundaries
+                        offset = (offset // 2048 + 1) * 2048
+                        continue
+                    record = data[offset : offset + length]
+                    offset += length
+                    name = record[33 : 33 + record[32]]
+                    if len(record) < 34 or name in (b"\0", b"\1"):
+                        continue
+                    name = name.split(b";")[0].rstrip(b".").decode("latin-1").upper()
+                    if record[25] & 2:
+                        if depth < ISO_MAX_DEPTH:
+                            pending.append((record, depth + 1))
+                    elif name.startswith(ISO_HOT_FILES) or name.endswith(
+                        ISO_HOT_SUFFIXES
+                    ):
+                        extent, size = struct.unpack_from("<I4xI", record, 2)
+                        files.append((extent * 2048, size))
+    except (OSError, struct.error, IndexError) as e:
+        print("ISO not fully inspected:", path, e)
+    return [r for r in regions + files + dirs if r[1]]
+
+
+class ImageCache:
+    """Keeps LUN images or their boot regions in RAM, within one budget.
+
+    Mode ram backs the LUN with a copy of the image in RAMDIR, mode pin
+    maps the regions a boot reads first (both ends of the image and for
+    ISOs iso_hot_regions()) and mlock()s them, which reads them into the
+    page cache and keeps them there. Entries outlive the LUNs using them,
+    an image swapped back in is still warm. A new entry that does not fit
+    evicts unused entries, least recently used first, then the pins of
+    images in use; RAM copies in use stay. What still does not fit is
+    pinned in part.
+    """
+
+    def __init__(self, budget=None, directory=RAMDIR):
+        self.budget = budget if budget is not None else cache_budget()
+        self.directory = directory
+        # real path -> entry, least recently used first
+        self.entries = {}
+        # replaced entries still backing a LUN, freed on release
+        self.stale = []
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self._mmap = getattr(self.libc, "mmap64", self.libc.mmap)
+        self._mmap.restype = ctypes.c_void_p
+        self._mmap.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_size_t,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int,
+            ctypes.c_int64,
+        ]
+        self.libc.mlock.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        self.libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        self.libc.madvise.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int]
+
+    @property
+    def used(self):
+        return sum(e["bytes"] for e in list(self.entries.values()) + self.stale)
+
+    def sweep(self):
+        """Remove RAM copies left behind by an earlier run"""
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                with contextlib.suppress(OSError):
+                    os.unlink(os.path.join(self.directory, name))
+
+    def acquire(self, image, mode, stype="flash"):
+        """Cache image for a LUN, returns the entry, entry["path"] backs it"""
+        if mode not in ("ram", "pin"):
+            raise ValueError("unknown cache mode %s" % mode)
+        real = os.path.realpath(image)
+        st = os.stat(real)
+        key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+        entry = self.entries.pop(real, None)
+        if (
+            entry is not None
+            and entry["key"] == key
+            and (entry["mode"] == mode or entry["users"])
+        ):
+            # most recently used now
+            self.entries[real] = entry
+            entry["users"] += 1
+            return entry
+        if entry is not None:
+            # changed on disk or wanted in another mode
+            if entry["users"]:
+                self.stale.append(entry)
+            else:
+                self._free(entry)
+        entry = {
+            "image": real,
+            "key": key,
+            "mode": mode,
+            "path": real,
+            "bytes": 0,
+            "maps": [],
+            "users": 1,
+        }
+        self.entries[real] = entry
+        try:
+            if mode == "ram":
+                if self._make_room(st.st_size, entry):
+                    try:
+                        self._copy(entry)
+                        return entry
+                    except OSError as e:
+                        print("No RAM copy of %s: %s" % (image, e))
+                else:
+                    print("RAM copy of %s exceeds the cache budget" % image)
+                entry["mode"] = "pin"
+            self._pin(entry, stype)
+        except Exception:
+            self._free(entry)
+            del self.entries[real]
+            raise
+        return entry
+
+    def release(self, entry):
+        entry["users"] -= 1
+        if not entry["users"] and entry in self.stale:
+            self.stale.remove(entry)
+            self._free(entry)
+
+    def _make_room(self, size, keep):
+        for in_use in (False, True):
+            for real, entry in list(self.entries.items()):
+                if self.used + size <= self.budget:
+                    return True
+                if entry is keep:
+                    continue
+                if not entry["users"]:
+                    print("Evicting %s from the cache" % real)
+                    self._free(entry)
+                    del self.entries[real]
+                elif in_use and entry["maps"]:
+                    print("Unpinning %s" % real)
+                    self._unpin(entry)
+        return self.used + size <= self.budget
+
+    def _copy(self, entry):
+        os.makedirs(self.directory, 0o700, exist_ok=True)
+        digest = hashlib.sha1(os.fsencode(entry["image"])).hexdigest()[:8]
+        name = "%s-%s" % (digest, os.path.basename(entry["image"]))
+        path = os.path.join(self.directory, name)
+        part = path + ".part"
+        t = time.monotonic()
+        with open(entry["image"], "rb") as src, open(part, "wb") as dst:
+            entry["bytes"] = entry["key"][2]
+            try:
+                offset = 0
+                while offset < entry["key"][2]:
+                    sent = os.sendfile(dst.fileno(), src.fileno(), offset, IMAGE_CHUNK)
+                    if not sent:
+                        break
+                    offset += sent
+                os.rename(part, path)
+            except OSError:
+                entry["bytes"] = 0
+                os.unlink(part)
+                raise
+        entry["path"] = path
+        print(
+            "RAM copy %s of %s in %.1fs" % (path, entry["image"], time.monotonic() - t)
         )
 
+    def _regions(self, entry, stype):
+        size = entry["key"][2]
+        regions = [(0, CACHE_HEAD)]
+        if stype == "iso":
+            regions += iso_hot_regions(entry["image"])
+        regions.append((max(0, size - CACHE_TAIL), CACHE_TAIL))
+        # page aligned, within the image, without overlaps
+        pages = []
+        for offset, length in regions:
+            start = offset - offset % mmap.PAGESIZE
+            end = min(size, -(-(offset + length) // mmap.PAGESIZE) * mmap.PAGESIZE)
+            for done_start, done_end in pages:
+                if start >= done_start and end <= done_end:
+                    break
+            else:
+                if end > start:
+                    pages.append((start, end))
+        return pages
+
+    def _pin(self, entry, stype):
+        regions = self._regions(entry, stype)
+        self._make_room(sum(end - start for start, end in regions), entry)
+        fd = os.open(entry["image"], os.O_RDONLY)
+        try:
+            for start, end in regions:
+                if self.used + end - start > self.budget:
+                    print("Cache budget used up, %s pinned in part" % entry["image"])
+                    break
+                addr = self._mmap(
+                    None, end - start, mmap.PROT_READ, mmap.MAP_SHARED, fd, start
+                )
+                if addr in (None, ctypes.c_void_p(-1).value):
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err), entry["image"])
+                entry["maps"].append((addr, end - start))
+                entry["bytes"] += end - start
+                if self.libc.mlock(addr, end - start) != 0:
+                    # no CAP_IPC_LOCK, at least read it in
+                    self.libc.madvise(addr, end - start, mmap.MADV_WILLNEED)
+        finally:
+            os.close(fd)
+        print(
+            "Pinned %d KiB of %s in %d regions"
+            % (entry["bytes"] // 1024, entry["image"], len(entry["maps"]))
+        )
+
+    def _unpin(self, entry):
+        # unmapping unlocks, the pages may then leave the page cache
+        for addr, length in entry["maps"]:
+            self.libc.munmap(addr, length)
+            entry["bytes"] -= length
+        entry["maps"] = []
+
+    def _free(self, entry):
+        self._unpin(entry)
+        if entry["path"] != entry["image"]:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(entry["path"])
+            entry["path"] = entry["image"]
+            entry["bytes"] = 0
+
+
+def cache_budget():
+    """CACHE_BUDGET_MB in bytes, a quarter of the RAM if that is 0"""
+    if CACHE_BUDGET_MB:
+        return CACHE_BUDGET_MB * 1024 * 1024
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 4
+
+
+class Overlay:
+    """Throwaway copy-on-write view of a base image for one LUN.
+
+    On btrfs/xfs a reflink clone next to the base shares all its blocks
+    and is made with a single FICLONE ioctl. Elsewhere a device-mapper
+    snapshot is put over a read-only loop device of the base, with the
+    changed chunks kept in a sparse file in TEMPDIR. The base is never
+    written, discard() drops all changes.
+    """
+
+    def __init__(self, base, name, host):
+        self.base = base
+        self.name = name
+        self.host = host
+        # what the LUN is backed by
+        self.path = None
+        self.files = []
+        self.loops = []
+        self.dm = None
+
+    def create(self):
+        try:
+            self._reflink()
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL):
+                raise
+            print("No reflink for %s (%s), using a snapshot" % (self.base, e.strerror))
+            try:
+                self._snapshot()
+            except Exception:
+                self.discard()
+                raise
+        print("Overlay %s over %s" % (self.path, self.base))
+        return self.path
+
+    def _reflink(self):
+        directory, name = os.path.split(self.base)
+        path = os.path.join(directory, ".%s.%s" % (name, self.name))
+        # the directory belongs to the user, a leftover could be a link to
+        # a file of someone else, only a file we create is written
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        with open(self.base, "rb") as base:
+            flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW
+            fd = os.open(path, flags, 0o600)
+            try:
+                fcntl.ioctl(fd, FICLONE, base.fileno())
+            except OSError:
+                os.unlink(path)
+                raise
+            finally:
+                os.close(fd)
+        self.files.append(path)
+        self.path = path
+
+    def _snapshot(self):
+        sectors = os.path.getsize(self.base) // 512
+        cow = os.path.join(TEMPDIR, self.name + ".cow")
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(cow)
+        with open(cow, "xb", opener=_nofollow) as store:
+            # room for every chunk to change, only changed ones use space
+            store.truncate(sectors * 512)
+        self.files.append(cow)
+        origin = self.host.loop_attach(self.base, readonly=True)
+        self.loops.append(origin)
+        store = self.host.loop_attach(cow)
+        self.loops.append(store)
+        if os.path.exists("/dev/mapper/" + self.name):
+            # left over from an unclean exit
+            self.host.run(["dmsetup", "remove", self.name])
+        table = "0 %d snapshot %s %s N 8" % (sectors, origin, store)
+        if self.host.run(["dmsetup", "create", self.name, "--table", table]) != 0:
+            raise OSError("dmsetup create %s failed" % self.name)
+        self.dm = self.name
+        self.path = "/dev/mapper/" + self.name
+
+    def discard(self):
+        if self.dm is not None:
+            self.host.run(["dmsetup", "remove", self.dm])
+            self.dm = None
+        for dev in reversed(self.loops):
+            try:
+                self.host.loop_detach(dev)
+            except OSError as e:
+                print("Detaching %s failed: %s" % (dev, e))
+        for path in self.files:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+        self.loops = []
+        self.files = []
+        self.path = None
+
+
+def dbus_caller(dbus_context):
+    """pwd entry of the sender of a D-Bus call, None for in-process calls"""
+    if dbus_context is None:
+        return None
+    uid = dbus_context.bus.dbus.GetConnectionUnixUser(dbus_context.sender)
+    return pwd.getpwuid(uid)
+
+
+def authorize(dbus_context, action=POLKIT_IMAGES):
+    """PermissionError unless polkit allows the sender of a D-Bus call action"""
+    if dbus_context is None:
+        return
+    subject = ("system-bus-name", {"name": GLib.Variant("s", dbus_context.sender)})
+    try:
+        authority = dbus_context.bus.get(".PolicyKit1", "Authority")
+        allowed = authority.CheckAuthorization(subject, action, {}, 0, "")[0]
+    except Exception as e:
+        print("polkit check failed:", e)
+        allowed = False
+    if not allowed:
+        raise PermissionError(errno.EACCES, "Not authorized", action)
+
+
+def user_image_path(user, path):
+    """The real path of path if it is in one of the image directories of
+    user, root (or None, in-process) may use any path"""
+    if user is None or user.pw_uid == 0:
+        return path
+    real = os.path.realpath(path)
+    for sub in IMAGE_SUBDIRS:
+        directory = os.path.realpath(os.path.join(user.pw_dir, ".gadget", sub))
+        if os.path.commonpath([real, directory]) != directory:
+            continue
+        # not a link to someone else's directory
+        with contextlib.suppress(OSError):
+            if os.stat(directory).st_uid == user.pw_uid:
+                return real
+    raise PermissionError(
+        errno.EACCES, "Not in the image directories of %s" % user.pw_name, path
+    )
+
+
+@contextlib.contextmanager
+def user_image_dir(user, directory):
+    """Path to an image directory of user that can not be swapped.
+
+    The user owns the directory and could replace it (or a parent) with a
+    symlink after the check, so the path handed out goes through an open
+    file descriptor of the checked directory, also for spawned programs.
+    """
+    if user is None or user.pw_uid == 0:
+        yield directory
+        return
+    fd = os.open(directory, os.O_PATH | os.O_DIRECTORY)
+    try:
+        real = user_image_path(user, os.readlink("/proc/self/fd/%d" % fd))
+        if os.fstat(fd).st_uid != user.pw_uid:
+            raise PermissionError(errno.EACCES, "Not owned by " + user.pw_name, real)
+        yield "/proc/%d/fd/%d" % (os.getpid(), fd)
+    finally:
+        os.close(fd)
+
+
+def open_as(user, path):
+    """Open path for reading with the permissions of user instead of root"""
+    if user is None or user.pw_uid == 0:
+        return open(path, "rb")
+    ours, theirs = socket.socketpair()
+    with ours:
+        with theirs:
+            helper = [sys.executable, "-I", "-c", OPEN_AS_HELPER]
+            subprocess.run(
+                helper + [str(theirs.fileno()), path],
+                pass_fds=(theirs.fileno(),),
+                user=user.pw_uid,
+                group=user.pw_gid,
+                extra_groups=os.getgrouplist(user.pw_name, user.pw_gid),
+                cwd="/",
+                env={},
+                timeout=30,
+            )
+        msg, fds, _, _ = socket.recv_fds(ours, 16, 1)
+    if not fds:
+        error = int(msg) if msg.isdigit() else errno.EIO
+        raise OSError(error, os.strerror(error), path)
+    return open(fds[0], "rb")
+
+
+def _nofollow(path, flags):
+    # part files live in directories of users, never follow their symlinks
+    return os.open(path, flags | os.O_NOFOLLOW, 0o644)
+
+
+def publish_image(part, path):
+    """Give a finished .part file its name, owned like its directory"""
+    # the service runs as root, the image belongs to the user
+    stat = os.stat(os.path.dirname(os.path.abspath(path)))
+    os.chown(part, stat.st_uid, stat.st_gid, follow_symlinks=False)
+    # unlike rename this does not replace an image created meanwhile
+    os.link(part, path)
+
+
+class ImageFactory:
+    """Creates flash images for the mass storage function.
+
+    A sparse image is only truncated, its blocks get allocated while the
+    host writes, which makes writes slow and jittery on eMMC; fallocate
+    reserves all blocks up front. The image can be formatted with FAT or
+    exFAT. It is built as a hidden .part file next to the target and only
+    linked into place when complete.
+    """
+
+    def __init__(self, host=None, progress=None):
+        self.host = host if host is not None else Host()
+        self.progress = progress if progress is not None else lambda *args: None
+
+    def create(self, path, size, alloc="sparse", fs=""):
+        if alloc not in IMAGE_ALLOC:
+            raise ValueError("unknown allocation %s" % alloc)
+        if fs not in IMAGE_FS:
+            raise ValueError("unknown filesystem %s" % fs)
+        if size <= 0:
+            raise ValueError("size must be positive")
+        if os.path.lexists(path):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        directory, name = os.path.split(os.path.abspath(path))
+        part = os.path.join(directory, "." + name + ".part")
+        fd = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o644)
+        try:
+            try:
+                self._allocate(fd, size, alloc)
+                if fs:
+                    self.progress("format", fs)
+                    label = re.sub("[^A-Z0-9]", "", os.path.splitext(name)[0].upper())
+                    # through our fd, the part may have been replaced by now
+                    own = "/proc/%d/fd/%d" % (os.getpid(), fd)
+                    argv = IMAGE_FS[fs] + [label[:11] or "GADGET", own]
+                    if self.host.run(argv) != 0:
+                        raise OSError("%s failed" % argv[0])
+            finally:
+                os.close(fd)
+            publish_image(part, path)
+        finally:
+            with contextlib.suppress(OSError):
+                os.unlink(part)
+        print("Created %s (%s %s)" % (path, alloc, fs or "unformatted"))
+        return path
+
+    def _allocate(self, fd, size, alloc):
+        os.ftruncate(fd, size)
+        if alloc == "fallocate":
+            done = 0
+            while done < size:
+                length = min(IMAGE_CHUNK, size - done)
+                os.posix_fallocate(fd, done, length)
+                done += length
+                self.progress("allocate", "%d%%" % (done * 100 // size))
+            os.fsync(fd)
+
+
+def idle_priority():
+    """Lowest CPU and idle I/O priority for the calling thread"""
+    tid = threading.get_native_id()
+    with contextlib.suppress(OSError):
+        os.setpriority(os.PRIO_PROCESS, tid, 19)
+    nr = IOPRIO_SYSCALL.get(os.uname().machine)
+    if nr is not None:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.syscall(nr, IOPRIO_WHO_PROCESS, tid, IOPRIO_CLASS_IDLE << 13)
+
+
+class ImageVerifier:
+    """Checks images against their published checksums in the background.
+
+    The expected sum comes from a <image>.sha256 / <image>.b2 sidecar or a
+    SHA256SUMS / B2SUMS manifest in the same directory. Images are read in
+    large blocks on a small thread pool at idle priority and dropped from
+    the page cache behind the reader. Results are cached by (device,
+    inode, size, mtime), an unchanged image is only read once.
+    """
+
+    def __init__(self, cache=None, workers=2, done=None, in_use=None):
+        self.cache = cache if cache is not None else VERIFYCACHE
+        # done(path, status, digest) after every check, on a pool thread
+        self.done = done
+        # real paths of the images backing LUNs, they stay in the page cache
+        self.in_use = in_use if in_use is not None else set
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            workers, thread_name_prefix="verify"
+        )
+        # key -> [status, digest, path]
+        self.results = {}
+        try:
+            with open(self.cache, "r") as cfile:
+                results = json.load(cfile)
+        except (OSError, ValueError):
+            results = {}
+        for key, result in results.items():
+            # drop images that are gone or changed
+            with contextlib.suppress(OSError):
+                if self._key(result[2]) == key:
+                    self.results[key] = result
+
+    def _key(self, path):
+        return self.stat_key(os.stat(path))
+
+    def stat_key(self, st):
+        return "%d:%d:%d:%d" % (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def status(self, path, key=None):
+        """(status, digest) of path: ok, mismatch, unknown (no published sum),
+        error or pending (not checked yet)"""
+        try:
+            if key is None:
+                key = self._key(path)
+        except OSError as e:
+            return "error", e.strerror
+        with self.lock:
+            if key in self.results:
+                return tuple(self.results[key][:2])
+        return "pending", ""
+
+    def verify(self, path, key=None):
+        """Like status(), but queues a check of an image not checked yet.
+        With a key only the file with that key is hashed.
+        """
+        status, digest = self.status(path, key)
+        if status == "pending":
+            with self.lock:
+                if path not in self.pending:
+                    self.pending[path] = self.pool.submit(self._verify, path, key)
+        return status, digest
+
+    def expected(self, path):
+        """(hash name, expected hex digest or None)"""
+        for ext, algo in VERIFY_SIDECARS:
+            with contextlib.suppress(OSError, IndexError):
+                with open(path + ext, "r") as sidecar:
+                    return algo, sidecar.read().split()[0].lower()
+        directory, name = os.path.split(path)
+        for manifest, algo in VERIFY_MANIFESTS:
+            with contextlib.suppress(OSError):
+                with open(os.path.join(directory, manifest), "r") as sums:
+                    for line in sums:
+                        fields = line.split()
+                        if len(fields) == 2 and fields[1].lstrip("*") == name:
+                            return algo, fields[0].lower()
+        return "sha256", None
+
+    def hash(self, path, algo="sha256", key=None):
+        digest = hashlib.new(algo)
+        buf = bytearray(VERIFY_BUFSIZE)
+        view = memoryview(buf)
+        offset = 0
+        real = os.path.realpath(path)
+        with open(path, "rb", buffering=0) as image:
+            fd = image.fileno()
+            if key is not None and self.stat_key(os.fstat(fd)) != key:
+                raise OSError(errno.ESTALE, "Image changed", path)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                size = image.readinto(buf)
+                if not size:
+                    break
+                # hashlib releases the GIL for large updates
+                digest.update(view[:size])
+                # drop what we read from the page cache, unless a LUN
+                # is (or is about to be) backed by the image
+                if real not in self.in_use():
+                    os.posix_fadvise(fd, offset, size, os.POSIX_FADV_DONTNEED)
+                offset += size
+        return digest.hexdigest()
+
+    def _verify(self, path, key=None):
+        idle_priority()
+        try:
+            if key is None:
+                key = self._key(path)
+            algo, expected = self.expected(path)
+            digest = self.hash(path, algo, key)
+            if expected is None:
+                status = "unknown"
+            else:
+                status = "ok" if digest == expected else "mismatch"
+            digest = f"{algo}:{digest}"
+            with self.lock:
+                self.results[key] = [status, digest, path]
+                self._save()
+        except OSError as e:
+            status, digest = "error", e.strerror or str(e)
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+        print("Verified %s: %s" % (path, status))
+        if self.done is not None:
+            self.done(path, status, digest)
+        return status, digest
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.cache), exist_ok=True)
+            tmp = self.cache + ".tmp"
+            with open(tmp, "w") as cfile:
+                json.dump(self.results, cfile)
+            os.replace(tmp, self.cache)
+        except OSError as e:
+            print("Checksum cache not saved:", e)
+
+
+class _ImportStream(io.RawIOBase):
+    """The raw bytes of an import, hashed on the way.
+
+    First what an earlier attempt saved in the part file, then the rest
+    from the source, which is appended to the part file as it arrives.
+    """
+
+    def __init__(self, part, source, digest, progress, user=None):
+        self.part = open(part, "a+b", opener=_nofollow)
+        self.part.seek(0)
+        self.source = source
+        self.user = user
+        self.response = None
+        self.digest = digest
+        self.progress = progress
+        self.offset = 0
+        self.size = None
+        self.reported = -1
+
+    def readable(self):
+        return True
+
+    def _open(self):
+        if "://" not in self.source:
+            # only what the caller may read
+            response = open_as(self.user, self.source)
+            response.seek(self.offset)
+            self.size = os.fstat(response.fileno()).st_size
+            return response
+        request = urllib.request.Request(self.source)
+        if self.offset:
+            request.add_header("Range", "bytes=%d-" % self.offset)
+        response = urllib.request.urlopen(request, timeout=60)
+        length = response.headers.get("Content-Length")
+        if self.offset and response.status != 206:
+            # no range support, skip what we already have
+            print("Server does not resume, skipping %d bytes" % self.offset)
+            skip = self.offset
+            while skip:
+                data = response.read(min(skip, IMPORT_BUFSIZE))
+                if not data:
+                    raise OSError("%s is shorter than the part file" % self.source)
+                skip -= len(data)
+        elif self.offset:
+            print("Resuming at %d bytes" % self.offset)
+        if length is not None:
+            self.size = int(length) + (self.offset if response.status == 206 else 0)
+        return response
+
+    def readinto(self, buf):
+        size = self.part.readinto(buf)
+        if not size:
+            if self.response is None:
+                self.response = self._open()
+            size = self.response.readinto(buf)
+            if size:
+                self.part.write(memoryview(buf)[:size])
+            elif self.size is not None and self.offset < self.size:
+                # the part file stays, the next attempt resumes from here
+                raise OSError(
+                    "%s ended after %d of %d bytes"
+                    % (self.source, self.offset, self.size)
+                )
+        self.digest.update(memoryview(buf)[:size])
+        self.offset += size
+        if self.size:
+            percent = self.offset * 100 // self.size
+            if percent != self.reported:
+                self.reported = percent
+                self.progress("import", "%d%%" % percent)
+        return size
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+        self.part.close()
+        super().close()
+
+
+class ImageImporter:
+    """Streams an image from a path or http(s) URL into an image directory.
+
+    .xz/.gz/.zst sources are decompressed on the fly. The source bytes are
+    kept in a hidden .part file so an interrupted import resumes where it
+    stopped (with an HTTP Range request), a compressed source is then
+    decompressed again from the local part. The checksum ("sha256:<hex>",
+    of the source as published) is computed while streaming. Nothing is
+    held in memory beyond one IMPORT_BUFSIZE block. A local source is
+    opened with the permissions of user.
+    """
+
+    def __init__(self, progress=None, user=None):
+        self.progress = progress if progress is not None else lambda *args: None
+        self.user = user
+
+    def target(self, source, directory):
+        """Image path for a source, without the compression suffix"""
+        name = os.path.basename(source.split("?")[0].rstrip("/"))
+        base, ext = os.path.splitext(name)
+        return os.path.join(directory, base if ext in IMPORT_COMPRESSED else name)
+
+    def _decompress(self, stream, ext):
+        if ext == ".xz":
+            return lzma.LZMAFile(stream)
+        if ext == ".gz":
+            return gzip.GzipFile(fileobj=stream)
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError(".zst imports need python-zstandard") from None
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+
+    def run(self, source, path, checksum=""):
+        if os.path.lexists(path):
+            raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), path)
+        algo, _, expected = checksum.partition(":")
+        if checksum and algo not in hashlib.algorithms_available:
+            raise ValueError("unknown checksum %s" % algo)
+        scheme = source.partition("://")[0] if "://" in source else ""
+        if scheme and scheme not in IMPORT_SCHEMES:
+            raise ValueError("unsupported source %s" % source)
+        directory = os.path.dirname(os.path.abspath(path))
+        name = os.path.basename(source.split("?")[0].rstrip("/"))
+        ext = os.path.splitext(name)[1]
+        raw = os.path.join(directory, "." + name + ".part")
+        out = raw
+        digest = hashlib.new(algo or "sha256")
+
+        stream = _ImportStream(raw, source, digest, self.progress, self.user)
+        try:
+            if ext in IMPORT_COMPRESSED:
+                out = os.path.join(directory, "." + os.path.basename(path) + ".part")
+                reader = self._decompress(stream, ext)
+                # written in whole IMPORT_BUFSIZE blocks
+                image = open(out, "wb", buffering=IMPORT_BUFSIZE, opener=_nofollow)
+                with reader, image:
+                    for block in iter(lambda: reader.read(IMPORT_BUFSIZE), b""):
+                        image.write(block)
+            else:
+                buf = bytearray(IMPORT_BUFSIZE)
+                while stream.readinto(buf):
+                    pass
+        except Exception:
+            # nothing to resume from
+            with contextlib.suppress(OSError):
+                if not os.lstat(raw).st_size:
+                    os.unlink(raw)
+            raise
+        finally:
+            stream.close()
+
+        if expected and digest.hexdigest() != expected.lower():
+            # a corrupt part can not be resumed either
+            for part in (raw, out):
+                with contextlib.suppress(OSError):
+                    os.unlink(part)
+            raise ValueError("%s checksum mismatch" % algo)
+        self.progress("publish", os.path.basename(path))
+        try:
+            publish_image(out, path)
+        finally:
+            for part in (raw, out):
+                with contextlib.suppress(OSError):
+                    os.unlink(part)
+        print("Imported %s from %s" % (path, source))
+        return path
 
-class Gadget:
-    def __init__(self, xml):
-        self.devices = 0
-        self.max_devices = 5
 
-        self.fullpath = os.path.join(GADGETFS, GADGETNAME)
+class Gadget:
+    def __init__(
+        self,
+        xml,
+        configfs=None,
+        udcdir=UDCDIR,
+        systemddir=SYSTEMDDIR,
+        host=None,
+        monitor=UeventMonitor,
+        progress=None,
+        cache=None,
+        name=GADGETNAME,
+    ):
+        self.configfs = configfs if configfs is not None else ConfigFS()
+        self.name = name
+        self.udcdir = udcdir
+        self.systemddir = systemddir
+        self.host = host if host is not None else Host()
+        self.monitor = monitor
+        # shared with the controller, outlives the gadget
+        self.cache = cache if cache is not None else ImageCache()
+        # called with the name of each phase of start/stop/reconfigure
+        self.progress = progress if progress is not None else (lambda phase: None)
+
+        self.fullpath = os.path.join(self.configfs.root, name)
+        # per gadget, stopping a benchmark gadget leaves the dhcpd of the
+        # live one alone
+        self.dhcppidpath = os.path.join(TEMPDIR, "%s-dhcpd.pid" % name)
 
         self.net = False
         self.serial = False
+        # (function, expected interface name) of the network functions,
+        # the interface carrying 10.0.0.1, RNDIS+NCM in two configs
+        self.netifs = []
+        self.netif = None
+        self.dual = False
+        self.mtu = None
 
         self.hid = []
+        # one entry per mass storage LUN, in LUN order
         self.storage = []
+        # image -> read_ahead_kb of its disk before we changed it
+        self.read_ahead = {}
+        # function name -> (add_* method, sorted kwargs) it was built from,
+        # mass storage is tracked per LUN in self.storage
+        self.functions = {}
+        self.udc = None
+        # ("dir", path) / ("link", path) for every configfs mkdir and
+        # symlink, in order, so teardown undoes exactly what was built
+        self.journal = []
+        # set by a completed stop()
+        self.stopped = False
+
+        # images share one mass_storage function as LUNs if the config
+        # has <storage_luns>N</storage_luns>, otherwise one function each
+        self.luns_per_function = 1
+        # <storage_stall>1</storage_stall> lets the mass storage functions
+        # halt bulk endpoints, some hosts need it off
+        self.storage_stall = False
+        # <dhcp>builtin</dhcp> serves DHCP in-process instead of dhcpd
+        self.dhcp = "dhcpd"
+        self.dhcp_server = None
+        if xml is not None:
+            luns = xml.find(".//storage_luns")
+            if luns is not None:
+                self.luns_per_function = max(1, min(int(luns.text), MAX_LUNS))
+            self.dhcp = xml.findtext(".//dhcp", "dhcpd")
+            self.storage_stall = xml.findtext(".//storage_stall", "0") == "1"
+            # <cache_budget_mb>N</cache_budget_mb> for the <cache> LUNs
+            budget = xml.findtext(".//cache_budget_mb")
+            self.cache.budget = int(budget) * 1024 * 1024 if budget else cache_budget()
+
+    def _mkdir(self, path):
+        self.configfs.mkdir(path)
+        self.journal.append(("dir", path))
+
+    def _link(self, target, path):
+        os.symlink(target, path, target_is_directory=True)
+        self.journal.append(("link", path))
+
+    def _undo(self, match=None):
+        """Remove journaled links and dirs (all or those match()es), newest first"""
+        kept = []
+        for kind, path in reversed(self.journal):
+            if match is not None and not match(path):
+                kept.append((kind, path))
+            elif kind == "link":
+                self.fdel(path)
+            else:
+                self.ddel(path)
+        self.journal = kept[::-1]
+
+    def _undo_since(self, mark):
+        """Remove what was journaled from index mark on, newest first"""
+        kept = self.journal[:mark]
+        self.journal = self.journal[mark:]
+        self._undo()
+        self.journal = kept + self.journal
 
     def prepaire(self):
         print("Start Multi Device")
+        self.progress("prepaire")
         fp = self.fullpath
 
-        os.makedirs(fp)
-
-        with open(os.path.join(fp, "idVendor"), "w") as wf:
-            wf.write("0x1d6b")
-        with open(os.path.join(fp, "idProduct"), "w") as wf:
-            wf.write("0x0104")
-        with open(os.path.join(fp, "bcdDevice"), "w") as wf:
-            wf.write("0x0100")
-        with open(os.path.join(fp, "bcdUSB"), "w") as wf:
-            wf.write("0x0300")
-
-        with open(os.path.join(fp, "bDeviceClass"), "w") as wf:
-            wf.write("0xEF")
-
-        with open(os.path.join(fp, "bDeviceSubClass"), "w") as wf:
-            wf.write("0x02")
-
-        with open(os.path.join(fp, "bDeviceProtocol"), "w") as wf:
-            wf.write("0x01")
+        self._mkdir(fp)
+        self.configfs.write(
+            fp,
+            {
+                "idVendor": "0x1d6b",
+                "idProduct": "0x0104",
+                "bcdDevice": "0x0100",
+                "bcdUSB": "0x0300",
+                "bDeviceClass": "0xEF",
+                "bDeviceSubClass": "0x02",
+                "bDeviceProtocol": "0x01",
+            },
+        )
 
-        os.makedirs(os.path.join(fp, "strings/0x409"))
+        self._mkdir(os.path.join(fp, "strings/0x409"))
         import uuid
 
-        with open(os.path.join(fp, "strings/0x409/serialnumber"), "w") as wf:
-            wf.write(str(uuid.uuid4()))
-        with open(os.path.join(fp, "strings/0x409/manufacturer"), "w") as wf:
-            wf.write("BEAERLIN")
-        with open(os.path.join(fp, "strings/0x409/product"), "w") as wf:
-            wf.write("GadgetController")
-
-        os.makedirs(os.path.join(fp, "configs/c.1"))
-        with open(os.path.join(fp, "configs/c.1/MaxPower"), "w") as wf:
-            wf.write("900")
-        os.makedirs(os.path.join(fp, "configs/c.1/strings/0x409"))
+        self.configfs.write(
+            os.path.join(fp, "strings/0x409"),
+            {
+                "serialnumber": str(uuid.uuid4()),
+                "manufacturer": "BEAERLIN",
+                "product": "GadgetController",
+            },
+        )
+
+        self._mkdir(os.path.join(fp, "configs/c.1"))
+        self.configfs.write(os.path.join(fp, "configs/c.1"), {"MaxPower": "900"})
+        self._mkdir(os.path.join(fp, "configs/c.1/strings/0x409"))
         # ~ with open(os.path.join(fp,'configs/%s/strings/0x409/configuration'%config),'w') as wf:
         # ~ wf.write("badusb cfg1")
 
@@ -301,12 +2388,12 @@ class Gadget:
 
         usbpath = os.path.join(self.fullpath, "functions/acm.usb0")
 
-        os.makedirs(usbpath)
-        os.symlink(
+        self._mkdir(usbpath)
+        self._link(
             usbpath,
             os.path.join(self.fullpath, "configs/c.1/acm.usb0"),
-            target_is_directory=True,
         )
+        self.functions["acm.usb0"] = ("add_serial", ())
 
         print("Done")
 
@@ -316,238 +2403,699 @@ class Gadget:
 
         usbpath = os.path.join(self.fullpath, f"functions/{stype}.usb0")
 
-        os.makedirs(usbpath)
-
-        with open(os.path.join(usbpath, "c_chmask"), "w") as wf:
-            wf.write("0x03")
-
-        with open(os.path.join(usbpath, "c_srate"), "w") as wf:
-            wf.write("48000")
-
-        with open(os.path.join(usbpath, "p_chmask"), "w") as wf:
-            wf.write("0x03")
-
-        with open(os.path.join(usbpath, "p_srate"), "w") as wf:
-            wf.write("48000")
+        self._mkdir(usbpath)
+        self.configfs.write(
+            usbpath,
+            {
+                "c_chmask": "0x03",
+                "c_srate": "48000",
+                "p_chmask": "0x03",
+                "p_srate": "48000",
+            },
+        )
 
-        os.symlink(
+        self._link(
             usbpath,
             os.path.join(self.fullpath, f"configs/c.1/{stype}.usb0"),
-            target_is_directory=True,
         )
+        self.functions[f"{stype}.usb0"] = ("add_uac", (("stype", stype),))
 
         print("Done")
 
-    def add_net(self, ntype="rndis"):
+    def add_net(self, ntype="rndis", qmult=None, mtu=None, max_segment_size=None):
+        """Network function: rndis, ncm, ecm, eem, or dual for RNDIS in the
+        first config (Windows only uses that one) and NCM in a second one
+        that Linux and macOS hosts choose."""
+        if ntype not in ("rndis", "ncm", "ecm", "eem", "dual"):
+            print("Unknown Network Device", ntype)
+            return
 
         self.net = True
         print(f"Add {ntype} Device")
-        if ntype == "rndis":
+        options = {"ntype": ntype}
+        attrs = {"host_addr": "46:6f:73:74:50:00", "dev_addr": "44:61:64:55:53:00"}
+        if qmult is not None:
+            options["qmult"] = qmult
+            attrs["qmult"] = str(qmult)
+        if mtu is not None:
+            options["mtu"] = mtu
+            self.mtu = mtu
+        if max_segment_size is not None:
+            options["max_segment_size"] = max_segment_size
+        key = tuple(sorted(options.items()))
+
+        if ntype in ("rndis", "dual"):
             # rndis windows
-            with open(os.path.join(self.fullpath, "os_desc/use"), "w") as wf:
-                wf.write("1")
-            with open(os.path.join(self.fullpath, "os_desc/b_vendor_code"), "w") as wf:
-                wf.write("0xcd")
-            with open(os.path.join(self.fullpath, "os_desc/qw_sign"), "w") as wf:
-                wf.write("MSFT100")
-
-            usbpath = os.path.join(self.fullpath, "functions/rndis.usb0")
-
-            os.makedirs(usbpath)
-            HOST = "46:6f:73:74:50:00"  # "HostPC"
-            SELF = "44:61:64:55:53:00"  # "BadUSB"
-            with open(os.path.join(usbpath, "host_addr"), "w") as wf:
-                wf.write(HOST)
-            with open(os.path.join(usbpath, "dev_addr"), "w") as wf:
-                wf.write(SELF)
-            with open(
-                os.path.join(usbpath, "os_desc/interface.rndis/compatible_id"), "w"
-            ) as wf:
-                wf.write("RNDIS")
-            with open(
-                os.path.join(usbpath, "os_desc/interface.rndis/sub_compatible_id"), "w"
-            ) as wf:
-                wf.write("5162001")
-
-            os.symlink(
-                usbpath,
-                os.path.join(self.fullpath, "configs/c.1/rndis.usb0"),
-                target_is_directory=True,
+            self.configfs.write(
+                self.fullpath,
+                {
+                    "os_desc/use": "1",
+                    "os_desc/b_vendor_code": "0xcd",
+                    "os_desc/qw_sign": "MSFT100",
+                },
+            )
+            name = "rndis.usb0"
+            self._net_function(
+                name,
+                "c.1",
+                dict(
+                    attrs,
+                    **{
+                        "os_desc/interface.rndis/compatible_id": "RNDIS",
+                        "os_desc/interface.rndis/sub_compatible_id": "5162001",
+                    },
+                ),
             )
-
-        elif ntype == "ecm":
-            usbpath = os.path.join(self.fullpath, "functions/ecm.usb0")
-            os.makedirs(usbpath)
-
-            HOST = "46:6f:73:74:50:00"  # "HostPC"
-            SELF = "44:61:64:55:53:00"  # "BadUSB"
         else:
-            return
+            name = f"{ntype}.usb0"
+            self._net_function(name, "c.1", attrs)
+
+        if ntype == "dual":
+            config = os.path.join(self.fullpath, "configs/c.2")
+            self._mkdir(config)
+            self.configfs.write(config, {"MaxPower": "900"})
+            self._mkdir(os.path.join(config, "strings/0x409"))
+            self.configfs.write(
+                os.path.join(config, "strings/0x409"), {"configuration": "NCM"}
+            )
+            self._net_function("ncm.usb0", "c.2", attrs)
+            self.dual = True
+
+        if ntype in ("ncm", "dual"):
+            ncm = os.path.join(self.fullpath, "functions/ncm.usb0")
+            if max_segment_size is None and mtu is not None and mtu > 1500:
+                max_segment_size = mtu + 14
+            if max_segment_size is not None:
+                # kernel 6.8+, NTBs themselves are sized by the host
+                if os.path.exists(os.path.join(ncm, "max_segment_size")):
+                    self.configfs.write(
+                        ncm, {"max_segment_size": str(max_segment_size)}
+                    )
+                else:
+                    print("NCM max_segment_size not supported by this kernel")
 
+        self.functions[name] = ("add_net", key)
         print("Done")
 
+    def _net_function(self, name, config, attrs):
+        usbpath = os.path.join(self.fullpath, "functions", name)
+        self._mkdir(usbpath)
+        self.configfs.write(usbpath, attrs)
+        self._link(usbpath, os.path.join(self.fullpath, "configs", config, name))
+        # interfaces are named usbN in the order the functions are made
+        self.netifs.append((name, f"usb{len(self.netifs)}"))
+
+    def _ifname(self, name, guess):
+        try:
+            with open(os.path.join(self.fullpath, "functions", name, "ifname")) as f:
+                ifname = f.read().strip()
+        except OSError:
+            return guess
+        # "(unnamed net_device)" until the function is bound
+        return ifname if ifname and not ifname.startswith("(") else guess
+
+    def _link_second_config(self):
+        # serial and storage are in both configs like in g_multi; hid and
+        # uac are only in the first, their functions cannot be instanced twice
+        config = os.path.join(self.fullpath, "configs/c.2")
+        self._undo(
+            lambda p: p.startswith(config + "/")
+            and not p.endswith("/ncm.usb0")
+            and not p.startswith(config + "/strings")
+        )
+        functions = os.path.join(self.fullpath, "functions")
+        for name in sorted(os.listdir(functions)):
+            if name.startswith(("acm.", "mass_storage.")):
+                self._link(os.path.join(functions, name), os.path.join(config, name))
+
     def add_hid(self, htype="keyboard"):
         print(f"Add {htype} Device")
 
-        hidnum = len(self.hid)
-        if hidnum > 3:
-            print("Max Limit of HID reached")
+        names = HID_COMPOSITES.get(htype, htype.split("+"))
+        if any(n not in HID_SPECS for n in names):
+            print("Unknown HID Device", htype)
             return
+        hidnum = 0
+        while f"hid.usb{hidnum}" in self.functions:
+            hidnum += 1
 
         # fp = self.fullpath
 
         usbpath = os.path.join(self.fullpath, f"functions/hid.usb{hidnum}")
 
-        os.makedirs(usbpath)
+        self._mkdir(usbpath)
 
-        with open(os.path.join(usbpath, "protocol"), "w") as wf:
-            wf.write("1")
-        with open(os.path.join(usbpath, "subclass"), "w") as wf:
-            wf.write("1")
+        desc, length, reports = hid_descriptor([(n, HID_SPECS[n]) for n in names])
+        # boot protocol only without report ids
+        boot = {"keyboard": "1", "mouse": "2"}.get(htype, "0")
+        attrs = {
+            "protocol": boot,
+            "subclass": "0" if boot == "0" else "1",
+            "report_length": str(length),
+            "report_desc": desc,
+        }
+        self.configfs.write(usbpath, attrs)
 
-        descriptors = Descriptors()
-        if htype == "keyboard":
-
-            with open(os.path.join(usbpath, "report_length"), "w") as wf:
-                wf.write(descriptors.KeyboardLength())
-
-            with open(os.path.join(usbpath, "report_desc"), "wb") as wf:
-                wf.write(descriptors.Keyboard())
-
-        if htype == "mouse":
-            with open(os.path.join(usbpath, "report_length"), "w") as wf:
-                wf.write(descriptors.MouseLength())
-
-            with open(os.path.join(usbpath, "report_desc"), "wb") as wf:
-                wf.write(descriptors.Mouse())
-
-        if htype == "joystick":
-            with open(os.path.join(usbpath, "report_length"), "w") as wf:
-                wf.write(descriptors.JoystickLength())
-
-            with open(os.path.join(usbpath, "report_desc"), "wb") as wf:
-                wf.write(descriptors.Joystick())
-
-        os.symlink(
+        self._link(
             usbpath,
             os.path.join(self.fullpath, f"configs/c.1/hid.usb{hidnum}"),
-            target_is_directory=True,
         )
+        self.functions[f"hid.usb{hidnum}"] = ("add_hid", (("htype", htype),))
 
-        self.hid.append((htype, f"/dev/hidg{hidnum}"))
+        for name, (report_id, size) in reports.items():
+            self.hid.append((name, f"/dev/hidg{hidnum}", report_id, size))
         print("Done")
 
-    def add_storage(self, image, stype="flash", readonly=False):
+    def add_storage(
+        self, image, stype="flash", readonly=False, overlay=False, **options
+    ):
 
         print(f"Add Storage Device ({stype}) {image}")
 
+        options = dict(LUN_DEFAULTS, **options)
         stnum = len(self.storage)
-        # if stnum > 3:
-        #     print("Max Limit of HID reached")
-        #     return
-        counter = 0
-        while 1:
-            usbpath = os.path.join(
-                self.fullpath, f"functions/mass_storage.usb{counter}"
+        file, backing, cached = self._medium(
+            stnum, image, stype, readonly, overlay, options
+        )
+        lunnum = stnum % self.luns_per_function
+        usbpath = os.path.join(
+            self.fullpath,
+            f"functions/mass_storage.usb{stnum // self.luns_per_function}",
+        )
+        lunpath = os.path.join(usbpath, f"lun.{lunnum}")
+        # listed right away, so stop() lets go of the overlay and cache
+        # entry also if building the LUN fails
+        self.storage.append(
+            dict(
+                options,
+                path=lunpath,
+                image=image,
+                stype=stype,
+                readonly=readonly,
+                overlay=overlay,
+                backing=backing,
+                cached=cached,
             )
-            counter += 1
-            if os.path.isdir(usbpath):
-                continue
-            else:
-                break
+        )
 
-        os.makedirs(usbpath)
+        if lunnum == 0:
+            self._mkdir(usbpath)
+            self.configfs.write(usbpath, {"stall": "1" if self.storage_stall else "0"})
+            self._link(
+                usbpath,
+                os.path.join(self.fullpath, "configs/c.1", os.path.basename(usbpath)),
+            )
+        else:
+            self._mkdir(lunpath)
 
-        with open(os.path.join(usbpath, "stall"), "w") as wf:
-            wf.write("0")
+        attrs = self._lun_attrs(image, stype, readonly, options)
+        attrs["file"] = backing.path if backing is not None else file
+        self.configfs.write(lunpath, attrs)
+        print("Done")
 
-        with open(os.path.join(usbpath, "lun.0/cdrom"), "w") as wf:
-            if stype == "iso":
-                wf.write("1")
-            else:
-                wf.write("0")
+    def _lun_attrs(self, image, stype, readonly, options):
+        # cdrom, ro and removable can only be changed without a medium
+        cdrom = stype == "iso"
+        if cdrom and image and options["mode"] != "cdrom":
+            info = inspect_iso(image)
+            if options["mode"] == "disk" or info["hybrid"]:
+                # boots from a removable disk, at disk speed and without
+                # the size limits of the CD-ROM emulation
+                print("Hybrid ISO, exposed as disk:", image)
+                cdrom = False
+        if image and options["read_ahead_kb"]:
+            try:
+                old = self.host.set_read_ahead(image, options["read_ahead_kb"])
+                self.read_ahead.setdefault(image, old)
+            except OSError as e:
+                print("read_ahead_kb not set:", e)
+        return {
+            "cdrom": "1" if cdrom else "0",
+            # an ISO is never written, also not in disk mode
+            "ro": "1" if readonly or stype == "iso" else "0",
+            "nofua": "1" if options["nofua"] else "0",
+            "removable": "1" if options["removable"] else "0",
+            "inquiry_string": options["inquiry"],
+        }
+
+    def _restore_read_ahead(self):
+        # newest first, two images may live on the same disk
+        for image, kb in reversed(list(self.read_ahead.items())):
+            try:
+                self.host.set_read_ahead(image, kb)
+            except OSError as e:
+                print("read_ahead_kb not restored:", e)
+        self.read_ahead = {}
+
+    def _cache(self, image, stype, readonly, overlay, options):
+        """The file to back a LUN with and its cache entry"""
+        mode = options["cache"]
+        if not mode or not image:
+            return image, None
+        if mode == "ram" and stype != "iso" and not readonly and not overlay:
+            # the host's writes would end up in the copy
+            print("Writable image, pinning instead of a RAM copy:", image)
+            mode = "pin"
+        try:
+            cached = self.cache.acquire(image, mode, stype)
+        except OSError as e:
+            print("Image not cached:", e)
+            return image, None
+        return cached["path"], cached
+
+    def _medium(self, lun, image, stype, readonly, overlay, options):
+        """(file, overlay, cache entry) backing a LUN, nothing stays
+        acquired if one of them fails"""
+        file, cached = self._cache(image, stype, readonly, overlay, options)
+        try:
+            backing = self._overlay(lun, file, stype, overlay)
+        except Exception:
+            self._release_cache([{"cached": cached}])
+            raise
+        return file, backing, cached
+
+    def _release_cache(self, entries):
+        for entry in entries:
+            if entry.get("cached") is not None:
+                self.cache.release(entry["cached"])
+                entry["cached"] = None
+
+    def _overlay(self, lun, image, stype, overlay):
+        # ISOs are read-only anyway
+        if not overlay or not image or stype == "iso":
+            return None
+        backing = Overlay(image, "%s-overlay%d" % (self.name, lun), self.host)
+        backing.create()
+        return backing
+
+    def _discard_overlays(self, entries):
+        for entry in entries:
+            if entry.get("backing") is not None:
+                entry["backing"].discard()
+                entry["backing"] = None
+
+    def set_media(self, lun, image, stype=None, readonly=None, overlay=None, **options):
+        """Swap (or with an empty image eject) the medium of a LUN in place.
+
+        Works while the gadget is bound, the host only sees a media change
+        instead of re-enumerating every function. An overlay LUN gets a
+        fresh overlay, so setting the same image again resets it. Options
+        not given keep their current value.
+        """
+        entry = self.storage[lun]
+        stype = entry["stype"] if stype is None else stype
+        readonly = entry["readonly"] if readonly is None else readonly
+        overlay = entry["overlay"] if overlay is None else overlay
+        options = {key: options.get(key, entry[key]) for key in LUN_DEFAULTS}
+        print(f"Set Media lun {lun} ({stype}) {image}")
 
-        with open(os.path.join(usbpath, "lun.0/ro"), "w") as wf:
-            if readonly:
-                wf.write("1")
-            else:
-                wf.write("0")
+        try:
+            # ejects even if the host has locked the medium
+            self.configfs.write(entry["path"], {"forced_eject": "1"})
+        except OSError as e:
+            print("forced_eject failed, ejecting:", e)
+            self.configfs.write(entry["path"], {"file": "\n"})
+
+        self._discard_overlays([entry])
+        self._release_cache([entry])
+        # ejected until the new medium is in
+        entry["image"] = ""
+        file, backing, cached = self._medium(
+            lun, image, stype, readonly, overlay, options
+        )
+        try:
+            attrs = self._lun_attrs(image, stype, readonly, options)
+            if image:
+                attrs["file"] = backing.path if backing is not None else file
+            self.configfs.write(entry["path"], attrs)
+        except Exception:
+            self._discard_overlays([{"backing": backing}])
+            self._release_cache([{"cached": cached}])
+            raise
+        entry.update(
+            options,
+            image=image,
+            stype=stype,
+            readonly=readonly,
+            overlay=overlay,
+            backing=backing,
+            cached=cached,
+        )
+        print("Done")
+
+    def _nodes(self):
+        nodes = list(dict.fromkeys(h[1] for h in self.hid))
+        if self.serial:
+            nodes.append("/dev/ttyGS0")
+        nodes += [os.path.join(NETDIR, ifname) for _, ifname in self.netifs]
+        return nodes
+
+    def _bind(self, monitor):
+        fp = self.fullpath
+        udcs = sorted(os.listdir(self.udcdir)) if os.path.isdir(self.udcdir) else []
+        if not udcs:
+            print("########## UDC Error, no UDC in", self.udcdir)
+            self.stop()
+            return "Error: UDC Error no UDC found"
+        self.udc = udcs[0]
 
-        with open(os.path.join(usbpath, "lun.0/nofua"), "w") as wf:
-            wf.write("0")
-        with open(os.path.join(usbpath, "lun.0/file"), "w") as wf:
-            wf.write(image)
+        if self.dual:
+            self._link_second_config()
+
+        self.progress("bind")
+        try:
+            self.configfs.write(fp, {"UDC": self.udc})
+        except OSError as e:
+            print("########## UDC Error", e)
+            self.stop()
+            return f"Error: UDC Error {e.strerror}"
+
+        self.progress("wait devices")
+        t = time.monotonic()
+        pending = monitor.wait(self._nodes())
+        if pending:
+            print("Timeout waiting for", ", ".join(pending))
+        print("Devices ready after %.3fs" % (time.monotonic() - t))
+
+        if len(self.hid) > 0:
+            for dev in glob.glob("/dev/hidg*"):
+                os.chmod(dev, 0o777)
+        return "OK"
 
+    def _start_serial(self):
+        print("Add Serial TTY")
+        self.progress("serial")
         os.symlink(
-            usbpath,
-            os.path.join(self.fullpath, f"configs/c.1/mass_storage.usb{counter}"),
-            target_is_directory=True,
+            "/lib/systemd/system/getty@.service",
+            os.path.join(self.systemddir, "getty.target.wants/getty@ttyGS0.service"),
+        )
+        self.host.start_unit("getty@ttyGS0.service")
+        print("Done")
+
+    def _stop_serial(self):
+        servicefile = os.path.join(
+            self.systemddir, "getty.target.wants/getty@ttyGS0.service"
+        )
+        if os.path.exists(servicefile):
+            self.host.stop_unit("getty@ttyGS0.service")
+            os.remove(servicefile)
+
+    def _start_net(self):
+        print("Startup DHCP Server")
+        self.progress("network")
+        dhcppath = os.path.join(TEMPDIR, "dhcpd.conf")
+        if not os.path.isfile(dhcppath):
+            with open(dhcppath, "w") as dhcpfile:
+                dhcpfile.write(
+                    """
+                # dhcpd.conf
+                default-lease-time 600;
+                max-lease-time 7200;
+
+                log-facility local7;
+
+                subnet 10.0.0.0 netmask 255.255.255.0 {
+                  range 10.0.0.10 10.0.0.100;
+                }
+                """
+                )
+            os.chmod(dhcppath, 0o777)
+
+        ifnames = [self._ifname(name, guess) for name, guess in self.netifs]
+        self.netif = ifnames[0]
+        try:
+            for ifname in ifnames:
+                if self.mtu is not None:
+                    self.host.set_mtu(ifname, self.mtu)
+                self.host.link_up(ifname)
+            if len(ifnames) > 1:
+                # only the interface of the config the host chose gets a
+                # carrier, a bridge keeps 10.0.0.1 on whichever it is
+                try:
+                    self.host.add_bridge(NETBRIDGE)
+                    for ifname in ifnames:
+                        self.host.set_master(ifname, NETBRIDGE)
+                    self.netif = NETBRIDGE
+                except OSError as e:
+                    print("Bridge failed, RNDIS gets no address:", e)
+                    self.netif = ifnames[-1]
+            self.host.add_address(self.netif, "10.0.0.1", 24)
+            self.host.link_up(self.netif)
+        except OSError as e:
+            print("%s setup failed: %s" % (self.netif, e))
+        if self.dhcp == "builtin":
+            try:
+                self.dhcp_server = DhcpServer(self.netif)
+                self.dhcp_server.start()
+                print("Done")
+                return
+            except OSError as e:
+                print("DHCP server failed, falling back to dhcpd:", e)
+                self.dhcp_server = None
+        self.host.run(
+            ["/usr/bin/dhcpd", "-4", "-q", "-cf", dhcppath, "-pf", self.dhcppidpath]
         )
-        # self.devices += 1
         print("Done")
 
+    def _stop_net(self):
+        if self.dhcp_server is not None:
+            print("stop DHCP server")
+            self.dhcp_server.close()
+            self.dhcp_server = None
+        if os.path.isfile(self.dhcppidpath):
+            print("stop dhcpd")
+            with open(self.dhcppidpath, "r") as pidfile:
+                pid = pidfile.read().strip()
+
+            self.host.kill(int(pid))
+            os.remove(self.dhcppidpath)
+        if self.netif == NETBRIDGE:
+            self.host.del_link(NETBRIDGE)
+        self.netif = None
+
     def start(self):
 
         fp = self.fullpath
-        os.chdir(fp)
+        spawned = self.host.spawned
         print("Startup Gadget")
-        os.system("ln -s configs/c.1 os_desc")
-        os.system("udevadm settle -t 5 || :")
+        self._link(os.path.join(fp, "configs/c.1"), os.path.join(fp, "os_desc/c.1"))
 
-        retval = os.system("ls /sys/class/udc > UDC")
-        if retval != 0:
-            print("########## UDC Error", retval)
-            self.stop()
-            return f"Error: UDC Error {retval}"
+        monitor = self.monitor()
+        try:
+            retval = self._bind(monitor)
+        finally:
+            monitor.close()
+        if retval != "OK":
+            return retval
 
         print("Done")
-        if len(self.hid) > 0:
-            os.system("chmod 777 /dev/hidg*")
-            for dev in self.hid:
-                print(dev)
+        for name, dev, report_id, _ in self.hid:
+            print(name, dev, report_id)
 
         if self.serial:
-            print("Add Serial TTY")
-            os.symlink(
-                "/lib/systemd/system/getty@.service",
-                "/etc/systemd/system/getty.target.wants/getty@ttyGS0.service",
-            )
-            os.system("systemctl start getty@ttyGS0")
-            print("Done")
+            self._start_serial()
 
         if self.net:
-            time.sleep(2)
-            print("Startup DHCP Server")
-            dhcppath = os.path.join(TEMPDIR, "dhcpd.conf")
-            dhcppidpath = os.path.join(TEMPDIR, "dhcpd.pid")
-            if not os.path.isfile(dhcppath):
-                with open(dhcppath, "w") as dhcpfile:
-                    dhcpfile.write(
-                        """
-                    # dhcpd.conf
-                    default-lease-time 600;
-                    max-lease-time 7200;
-
-                    log-facility local7;
-
-                    subnet 10.0.0.0 netmask 255.255.255.0 {
-                      range 10.0.0.10 10.0.0.100;
-                    }
-                    """
-                    )
-                os.system("chmod 777 %s" % dhcppath)
+            self._start_net()
+
+        self.progress("wait host")
+        state = monitor.wait_udc(os.path.join(self.udcdir, self.udc, "state"))
+        print("UDC state:", state)
+        print("Spawned %d processes" % (self.host.spawned - spawned))
+        return "OK"
+
+    def _remove_function(self, name):
+        method, _ = self.functions.pop(name)
+        print("Remove Function", name)
+        names = [name]
+        configs = os.path.join(self.fullpath, "configs")
+        second = os.path.join(configs, "c.2")
+        dual = method == "add_net" and self.dual
+        if dual:
+            # NCM and its config go with the RNDIS function
+            names.append("ncm.usb0")
+        usbpaths = [os.path.join(self.fullpath, "functions", n) for n in names]
+        self._undo(
+            lambda p: p in usbpaths
+            or (p.startswith(configs) and os.path.basename(p) in names)
+            or (dual and (p == second or p.startswith(second + "/")))
+        )
+        if method == "add_hid":
+            num = name[len("hid.usb") :]
+            self.hid = [h for h in self.hid if h[1] != f"/dev/hidg{num}"]
+        elif method == "add_serial":
+            self.serial = False
+            self._stop_serial()
+        elif method == "add_net":
+            self.net = False
+            self._stop_net()
+            self.netifs = [n for n in self.netifs if n[0] not in names]
+            self.dual = False
+            self.mtu = None
+
+    def _remove_storage(self):
+        # function links, lun.N and function dirs
+        self._undo(lambda p: "/mass_storage." in p)
+        self._discard_overlays(self.storage)
+        self._release_cache(self.storage)
+        self.storage = []
 
-            os.system("ip address add 10.0.0.1/24 dev usb0")
-            os.system("ip link set usb0 up")
-            os.system("/usr/bin/dhcpd -4 -q -cf %s -pf %s" % (dhcppath, dhcppidpath))
-            print("Done")
-        os.system("udevadm settle -t 5 || :")
+    def _clear_luns(self, usbpath):
+        # lun.0 is a default group, the others were created by us
+        for lun in glob.glob(os.path.join(usbpath, "lun.*")):
+            if not lun.endswith("lun.0"):
+                self.ddel(lun)
+
+    def reconfigure(self, layout, luns_per_function=None):
+        """Apply a new layout to the running gadget.
+
+        Only the functions that differ are removed or added while the UDC
+        is unbound, dhcpd, the serial getty and unchanged functions are
+        left running. If only the images of the storage LUNs changed they
+        are swapped in place without unbinding at all. If applying fails
+        what was changed is put back and the gadget is bound again with
+        the previous layout before the error is raised.
+        """
+        storage = [kwargs for method, kwargs in layout if method == "add_storage"]
+        layout = [(m, kwargs) for m, kwargs in layout if m != "add_storage"]
+
+        wanted = [(method, tuple(sorted(kwargs.items()))) for method, kwargs in layout]
+        remove = []
+        for name, key in self.functions.items():
+            if key in wanted:
+                wanted.remove(key)
+            else:
+                remove.append(name)
+
+        media = None
+        old_luns = self.luns_per_function
+        if luns_per_function is None:
+            luns_per_function = self.luns_per_function
+        if luns_per_function != self.luns_per_function:
+            # LUNs are packed differently, rebuild the storage functions
+            self.luns_per_function = luns_per_function
+        elif len(storage) == len(self.storage):
+            media = [
+                (lun, kwargs)
+                for lun, kwargs in enumerate(storage)
+                if any(kwargs[k] != self.storage[lun][k] for k in kwargs)
+            ]
+
+        if media is not None and not remove and not wanted:
+            if not media:
+                print("Gadget unchanged")
+            self._set_media_all(media)
+            return "OK"
+
+        print("Reconfigure Gadget: -%d +%d functions" % (len(remove), len(wanted)))
+        self.progress("reconfigure")
+        functions = dict(self.functions)
+        luns = [self._lun_kwargs(entry) for entry in self.storage]
+        self.configfs.write(self.fullpath, {"UDC": "\n"})
+        removed = []
+        # the journal only grows from here on, what a failure leaves of a
+        # half built function is undone from mark
+        mark = len(self.journal)
+        try:
+            for name in remove:
+                removed.append(functions[name][0])
+                self._remove_function(name)
+            if media is None:
+                # LUN count changed, rebuild the storage functions
+                self._remove_storage()
+            mark = len(self.journal)
+            # what is still running after removing, a replaced network or
+            # serial function is started again below
+            serial = self.serial
+            net = self.net
+            for method, kwargs in wanted:
+                getattr(self, method)(**dict(kwargs))
+            if media is None:
+                for kwargs in storage:
+                    self.add_storage(**kwargs)
+            else:
+                self._set_media_all(media)
+        except Exception as e:
+            print("Reconfigure failed, restoring the previous layout:", e)
+            try:
+                self._undo_since(mark)
+                self._restore(functions, luns, old_luns, removed, media is None)
+            except Exception as error:
+                print("Restoring failed:", error)
+                self.stop()
+            raise
+
+        monitor = self.monitor()
+        try:
+            retval = self._bind(monitor)
+        finally:
+            monitor.close()
+        if retval != "OK":
+            return retval
+
+        if self.serial and not serial:
+            self._start_serial()
+        if self.net and not net:
+            self._start_net()
+
+        state = monitor.wait_udc(os.path.join(self.udcdir, self.udc, "state"))
+        print("UDC state:", state)
         return "OK"
 
+    def _lun_kwargs(self, entry):
+        """add_storage/set_media kwargs that give a LUN its current medium"""
+        kwargs = {key: entry[key] for key in LUN_DEFAULTS}
+        for key in ("image", "stype", "readonly", "overlay"):
+            kwargs[key] = entry[key]
+        return kwargs
+
+    def _set_media_all(self, media):
+        """set_media() for every (lun, kwargs), if one fails the LUNs
+        changed so far get their previous medium back"""
+        previous = []
+        try:
+            for lun, kwargs in media:
+                previous.append((lun, self._lun_kwargs(self.storage[lun])))
+                self.set_media(lun, **kwargs)
+        except Exception:
+            for lun, kwargs in reversed(previous):
+                try:
+                    self.set_media(lun, **kwargs)
+                except Exception as e:
+                    print("Medium of LUN %d not restored: %s" % (lun, e))
+            raise
+
+    def _restore(self, functions, luns, luns_per_function, removed, storage):
+        """Back to functions and LUNs as recorded before a reconfigure
+        (storage if the LUNs were rebuilt) and bound again"""
+        for name in list(self.functions):
+            if functions.get(name) != self.functions[name]:
+                self._remove_function(name)
+        for name, (method, kwargs) in functions.items():
+            if name not in self.functions:
+                getattr(self, method)(**dict(kwargs))
+        if storage:
+            self._remove_storage()
+            self.luns_per_function = luns_per_function
+            for kwargs in luns:
+                self.add_storage(**kwargs)
+        monitor = self.monitor()
+        try:
+            retval = self._bind(monitor)
+        finally:
+            monitor.close()
+        if retval != "OK":
+            raise OSError(retval)
+        # the getty and dhcpd went with their functions
+        if self.serial and "add_serial" in removed:
+            self._start_serial()
+        if self.net and "add_net" in removed:
+            self._start_net()
+
     def ddel(self, fpath):
         print("Del Dir", fpath)
         if os.path.exists(fpath):
-            os.rmdir(fpath)
+            self.configfs.rmdir(fpath)
             print("deleted dir: %s" % fpath)
         else:
             print("dir not found: %s" % fpath)
@@ -571,55 +3119,89 @@ class Gadget:
         self.ddel(os.path.join(self.fullpath, "configs/%s/strings/0x409" % num))
         self.ddel(os.path.join(self.fullpath, "configs/%s" % num))
 
-    # def stop(self):
-    #     self.stopped = False
-    #     clearthread = threading.Thread(target=self.clearall)
-    #     clearthread.start()
-    #     counter = 0
-    #     while not self.stopped:
-    #         time.sleep(1)
-    #         counter += 1
-    #         if counter > 60:
-    #             print("Force reboot")
-    #             os.system("reboot -f")
-
-    def stop(self):
-
+    def stop(self, deadline=STOP_DEADLINE):
+        """Tear down, the getty and dhcpd are stopped while configfs is cleared"""
         self.stopped = False
 
         print("Cleanup USB gadget")
 
-        os.system("udevadm settle -t 5 || :")
-
-        servicefile = "/etc/systemd/system/getty.target.wants/getty@ttyGS0.service"
-        if os.path.exists(servicefile):
-            os.system("systemctl stop getty@ttyGS0")
-            os.remove(servicefile)
-
-        # time.sleep(2)
+        nodes = self._nodes()
+        built = os.path.isdir(self.fullpath)
+        storage = self.storage
 
         self.net = False
         self.serial = False
+        self.netifs = []
+        self.dual = False
+        self.mtu = None
         self.hid = []
         self.storage = []
+        self.functions = {}
 
-        if not os.path.isdir(self.fullpath):
-            self.stopped = True
-            return
+        monitor = self.monitor()
+
+        def unbind():
+            print("Clear UDC")
+            self.progress("unbind")
+            self.configfs.write(self.fullpath, {"UDC": "\n"})
 
-        # kill the UDC
-        print("Clear UDC")
-        udcfile = os.path.join(self.fullpath, "UDC")
-        with open(udcfile, "w") as uf:
-            uf.write("")
+        def functions():
+            self.progress("remove functions")
+            if self.journal:
+                # built by us, remove exactly that
+                print("Undo Journal (%d entries)" % len(self.journal))
+                self._undo()
+            else:
+                self._clear_all()
+
+        def devices():
+            self.progress("wait devices")
+            pending = monitor.wait(nodes, exist=False)
+            if pending:
+                print("Timeout waiting for removal of", ", ".join(pending))
+
+        def overlays():
+            # the LUNs hold the overlays open until their function is gone
+            self._discard_overlays(storage)
+            # cached images stay in RAM for the next start, but may go
+            self._release_cache(storage)
+
+        steps = {"serial": (self._stop_serial, ()), "network": (self._stop_net, ())}
+        if built:
+            steps["unbind"] = (unbind, ())
+            steps["functions"] = (functions, ("unbind",))
+            steps["devices"] = (devices, ("functions",))
+            steps["overlays"] = (overlays, ("functions",))
+            steps["read_ahead"] = (self._restore_read_ahead, ("functions",))
+        else:
+            self.journal = []
+
+        try:
+            errors, pending = run_steps(steps, deadline)
+        finally:
+            monitor.close()
+        if pending:
+            print("Stop deadline passed, unfinished:", ", ".join(pending))
+            return "ERROR (Timeout) %s" % ", ".join(pending)
+        if errors:
+            name, error = next(iter(errors.items()))
+            return "ERROR (%s) %s" % (name, error)
+        self.stopped = True
+        print("Cleanup Complete")
+        return "OK"
 
+    def _clear_all(self):
+        # a gadget left from an earlier run, walk configfs
         print("Clear Configs")
+        self.progress("remove functions")
         for conf in os.listdir(os.path.join(self.fullpath, "configs")):
             self._clear_config(conf)
         print("Done")
 
         print("Clear Functions")
         for f in os.listdir(os.path.join(self.fullpath, "functions")):
+            if f.startswith("mass_storage."):
+                self._clear_luns(os.path.join(self.fullpath, "functions/%s" % f))
             self.ddel(os.path.join(self.fullpath, "functions/%s" % f))
         print("Done")
 
@@ -632,19 +3214,149 @@ class Gadget:
         self.ddel(self.fullpath)
         print("Done")
 
-        dhcppidpath = os.path.join(TEMPDIR, "dhcpd.pid")
-        if os.path.isfile(dhcppidpath):
-            print("stop dhcpd")
-            with open(dhcppidpath, "r") as pidfile:
-                pid = pidfile.read().strip()
 
-            os.system("kill %s" % pid)
-            os.remove(dhcppidpath)
+class HidWriter:
+    """Sends reports to a /dev/hidgN node from a queue on its own thread.
 
-        print("stop tty")
-        self.stopped = True
-        os.system("udevadm settle -t 5 || :")
-        print("Cleanup Complete")
+    The node is opened once non-blocking, every report waits for POLLOUT
+    which f_hid only signals after the host fetched the previous one, so
+    writes are paced by the host's polling interval.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.poller = None
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+            target=self._run, name=f"hid-{os.path.basename(path)}", daemon=True
+        )
+        self.thread.start()
+
+    def send(self, data, size, report_id=0):
+        """Queue size byte reports, prefixed with report_id on composite functions"""
+        if len(data) % size:
+            raise ValueError("reports are %d bytes, got %d" % (size, len(data)))
+        count = len(data) // size
+        if report_id:
+            framed = bytearray(count * (size + 1))
+            framed[:: size + 1] = bytes([report_id]) * count
+            for i in range(size):
+                framed[i + 1 :: size + 1] = data[i::size]
+            data, size = framed, size + 1
+        with self.lock:
+            self.pending += count
+        self.queue.put((data, size))
+        return count
+
+    def close(self):
+        self.queue.put(None)
+
+    def _open(self):
+        self._close_fd()
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLOUT)
+
+    def _close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _write(self, report):
+        while True:
+            try:
+                os.write(self.fd, report)
+                return
+            except BlockingIOError:
+                if not self.poller.poll(HID_TIMEOUT * 1000):
+                    raise TimeoutError("host is not polling %s" % self.path)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            data, size = item
+            view = memoryview(data)
+            try:
+                if self.fd is None:
+                    self._open()
+                for offset in range(0, len(data), size):
+                    report = view[offset : offset + size]
+                    try:
+                        self._write(report)
+                    except TimeoutError:
+                        raise
+                    except OSError:
+                        # node was recreated by a rebind, retry once
+                        self._open()
+                        self._write(report)
+            except OSError as e:
+                print("HID write to %s failed: %s" % (self.path, e))
+            finally:
+                with self.lock:
+                    self.pending -= len(data) // size
+        self._close_fd()
+
+
+class HidSocket:
+    """Unix stream socket to stream HID input without D-Bus round trips.
+
+    A client sends one header line naming the device (keyboard, mouse,
+    joystick, media, or text to type UTF-8 text on the keyboard) followed
+    by raw reports or text until it closes the connection.
+    """
+
+    def __init__(self, controller, path=HIDSOCKET):
+        self.controller = controller
+        self.path = path
+        self.sock = None
+
+    def start(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o666)
+        self.sock.listen()
+        threading.Thread(target=self._accept, name="hid-socket", daemon=True).start()
+        print("HID socket listening on", self.path)
+
+    def _accept(self):
+        while True:
+            conn, _ = self.sock.accept()
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn, conn.makefile("rb") as stream:
+            device = stream.readline().decode(errors="replace").strip()
+            if device == "text":
+                decoder = codecs.getincrementaldecoder("utf-8")("replace")
+            elif self.controller.hid_report_size(device):
+                size = self.controller.hid_report_size(device)
+            else:
+                conn.sendall(b"ERROR (Unknown Device)\n")
+                return
+            pending = b""
+            while True:
+                data = stream.read1(65536)
+                if not data:
+                    break
+                if device == "text":
+                    response = self.controller.hid_type(decoder.decode(data))
+                else:
+                    # only whole reports, keep the rest for the next read
+                    data = pending + data
+                    whole = len(data) - len(data) % size
+                    pending = data[whole:]
+                    response = self.controller.hid_send(device, data[:whole])
+                if not response.startswith("OK"):
+                    conn.sendall(response.encode() + b"\n")
+                    return
 
 
 class GadgetController:
@@ -670,20 +3382,309 @@ class GadgetController:
                 <method name='stop'>
                     <arg type='s' name='response' direction='out'/>
                 </method>
+                <method name='start_async'>
+                    <arg type='u' name='job' direction='out'/>
+                </method>
+                <method name='stop_async'>
+                    <arg type='u' name='job' direction='out'/>
+                </method>
+                <method name='swap_media'>
+                    <arg type='u' name='lun' direction='in'/>
+                    <arg type='s' name='path' direction='in'/>
+                    <arg type='u' name='job' direction='out'/>
+                </method>
+                <method name='eject_media'>
+                    <arg type='u' name='lun' direction='in'/>
+                    <arg type='u' name='job' direction='out'/>
+                </method>
+                <method name='import_image'>
+                    <arg type='s' name='source' direction='in'/>
+                    <arg type='s' name='directory' direction='in'/>
+                    <arg type='s' name='checksum' direction='in'/>
+                    <arg type='u' name='job' direction='out'/>
+                </method>
+                <method name='verify_image'>
+                    <arg type='s' name='path' direction='in'/>
+                    <arg type='s' name='response' direction='out'/>
+                </method>
+                <method name='reset_media'>
+                    <arg type='u' name='lun' direction='in'/>
+                    <arg type='u' name='job' direction='out'/>
+                </method>
+                <method name='hid_send'>
+                    <arg type='s' name='device' direction='in'/>
+                    <arg type='ay' name='reports' direction='in'/>
+                    <arg type='s' name='response' direction='out'/>
+                </method>
+                <method name='hid_type'>
+                    <arg type='s' name='text' direction='in'/>
+                    <arg type='s' name='response' direction='out'/>
+                </method>
+                <method name='plan'>
+                    <arg type='s' name='response' direction='out'/>
+                </method>
+                <method name='net_bench'>
+                    <arg type='s' name='peer' direction='in'/>
+                    <arg type='u' name='seconds' direction='in'/>
+                    <arg type='u' name='job' direction='out'/>
+                </method>
+                <method name='create_image'>
+                    <arg type='s' name='path' direction='in'/>
+                    <arg type='t' name='size' direction='in'/>
+                    <arg type='s' name='alloc' direction='in'/>
+                    <arg type='s' name='fs' direction='in'/>
+                    <arg type='u' name='job' direction='out'/>
+                </method>
+                <method name='hid_pending'>
+                    <arg type='s' name='device' direction='in'/>
+                    <arg type='u' name='reports' direction='out'/>
+                </method>
+                <property name='State' type='s' access='read'>
+                    <annotation name='org.freedesktop.DBus.Property.EmitsChangedSignal' value='true'/>
+                </property>
+                <property name='UdcState' type='s' access='read'>
+                    <annotation name='org.freedesktop.DBus.Property.EmitsChangedSignal' value='true'/>
+                </property>
+                <signal name='StateChanged'>
+                    <arg type='s' name='state'/>
+                </signal>
+                <signal name='Verified'>
+                    <arg type='s' name='path'/>
+                    <arg type='s' name='status'/>
+                    <arg type='s' name='digest'/>
+                </signal>
+                <signal name='Progress'>
+                    <arg type='u' name='job'/>
+                    <arg type='s' name='phase'/>
+                    <arg type='s' name='message'/>
+                </signal>
             </interface>
         </node>
     """
 
-    def __init__(self):
+    StateChanged = dbus_signal()
+    Verified = dbus_signal()
+    Progress = dbus_signal()
+    PropertiesChanged = dbus_signal()
+
+    def __init__(
+        self,
+        configfs=None,
+        udcdir=UDCDIR,
+        systemddir=SYSTEMDDIR,
+        host=None,
+        monitor=UeventMonitor,
+    ):
         self.config = None
         self.gadget = None
         self.running = False
 
+        self.configfs = configfs if configfs is not None else ConfigFS()
+        self.udcdir = udcdir
+        self.systemddir = systemddir
+        self.host = host if host is not None else Host()
+        self.monitor = monitor
+
+        # start/stop jobs run one at a time on a worker thread
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.job = None
+
+        # STOPPED/STARTING/RUNNING/STOPPING/BLOCKED (or NOGADGETFS), kept up
+        # to date by our own transitions and the inotify watch
+        self.state = self._scan()
+        self.udc_state = ""
+        self.inotify = None
+
+        self.verifier = ImageVerifier(
+            done=lambda *result: self._emit(self.Verified, *result),
+            in_use=self._images_in_use,
+        )
+        # verify_image requests, the caller checks (polkit, a helper
+        # process per image) stay off the main loop
+        self.verify_requests = concurrent.futures.ThreadPoolExecutor(
+            1, thread_name_prefix="verify-request"
+        )
+        # RAM copies and pinned images of <cache> LUNs, across starts
+        self.cache = ImageCache()
+        self.cache.sweep()
+
+        # /dev/hidgN path -> HidWriter, used from D-Bus and the HID socket
+        self.hid_lock = threading.Lock()
+        self.hid_writers = {}
+
+    @property
+    def State(self):
+        return self.status()
+
+    @property
+    def UdcState(self):
+        return self.udc_state
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        print("State %s -> %s" % (self.state, state))
+        self.state = state
+        self._emit(self.StateChanged, self.status())
+        self._emit(self.PropertiesChanged, BUS_NAME, {"State": self.status()}, [])
+
+    def _set_udc_state(self, udc_state):
+        if udc_state == self.udc_state:
+            return
+        print("UDC state %s" % udc_state)
+        self.udc_state = udc_state
+        self._emit(self.PropertiesChanged, BUS_NAME, {"UdcState": udc_state}, [])
+
+    def watch(self):
+        """Follow changes made behind our back via inotify in the GLib loop"""
+        try:
+            self.inotify = Inotify()
+            self.inotify.add_watch(self.configfs.root, IN_CREATE | IN_DELETE)
+            if os.path.isdir(self.udcdir):
+                for udc in os.listdir(self.udcdir):
+                    statefile = os.path.join(self.udcdir, udc, "state")
+                    self.inotify.add_watch(statefile, IN_MODIFY)
+                    self._read_udc_state(statefile)
+        except OSError as e:
+            print("inotify watch not available:", e)
+            return
+        GLib.io_add_watch(self.inotify.fd, GLib.IO_IN, self._on_inotify)
+
+    def _read_udc_state(self, statefile):
+        try:
+            with open(statefile, "r") as sf:
+                self._set_udc_state(sf.read().strip())
+        except OSError:
+            pass
+
+    def _on_inotify(self, fd, condition):
+        for path, mask, name in self.inotify.read():
+            if mask & IN_MODIFY:
+                self._read_udc_state(path)
+        if self.job is None:
+            self._set_state(self._scan())
+        return True
+
+    def _new_gadget(self, xml):
+        return Gadget(
+            xml,
+            configfs=self.configfs,
+            udcdir=self.udcdir,
+            systemddir=self.systemddir,
+            host=self.host,
+            monitor=self.monitor,
+            progress=self._phase,
+            cache=self.cache,
+        )
+
+    def _emit(self, sig, *args):
+        # signals are sent from the main loop, jobs run on other threads
+        def emit():
+            sig(*args)
+            return False
+
+        GLib.idle_add(emit)
+
+    def _phase(self, phase):
+        job = self.job
+        if job is not None:
+            self._emit(self.Progress, job[0], phase, "")
+
+    def _run_job(self, name, func):
+        with self.lock:
+            if self.job is not None:
+                return 0
+            self.jobs += 1
+            self.job = (self.jobs, name)
+            job = self.jobs
+        if name in ("start", "stop"):
+            self._set_state("STARTING" if name == "start" else "STOPPING")
+
+        def worker():
+            try:
+                result = func()
+            except Exception as e:
+                print("Job %s %s failed: %s" % (job, name, e))
+                result = f"Error: {e}"
+            with self.lock:
+                self.job = None
+            self._emit(self.Progress, job, "finished", result)
+            self._set_state(self._scan())
+
+        threading.Thread(target=worker, name=f"{name}-{job}", daemon=True).start()
+        return job
+
+    def start_async(self):
+        """Start (or reconfigure) on a worker thread, returns the job id or 0 if busy"""
+        return self._run_job("start", self._start)
+
+    def stop_async(self):
+        """Stop on a worker thread, returns the job id or 0 if busy"""
+        return self._run_job("stop", self._stop)
+
+    def _run_task(self, name, func):
+        """Run func(progress) on a worker thread, returns the job id.
+
+        Image and benchmark jobs report through Progress like start/stop
+        but do not block them. What func returns (or "OK") is the message
+        of the finished phase.
+        """
+        with self.lock:
+            self.jobs += 1
+            job = self.jobs
+
+        def progress(phase, message=""):
+            self._emit(self.Progress, job, phase, message)
+
+        def worker():
+            try:
+                result = func(progress) or "OK"
+            except Exception as e:
+                print("Job %s %s failed: %s" % (job, name, e))
+                result = f"Error: {e}"
+            progress("finished", result)
+
+        threading.Thread(target=worker, name=f"{name}-{job}", daemon=True).start()
+        return job
+
+    def create_image(self, path, size, alloc, fs, dbus_context=None):
+        """Create a flash image on a worker thread, returns the job id.
+        D-Bus callers create images in their own image directories only.
+        """
+
+        def run(progress):
+            authorize(dbus_context)
+            user = dbus_caller(dbus_context)
+            directory, name = os.path.split(os.path.abspath(path))
+            with user_image_dir(user, directory) as target:
+                factory = ImageFactory(self.host, progress)
+                factory.create(os.path.join(target, name), size, alloc, fs)
+
+        return self._run_task("image", run)
+
+    def import_image(self, source, directory, checksum, dbus_context=None):
+        """Import a path or URL into directory on a worker thread, returns
+        the job id. Importing the same source again resumes an interrupted
+        import. D-Bus callers import into their own image directories only.
+        """
+
+        def run(progress):
+            authorize(dbus_context)
+            user = dbus_caller(dbus_context)
+            with user_image_dir(user, directory) as target:
+                importer = ImageImporter(progress, user)
+                importer.run(source, importer.target(source, target), checksum)
+
+        return self._run_task("import", run)
+
     def get_config(self, xml):
         name = self.config.find("name")
         return name.text
 
     def set_config(self, xml):
+        if self.job is not None:
+            return "BUSY"
         try:
             self.config = ET.fromstring(xml)
         except:
@@ -700,18 +3701,32 @@ class GadgetController:
             self.config = None
             return "NODEVS"
 
+        error = self._check_config()
+        if error:
+            self.config = None
+            return "FORMATERROR %s" % error
+
+        # reject what the UDC cannot do before anything is built
+        try:
+            self._plan()
+        except ValueError as e:
+            self.config = None
+            return "ERROR (No Room) %s" % e
+
         return 'Loaded "%s" (%s devs)' % (name.text, len(devs))
 
     def status(self):
-        if not os.path.isdir(GADGETFS):
-            return "NOGADGETFS"
-
-        if not self.config:
-            if os.listdir(GADGETFS) != []:
-                return "BLOCKED"
+        state = self.state
+        if state == "STOPPED" and not self.config:
             return "NOCONFIG"
+        return state
+
+    def _scan(self):
+        gadgetfs = self.configfs.root
+        if not os.path.isdir(gadgetfs):
+            return "NOGADGETFS"
 
-        if os.listdir(GADGETFS) != []:
+        if os.listdir(gadgetfs) != []:
             if not self.gadget:
                 return "BLOCKED"
             else:
@@ -724,28 +3739,78 @@ class GadgetController:
 
         return "UNKNOWN"
 
-    def start(self):
-        if self.status() != "STOPPED":
-            return "ERROR (Wrong State) %s" % self.status()
-
-        self.gadget = Gadget(self.config)
-        self.gadget.prepaire()
+    def _check_config(self):
+        """What layout() and the Gadget would trip over in the config, or
+        None if it is fine"""
+        for option in ("storage_luns", "cache_budget_mb"):
+            value = self.config.findtext(".//" + option)
+            if value is not None and not value.strip().isdigit():
+                return "<%s> %r is not a number" % (option, value)
+        for i, dev in enumerate(self.config.findall(".//dev")):
+            gtype = dev.get("type")
+            if gtype is None:
+                return "dev %d has no type" % i
+            for option in ("qmult", "mtu", "max_segment_size", "read_ahead_kb"):
+                value = dev.findtext(option)
+                if value and not value.strip().isdigit():
+                    return "dev %d (%s): <%s> %r is not a number" % (
+                        i,
+                        gtype,
+                        option,
+                        value,
+                    )
+            if gtype in ("storage_flash", "storage_iso"):
+                if dev.find("path") is None:
+                    return "dev %d (%s) has no <path>" % (i, gtype)
+                if dev.findtext("mode", "auto") not in ("auto", "cdrom", "disk"):
+                    return "dev %d (%s): unknown <mode> %s" % (
+                        i,
+                        gtype,
+                        dev.findtext("mode"),
+                    )
+                if dev.findtext("cache", "") not in ("", "ram", "pin"):
+                    return "dev %d (%s): unknown <cache> %s" % (
+                        i,
+                        gtype,
+                        dev.findtext("cache"),
+                    )
+        return None
 
+    def layout(self):
+        """The Gadget.add_* calls (method, kwargs) the config asks for"""
+        layout = []
         devs = self.config.findall(".//dev")
         for dev in devs:
             gtype = dev.attrib["type"]
             if gtype == "serial":
-                self.gadget.add_serial()
+                layout.append(("add_serial", {}))
             if gtype == "hid_keyboard":
-                self.gadget.add_hid(htype="keyboard")
+                layout.append(("add_hid", {"htype": "keyboard"}))
             if gtype == "hid_mouse":
-                self.gadget.add_hid(htype="mouse")
+                layout.append(("add_hid", {"htype": "mouse"}))
             if gtype == "hid_joystick":
-                self.gadget.add_hid(htype="joystick")
-            if gtype == "net_rndis":
-                self.gadget.add_net(ntype="rndis")
+                layout.append(("add_hid", {"htype": "joystick"}))
+            if gtype == "hid_media":
+                layout.append(("add_hid", {"htype": "media"}))
+            if gtype == "hid_composite":
+                layout.append(("add_hid", {"htype": "composite"}))
+            if gtype in ("net_rndis", "net_ncm", "net_ecm", "net_eem", "net_dual"):
+                kwargs = {"ntype": gtype[len("net_") :]}
+                for option in ("qmult", "mtu", "max_segment_size"):
+                    if dev.findtext(option):
+                        kwargs[option] = int(dev.findtext(option))
+                layout.append(("add_net", kwargs))
             if gtype == "sound":
-                self.gadget.add_uac()
+                layout.append(("add_uac", {"stype": "uac1"}))
+            if gtype in ("storage_flash", "storage_iso"):
+                options = {
+                    "nofua": dev.find("nofua") is not None,
+                    "removable": dev.findtext("removable", "1") != "0",
+                    "inquiry": dev.findtext("inquiry", ""),
+                    "mode": dev.findtext("mode", "auto"),
+                    "read_ahead_kb": int(dev.findtext("read_ahead_kb", "0")),
+                    "cache": dev.findtext("cache", ""),
+                }
             if gtype == "storage_flash":
                 p = dev.find("path")
                 ro = dev.find("readonly")
@@ -753,24 +3818,325 @@ class GadgetController:
                     readonly = True
                 else:
                     readonly = False
-                self.gadget.add_storage(p.text, stype="flash", readonly=readonly)
+                layout.append(
+                    (
+                        "add_storage",
+                        {
+                            "image": p.text or "",
+                            "stype": "flash",
+                            "readonly": readonly,
+                            "overlay": dev.find("overlay") is not None,
+                            **options,
+                        },
+                    )
+                )
             if gtype == "storage_iso":
                 p = dev.find("path")
-                self.gadget.add_storage(p.text, stype="iso")
-        retval = self.gadget.start()
-        if retval == "OK":
-            self.running = True
+                layout.append(
+                    (
+                        "add_storage",
+                        {
+                            "image": p.text or "",
+                            "stype": "iso",
+                            "readonly": False,
+                            "overlay": False,
+                            **options,
+                        },
+                    )
+                )
+        return layout
+
+    def _luns_per_function(self):
+        luns = self.config.findtext(".//storage_luns")
+        return max(1, min(int(luns), MAX_LUNS)) if luns else 1
+
+    def _plan(self):
+        return Planner(self.udcdir).plan(self.layout(), self._luns_per_function())
+
+    def plan(self):
+        """Endpoint/interface budget of the loaded config on this UDC"""
+        if not self.config:
+            return "ERROR (Wrong State) NOCONFIG"
+        planner = Planner(self.udcdir)
+        try:
+            layout, luns = planner.plan(self.layout(), self._luns_per_function())
+        except ValueError as e:
+            return "ERROR (No Room) %s" % e
+        return "OK " + planner.describe(layout, luns)
+
+    def start(self):
+        if self.job is not None:
+            return "ERROR (Wrong State) %s" % self.status()
+        retval = self._start()
+        self._set_state(self._scan())
+        return retval
+
+    def _start(self):
+        if not self.config:
+            return "ERROR (Wrong State) NOCONFIG"
+
+        try:
+            layout, luns = self._plan()
+        except ValueError as e:
+            return "ERROR (No Room) %s" % e
+
+        for method, kwargs in layout:
+            if method == "add_storage" and kwargs["image"]:
+                # a known bad image would only waste a boot attempt
+                if self.verifier.verify(kwargs["image"])[0] == "mismatch":
+                    return "ERROR (Corrupt Image) %s" % kwargs["image"]
+
+        status = self._scan()
+        if status == "RUNNING":
+            self._close_hid()
+            # already running, only apply what changed in the config
+            build = lambda: self.gadget.reconfigure(layout, luns)
+        elif status == "STOPPED":
+            self.gadget = self._new_gadget(self.config)
+            self.gadget.luns_per_function = luns
+
+            def build():
+                self.gadget.prepaire()
+                for method, kwargs in layout:
+                    getattr(self.gadget, method)(**kwargs)
+                return self.gadget.start()
+
+        else:
+            return "ERROR (Wrong State) %s" % status
+
+        try:
+            retval = build()
+        except Exception as e:
+            retval = "ERROR (Build Failed) %s" % e
+        if retval != "OK" and status == "RUNNING" and not self.gadget.stopped:
+            # reconfigure put back what it changed, the gadget is still
+            # bound with the previous layout, getty and dhcpd running
+            print("Reconfigure failed, previous layout kept:", retval)
+            return retval
+        if retval != "OK":
+            # roll back what the journal recorded instead of leaving a
+            # half built gadget that reads as BLOCKED
+            print("Rolling back:", retval)
+            self.gadget.stop()
+            self.gadget = None
+            self.running = False
+            return retval
+        self.running = True
         return retval
 
+    def swap_media(self, lun, path, dbus_context=None):
+        """Change the medium of a LUN on a worker thread, returns the job
+        id or 0 if busy. Copying an image to RAM or setting up an overlay
+        can take a while, the result comes with the finished Progress.
+        D-Bus callers can only insert images in their image directories
+        they can read.
+        """
+        return self._run_job("media", lambda: self._swap_media(lun, path, dbus_context))
+
+    def _swap_media(self, lun, path, dbus_context=None):
+        if path:
+            authorize(dbus_context)
+            user = dbus_caller(dbus_context)
+            path = user_image_path(user, path)
+            if user is not None and user.pw_uid != 0:
+                # the host gets to read it, so the caller must be able to
+                with open_as(user, path):
+                    pass
+
+        if self.status() != "RUNNING":
+            return "ERROR (Wrong State) %s" % self.status()
+
+        devs = [
+            dev
+            for dev in self.config.findall(".//dev")
+            if dev.attrib["type"] in ("storage_flash", "storage_iso")
+        ]
+        if lun >= len(devs) or lun >= len(self.gadget.storage):
+            return "ERROR (No LUN) %s" % lun
+
+        try:
+            # the previous medium is put back if the new one fails
+            self.gadget._set_media_all([(lun, {"image": path})])
+        except OSError as e:
+            return f"Error: {e}"
+
+        # keep the config in step so a later reconfigure does not revert it
+        p = devs[lun].find("path")
+        if p is None:
+            p = ET.SubElement(devs[lun], "path")
+        p.text = path
+        return "OK"
+
+    def eject_media(self, lun):
+        return self._run_job("media", lambda: self._swap_media(lun, ""))
+
+    def verify_image(self, path, dbus_context=None):
+        """Queue a checksum check of an image, returns "pending ".
+
+        The result comes with the Verified signal, right away for an image
+        checked before, otherwise when the background check is done.
+        D-Bus callers can only verify images in their image directories
+        they can read.
+        """
+        self.verify_requests.submit(self._verify_request, path, dbus_context)
+        return "pending "
+
+    def _verify_request(self, path, dbus_context):
+        try:
+            authorize(dbus_context)
+            user = dbus_caller(dbus_context)
+            key = None
+            checked = path
+            if user is not None and user.pw_uid != 0:
+                checked = user_image_path(user, path)
+                # only the file the caller could open gets hashed
+                with open_as(user, checked) as image:
+                    key = self.verifier.stat_key(os.fstat(image.fileno()))
+            status, digest = self.verifier.verify(checked, key)
+        except Exception as e:
+            status, digest = "error", getattr(e, "strerror", None) or str(e)
+        if status != "pending":
+            self._emit(self.Verified, path, status, digest)
+
+    def _images_in_use(self):
+        """Real paths of the images of the loaded config and of the LUNs"""
+        paths = set()
+        config = self.config
+        if config is not None:
+            paths.update(p.text for p in config.findall(".//dev/path") if p.text)
+        gadget = self.gadget
+        if gadget is not None:
+            paths.update(entry["image"] for entry in gadget.storage if entry["image"])
+        return {os.path.realpath(path) for path in paths}
+
+    def reset_media(self, lun):
+        """Drop everything written to an overlay LUN since it was set up,
+        on a worker thread, returns the job id or 0 if busy"""
+        return self._run_job("media", lambda: self._reset_media(lun))
+
+    def _reset_media(self, lun):
+        if self.status() != "RUNNING":
+            return "ERROR (Wrong State) %s" % self.status()
+        if lun >= len(self.gadget.storage):
+            return "ERROR (No LUN) %s" % lun
+        entry = self.gadget.storage[lun]
+        if entry["backing"] is None:
+            return "ERROR (No Overlay) %s" % lun
+        try:
+            self.gadget.set_media(lun, entry["image"])
+        except OSError as e:
+            return f"Error: {e}"
+        return "OK"
+
+    def _hid_writer(self, device):
+        """(writer, report id, report size) of the first hid device of that name"""
+        if self.gadget is None or self.status() != "RUNNING":
+            return None
+        with self.hid_lock:
+            for name, path, report_id, size in self.gadget.hid:
+                if name != device:
+                    continue
+                writer = self.hid_writers.get(path)
+                if writer is None:
+                    writer = self.hid_writers[path] = HidWriter(path)
+                return writer, report_id, size
+        return None
+
+    def hid_report_size(self, device):
+        hid = self._hid_writer(device)
+        return hid[2] if hid is not None else 0
+
+    def _close_hid(self):
+        with self.hid_lock:
+            for writer in self.hid_writers.values():
+                writer.close()
+            self.hid_writers = {}
+
+    def hid_send(self, device, reports):
+        """Queue raw reports for the first hid function of that type"""
+        if self.status() != "RUNNING":
+            return "ERROR (Wrong State) %s" % self.status()
+        hid = self._hid_writer(device)
+        if hid is None:
+            return "ERROR (No Device) %s" % device
+        writer, report_id, size = hid
+        try:
+            count = writer.send(bytes(reports), size, report_id)
+        except ValueError as e:
+            return f"ERROR (Bad Length) {e}"
+        return "OK (%d reports queued)" % count
+
+    def hid_type(self, text):
+        """Type text on the first keyboard with the configured <keymap>"""
+        if self.status() != "RUNNING":
+            return "ERROR (Wrong State) %s" % self.status()
+        name = self.config.findtext(".//keymap", "us")
+        keymap = KEYMAPS.get(name)
+        if keymap is None:
+            return "ERROR (Unknown Keymap) %s" % name
+        return self.hid_send("keyboard", keymap.encode(text))
+
+    def hid_pending(self, device):
+        hid = self._hid_writer(device)
+        return hid[0].pending if hid is not None else 0
+
+    def net_bench(self, peer, seconds):
+        """Link benchmark against a host running "bench --net-serve" on a
+        worker thread, returns the job id. The finished Progress carries
+        "OK <json>" or the error.
+
+        Without a peer the host holding the newest built-in DHCP lease is used.
+        """
+        return self._run_task("bench", lambda progress: self._net_bench(peer, seconds))
+
+    def _net_bench(self, peer, seconds):
+        if self.status() != "RUNNING" or self.gadget is None:
+            return "ERROR (Wrong State) %s" % self.status()
+        netif = self.gadget.netif
+        if not netif:
+            return "ERROR (No Device) net"
+        if not peer:
+            server = self.gadget.dhcp_server
+            leases = server.leases if server is not None else {}
+            if not leases:
+                return "ERROR (No Peer) no DHCP lease"
+            peer = str(max(leases.values(), key=lambda lease: lease[1])[0])
+        try:
+            with open(os.path.join(NETDIR, netif, "mtu"), "r") as mtufile:
+                mtu = int(mtufile.read())
+        except (OSError, ValueError):
+            mtu = self.gadget.mtu or 1500
+        bench = NetBench(
+            peer,
+            seconds=max(1, min(seconds, 30)),
+            source="10.0.0.1",
+            datagram=mtu - 28,
+        )
+        try:
+            result = bench.run()
+        except OSError as e:
+            return "ERROR (Bench Failed) %s" % e
+        functions = [name.split(".")[0] for name, _ in self.gadget.netifs]
+        result.update(function="+".join(functions), mtu=mtu, peer=peer)
+        return "OK " + json.dumps(result)
+
     def stop(self):
+        if self.job is not None:
+            return "ERROR (Wrong State) %s" % self.status()
+        retval = self._stop()
+        self._set_state(self._scan())
+        return retval
+
+    def _stop(self):
+        self._close_hid()
         if self.gadget:
-            self.gadget.stop()
+            retval = self.gadget.stop()
             self.gadget = None
         else:
-            g = Gadget(None)
-            g.stop()
+            g = self._new_gadget(None)
+            retval = g.stop()
         self.running = False
-        return "OK"
+        return retval
 
     def _indent(self, elem, level=0):
         i = "\n" + level * "  "
@@ -790,8 +4156,873 @@ class GadgetController:
         return elem
 
 
+class SyscallCounter:
+    """Counts audited os/io calls (open, mkdir, symlink, spawn, ...)."""
+
+    def __init__(self):
+        self.active = False
+        self.counts = {}
+        sys.addaudithook(self._hook)
+
+    def _hook(self, event, args):
+        if not self.active:
+            return
+        if event == "open" or event.startswith(("os.", "subprocess.")):
+            self.counts[event] = self.counts.get(event, 0) + 1
+
+    def start(self):
+        self.counts = {}
+        self.active = True
+
+    def stop(self):
+        self.active = False
+        return sum(self.counts.values())
+
+
+class ReadyMonitor:
+    """Stand-in for UeventMonitor, the fake tree has no device nodes."""
+
+    def wait(self, paths, exist=True, timeout=READY_TIMEOUT):
+        return []
+
+    def wait_udc(self, statefile, state="configured", timeout=CONFIGURED_TIMEOUT):
+        return state
+
+    def close(self):
+        pass
+
+
+class HostRecorder(Host):
+    """Stand-in for Host that records instead of touching the system."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def run(self, argv):
+        self.spawned += 1
+        self.calls.append(argv)
+        return 0
+
+    def start_unit(self, unit):
+        self.calls.append(["start_unit", unit])
+
+    def stop_unit(self, unit):
+        self.calls.append(["stop_unit", unit])
+
+    def kill(self, pid):
+        self.calls.append(["kill", pid])
+
+    def add_address(self, ifname, address, prefixlen):
+        self.calls.append(["add_address", ifname, address, prefixlen])
+
+    def link_up(self, ifname):
+        self.calls.append(["link_up", ifname])
+
+    def set_mtu(self, ifname, mtu):
+        self.calls.append(["set_mtu", ifname, mtu])
+
+    def set_master(self, ifname, master):
+        self.calls.append(["set_master", ifname, master])
+
+    def add_bridge(self, ifname):
+        self.calls.append(["add_bridge", ifname])
+
+    def del_link(self, ifname):
+        self.calls.append(["del_link", ifname])
+
+    def set_read_ahead(self, image, kb):
+        self.calls.append(["set_read_ahead", image, kb])
+        return 128
+
+    def loop_attach(self, path, readonly=False):
+        self.calls.append(["loop_attach", path, readonly])
+        return "/dev/loop%d" % sum(c[0] == "loop_attach" for c in self.calls)
+
+    def loop_detach(self, dev):
+        self.calls.append(["loop_detach", dev])
+
+
+class NetBenchServer:
+    """Peer end of the network benchmark, "bench --net-serve" on the host.
+
+    A TCP connection starts with a mode byte: "S" is drained and answered
+    with the byte count once the client shuts down its side, "R" (followed
+    by the seconds as a double) is sent data until the time is up. UDP "P"
+    datagrams are echoed, "U" datagrams are counted and an "E" datagram is
+    answered with the (datagrams, bytes) counted since the last one.
+    """
+
+    def __init__(self, address="0.0.0.0", port=NETBENCH_PORT):
+        self.tcp = socket.create_server((address, port))
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((address, port))
+        self.threads = []
+
+    def start(self):
+        for target in (self._accept, self._datagrams):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def serve_forever(self):
+        print("Benchmark peer on %s:%s" % self.tcp.getsockname())
+        for thread in self.start().threads:
+            thread.join()
+
+    def close(self):
+        for sock in (self.tcp, self.udp):
+            with contextlib.suppress(OSError):
+                # wakes the threads blocked in accept/recvfrom
+                sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.tcp.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._stream, args=(conn,), daemon=True).start()
+
+    def _stream(self, conn):
+        with conn, contextlib.suppress(OSError):
+            mode = conn.recv(1)
+            if mode == b"S":
+                buf = bytearray(NETBENCH_BUFSIZE)
+                total = 0
+                while True:
+                    size = conn.recv_into(buf)
+                    if not size:
+                        break
+                    total += size
+                conn.sendall(struct.pack("!Q", total))
+            elif mode == b"R":
+                (seconds,) = struct.unpack("!d", conn.recv(8, socket.MSG_WAITALL))
+                data = bytes(NETBENCH_BUFSIZE)
+                deadline = time.monotonic() + seconds
+                while time.monotonic() < deadline:
+                    conn.sendall(data)
+
+    def _datagrams(self):
+        count = size = 0
+        while True:
+            try:
+                data, addr = self.udp.recvfrom(65535)
+            except OSError:
+                return
+            if not data:
+                return
+            if data[:1] == b"P":
+                self.udp.sendto(data, addr)
+            elif data[:1] == b"U":
+                count += 1
+                size += len(data)
+            elif data[:1] == b"E":
+                self.udp.sendto(struct.pack("!QQ", count, size), addr)
+                count = size = 0
+
+
+class NetBench:
+    """Throughput, latency and CPU use of the link to a NetBenchServer.
+
+    cpu is the busy share of all CPUs while a test runs, the gadget side
+    of the link is kernel work; cpu_self is this process on one CPU.
+    """
+
+    def __init__(
+        self, peer, port=NETBENCH_PORT, seconds=3.0, source=None, datagram=1472
+    ):
+        self.peer = (peer, port)
+        self.seconds = seconds
+        self.source = (source, 0) if source else None
+        self.datagram = datagram
+
+    def _connect(self):
+        return socket.create_connection(
+            self.peer, timeout=self.seconds + READY_TIMEOUT, source_address=self.source
+        )
+
+    def _udp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.source:
+            sock.bind(self.source)
+        sock.connect(self.peer)
+        sock.settimeout(1.0)
+        return sock
+
+    def _cpu(self):
+        """(busy, total) jiffies of all CPUs"""
+        try:
+            with open("/proc/stat", "r") as stat:
+                ticks = [int(t) for t in stat.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        total = sum(ticks)
+        return total - ticks[3] - ticks[4], total
+
+    def _measure(self, test):
+        cpu = self._cpu()
+        start = os.times()
+        t0 = time.monotonic()
+        result = test()
+        elapsed = time.monotonic() - t0
+        end = os.times()
+        used = end.user + end.system - start.user - start.system
+        result["cpu_self"] = used / elapsed * 100
+        end = self._cpu()
+        if cpu is not None and end is not None and end[1] > cpu[1]:
+            result["cpu"] = (end[0] - cpu[0]) / (end[1] - cpu[1]) * 100
+        else:
+            result["cpu"] = None
+        return result
+
+    def tcp_tx(self):
+        data = bytes(NETBENCH_BUFSIZE)
+        with self._connect() as sock:
+            sock.sendall(b"S")
+            t0 = time.monotonic()
+            deadline = t0 + self.seconds
+            while time.monotonic() < deadline:
+                sock.sendall(data)
+            sock.shutdown(socket.SHUT_WR)
+            (total,) = struct.unpack("!Q", sock.recv(8, socket.MSG_WAITALL))
+            elapsed = time.monotonic() - t0
+        return {"mbit_s": total * 8 / elapsed / 1e6}
+
+    def tcp_rx(self):
+        buf = bytearray(NETBENCH_BUFSIZE)
+        total = 0
+        with self._connect() as sock:
+            t0 = time.monotonic()
+            sock.sendall(b"R" + struct.pack("!d", self.seconds))
+            while True:
+                size = sock.recv_into(buf)
+                if not size:
+                    break
+                total += size
+            elapsed = time.monotonic() - t0
+        return {"mbit_s": total * 8 / elapsed / 1e6}
+
+    def udp_tx(self):
+        data = b"U" + bytes(self.datagram - 1)
+        sent = 0
+        with self._udp() as sock:
+            t0 = time.monotonic()
+            deadline = t0 + self.seconds
+            while time.monotonic() < deadline:
+                try:
+                    sock.send(data)
+                    sent += 1
+                except (BlockingIOError, ConnectionRefusedError):
+                    pass
+                except OSError as e:
+                    # the qdisc is full
+                    if e.errno != errno.ENOBUFS:
+                        raise
+            elapsed = time.monotonic() - t0
+            for _ in range(3):
+                sock.send(b"E")
+                try:
+                    count, total = struct.unpack("!QQ", sock.recv(16))
+                    break
+                except socket.timeout:
+                    continue
+            else:
+                raise OSError("no answer from %s:%s" % self.peer)
+        return {
+            "mbit_s": total * 8 / elapsed / 1e6,
+            "loss": (1 - count / sent) * 100 if sent else 0.0,
+        }
+
+    def rtt(self, count=200):
+        rtts = []
+        with self._udp() as sock:
+            for seq in range(count):
+                probe = b"P" + struct.pack("!I", seq)
+                t0 = time.perf_counter()
+                sock.send(probe)
+                try:
+                    while sock.recv(64) != probe:
+                        pass
+                except socket.timeout:
+                    continue
+                rtts.append((time.perf_counter() - t0) * 1000)
+        rtts.sort()
+        if not rtts:
+            raise OSError("no answer from %s:%s" % self.peer)
+        return {
+            "p50_ms": rtts[len(rtts) // 2],
+            "p99_ms": rtts[min(len(rtts) - 1, len(rtts) * 99 // 100)],
+            "lost": count - len(rtts),
+        }
+
+    def run(self):
+        return {
+            "tcp_tx": self._measure(self.tcp_tx),
+            "tcp_rx": self._measure(self.tcp_rx),
+            "udp_tx": self._measure(self.udp_tx),
+            "rtt": self._measure(self.rtt),
+        }
+
+
+class NetBenchVeth:
+    """veth pair with the far end in its own network namespace, standing in
+    for usb0 and the host behind it when there is no USB hardware.
+    """
+
+    def __init__(
+        self,
+        host,
+        mtu=1500,
+        netns=NETBENCH_NETNS,
+        address="10.200.0.1",
+        peer="10.200.0.2",
+    ):
+        self.host = host
+        self.mtu = mtu
+        self.netns = netns
+        self.ifname = netns + "0"
+        self.address = address
+        self.peer = peer
+        self.server = None
+
+    def __enter__(self):
+        ip = ["ip", "netns", "exec", self.netns, "ip"]
+        peerif = self.netns + "1"
+        steps = [
+            ["ip", "netns", "add", self.netns],
+            ["ip", "link", "add", self.ifname, "type", "veth"]
+            + ["peer", "name", peerif, "netns", self.netns],
+            ip + ["link", "set", "lo", "up"],
+            ip + ["link", "set", peerif, "mtu", str(self.mtu), "up"],
+            ip + ["addr", "add", self.peer + "/24", "dev", peerif],
+        ]
+        try:
+            for argv in steps:
+                if self.host.run(argv) != 0:
+                    raise OSError("%s failed" % " ".join(argv))
+            self.host.set_mtu(self.ifname, self.mtu)
+            self.host.add_address(self.ifname, self.address, 24)
+            self.host.link_up(self.ifname)
+
+            self.host.spawned += 1
+            self.server = subprocess.Popen(
+                ip[:4]
+                + [sys.executable, os.path.abspath(__file__), "bench"]
+                + ["--net-serve", self.peer]
+            )
+            deadline = time.monotonic() + READY_TIMEOUT
+            while True:
+                try:
+                    socket.create_connection(
+                        (self.peer, NETBENCH_PORT), timeout=1.0
+                    ).close()
+                    break
+                except OSError:
+                    if time.monotonic() > deadline or self.server.poll() is not None:
+                        raise
+                    time.sleep(0.1)
+        except Exception:
+            self.close()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.server is not None:
+            self.server.terminate()
+            self.server.wait()
+            self.server = None
+        # takes the peer and with it our end of the pair
+        self.host.run(["ip", "netns", "del", self.netns])
+
+
+def bench_net(mtus=(1500,), seconds=3.0, peer=None, source=None):
+    """Link benchmark against a peer, or over a veth pair per MTU"""
+    if peer:
+        bench = NetBench(peer, seconds=seconds, source=source)
+        return {"peer": bench.run()}
+    results = {}
+    for mtu in mtus:
+        with NetBenchVeth(Host(), mtu=mtu) as veth:
+            bench = NetBench(
+                veth.peer, seconds=seconds, source=veth.address, datagram=mtu - 28
+            )
+            results[f"veth/{mtu}"] = bench.run()
+    return results
+
+
+def bench_mixes(image, storage=(1, 2, 4)):
+    mixes = {
+        "serial": [("add_serial", {})],
+        "rndis": [("add_net", {"ntype": "rndis"})],
+        "uac1": [("add_uac", {"stype": "uac1"})],
+    }
+    for num in range(1, 5):
+        mixes[f"hid{num}"] = [("add_hid", {"htype": "keyboard"})] * num
+    mixes["composite"] = [("add_hid", {"htype": "composite"})]
+    for num in storage:
+        mixes[f"storage{num}"] = [("add_storage", {"image": image})] * num
+    mixes["all"] = (
+        mixes["serial"]
+        + mixes["rndis"]
+        + mixes["uac1"]
+        + [("add_hid", {"htype": h}) for h in ("keyboard", "mouse", "joystick")]
+        + [("add_storage", {"image": image, "stype": "iso"})]
+    )
+    return mixes
+
+
+def bench_run(calls, root, counter):
+    configfs = FakeConfigFS(os.path.join(root, "usb_gadget"))
+    recorder = HostRecorder()
+    g = Gadget(
+        None,
+        configfs=configfs,
+        udcdir=os.path.join(root, "udc"),
+        systemddir=os.path.join(root, "systemd"),
+        host=recorder,
+        monitor=ReadyMonitor,
+        name=BENCH_GADGET,
+    )
+    phases = [
+        ("prepaire", [(g.prepaire, {})]),
+        ("add", [(getattr(g, name), kwargs) for name, kwargs in calls]),
+        ("start", [(g.start, {})]),
+        ("stop", [(g.stop, {})]),
+    ]
+    result = {}
+    for phase, steps in phases:
+        spawned = recorder.spawned
+        writes = configfs.writes
+        write_time = configfs.write_time
+        with contextlib.redirect_stdout(io.StringIO()):
+            counter.start()
+            t = time.perf_counter()
+            for func, kwargs in steps:
+                func(**kwargs)
+            elapsed = time.perf_counter() - t
+            syscalls = counter.stop()
+        result[phase] = {
+            "ms": elapsed * 1000,
+            "syscalls": syscalls,
+            "spawned": recorder.spawned - spawned,
+            "writes": configfs.writes - writes,
+            "io_ms": (configfs.write_time - write_time) * 1000,
+        }
+    if os.listdir(configfs.root) != []:
+        raise RuntimeError("stop() left items in %s" % configfs.root)
+    return result
+
+
+def benchmark(repeat=5, storage=(1, 2, 4)):
+    counter = SyscallCounter()
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="gcbench") as root:
+        for d in ("usb_gadget", "udc/fake-udc.0", "systemd/getty.target.wants"):
+            os.makedirs(os.path.join(root, d))
+        image = os.path.join(root, "disk.img")
+        with open(image, "wb") as img:
+            img.truncate(1024 * 1024)
+
+        for mix, calls in bench_mixes(image, storage).items():
+            runs = [bench_run(calls, root, counter) for _ in range(repeat)]
+            results[mix] = {}
+            for phase in runs[0]:
+                ms = sorted(r[phase]["ms"] for r in runs)
+                io_ms = sorted(r[phase]["io_ms"] for r in runs)
+                results[mix][phase] = dict(
+                    runs[0][phase], ms=ms[len(ms) // 2], io_ms=io_ms[len(io_ms) // 2]
+                )
+    return results
+
+
+def _fstype(path):
+    """Type of the file system holding path, from /proc/mounts"""
+    path = os.path.realpath(path)
+    best, fstype = "", "?"
+    with contextlib.suppress(OSError):
+        with open("/proc/mounts", "r") as mounts:
+            for line in mounts:
+                fields = line.split()
+                mount = fields[1].replace("\\040", " ")
+                if (path + "/").startswith(mount.rstrip("/") + "/") and len(
+                    mount
+                ) >= len(best):
+                    best, fstype = mount, fields[2]
+    return fstype
+
+
+class StorageBench:
+    """Sequential and random throughput of a mass storage LUN setup.
+
+    With dummy_hcd loaded the gadget is bound to the dummy UDC and the
+    SCSI disk the host side gets is driven with O_DIRECT, measuring USB,
+    the SCSI layer and f_mass_storage together. Otherwise the backing file
+    is read and written the way f_mass_storage does it: every command
+    becomes FSG_BUFLEN sized reads or writes, and unless nofua every
+    write command is followed by fdatasync as for FUA.
+    """
+
+    def __init__(self, size=64 * 1024 * 1024, seconds=2.0, simulate=False):
+        self.size = size
+        self.seconds = seconds
+        self.udc = None
+        if not simulate and os.path.isdir(UDCDIR):
+            udcs = [u for u in sorted(os.listdir(UDCDIR)) if u.startswith("dummy_udc")]
+            self.udc = udcs[0] if udcs else None
+
+    @property
+    def mode(self):
+        return "dummy_hcd" if self.udc else "simulated"
+
+    def _io(self, fd, write, request, piece, sync, offsets):
+        """Run commands at offsets until done or out of time, (bytes, commands)"""
+        buf = mmap.mmap(-1, request)
+        if write:
+            buf.write(os.urandom(request))
+        done = commands = 0
+        deadline = time.monotonic() + self.seconds
+        for offset in offsets:
+            for start in range(0, request, piece):
+                view = memoryview(buf)[start : start + piece]
+                if write:
+                    os.pwritev(fd, [view], offset + start)
+                else:
+                    os.preadv(fd, [view], offset + start)
+                view.release()
+            if write and sync:
+                os.fdatasync(fd)
+            done += request
+            commands += 1
+            if time.monotonic() > deadline:
+                break
+        buf.close()
+        return done, commands
+
+    def _tests(self, fd, piece, sync, ro, drop):
+        results = {}
+        blocks = self.size // STORAGE_BENCH_RAND
+        for test in ("seq_read", "seq_write", "rand_read", "rand_write"):
+            write = test.endswith("write")
+            if write and ro:
+                results[test] = None
+                continue
+            if test.startswith("seq"):
+                request = STORAGE_BENCH_SEQ
+                offsets = range(0, self.size - request + 1, request)
+            else:
+                request = STORAGE_BENCH_RAND
+                offsets = (random.randrange(blocks) * request for _ in iter(int, 1))
+            drop()
+            t0 = time.monotonic()
+            size, commands = self._io(
+                fd, write, request, min(piece, request), sync, offsets
+            )
+            if write:
+                # what is still in the page cache is not written yet
+                os.fsync(fd)
+            elapsed = time.monotonic() - t0
+            results[test] = {
+                "mb_s": size / elapsed / 1e6,
+                "iops": commands / elapsed,
+            }
+        return results
+
+    def _backing(self, directory):
+        path = os.path.join(directory, ".gcbench.img")
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            # written out, a sparse file would read zeros from nowhere
+            block = os.urandom(1024 * 1024)
+            for offset in range(0, self.size, len(block)):
+                os.pwrite(fd, block, offset)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        return path
+
+    def run(self, directory, nofua=False, ro=False, stall=False, cache="cold"):
+        path = self._backing(directory)
+        try:
+            backing = os.open(path, os.O_RDONLY)
+
+            def drop():
+                if cache == "cold":
+                    os.posix_fadvise(backing, 0, 0, os.POSIX_FADV_DONTNEED)
+                else:
+                    os.posix_fadvise(backing, 0, 0, os.POSIX_FADV_WILLNEED)
+
+            try:
+                if self.udc:
+                    return self._run_gadget(path, nofua, ro, stall, drop)
+                flags = os.O_RDONLY if ro else os.O_RDWR
+                fd = os.open(path, flags)
+                try:
+                    return self._tests(fd, FSG_BUFLEN, not nofua, ro, drop)
+                finally:
+                    os.close(fd)
+            finally:
+                os.close(backing)
+        finally:
+            os.remove(path)
+
+    def _run_gadget(self, path, nofua, ro, stall, drop):
+        with tempfile.TemporaryDirectory(prefix="gcbench") as root:
+            # a udc dir with only the dummy UDC in it
+            udcdir = os.path.join(root, "udc")
+            os.makedirs(udcdir)
+            os.symlink(os.path.join(UDCDIR, self.udc), os.path.join(udcdir, self.udc))
+            g = Gadget(
+                None,
+                udcdir=udcdir,
+                systemddir=root,
+                host=HostRecorder(),
+                name=BENCH_GADGET,
+            )
+            g.storage_stall = stall
+            with contextlib.redirect_stdout(io.StringIO()):
+                g.stop()
+                g.prepaire()
+                g.add_storage(
+                    path, readonly=ro, nofua=nofua, inquiry=STORAGE_BENCH_INQUIRY
+                )
+                result = g.start()
+            try:
+                if result != "OK":
+                    raise OSError("gadget start failed: %s" % result)
+                dev = self._host_disk()
+                flags = (os.O_RDONLY if ro else os.O_RDWR) | os.O_DIRECT
+                fd = os.open(dev, flags)
+                try:
+                    return self._tests(fd, STORAGE_BENCH_SEQ, False, ro, drop)
+                finally:
+                    os.close(fd)
+            finally:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    g.stop()
+
+    def _host_disk(self):
+        """The host side /dev/sdX of our LUN, found by its inquiry string"""
+        vendor = STORAGE_BENCH_INQUIRY[:8].strip()
+        model = STORAGE_BENCH_INQUIRY[8:24].strip()
+        deadline = time.monotonic() + READY_TIMEOUT * 2
+        while time.monotonic() < deadline:
+            for disk in glob.glob("/sys/block/sd*"):
+                with contextlib.suppress(OSError):
+                    with open(os.path.join(disk, "device/vendor"), "r") as v:
+                        with open(os.path.join(disk, "device/model"), "r") as m:
+                            if v.read().strip() == vendor and m.read().strip() == model:
+                                with open(os.path.join(disk, "size"), "r") as n:
+                                    size = int(n.read())
+                                if size:
+                                    return "/dev/" + os.path.basename(disk)
+            time.sleep(0.1)
+        raise OSError("host side disk of the dummy_hcd gadget did not show up")
+
+
+def bench_storage(dirs, size, seconds, simulate=False):
+    """Storage throughput for every option combination and directory"""
+    bench = StorageBench(size=size, seconds=seconds, simulate=simulate)
+    # stall only matters on the wire
+    stalls = (False, True) if bench.udc else (False,)
+    results = {"mode": bench.mode, "size": size, "results": {}}
+    for directory in dirs:
+        fstype = _fstype(directory)
+        for nofua in (False, True):
+            for ro in (False, True):
+                for stall in stalls:
+                    for cache in ("cold", "warm"):
+                        name = "%s(%s) nofua=%d ro=%d stall=%d %s" % (
+                            directory,
+                            fstype,
+                            nofua,
+                            ro,
+                            stall,
+                            cache,
+                        )
+                        results["results"][name] = bench.run(
+                            directory, nofua, ro, stall, cache
+                        )
+    return results
+
+
+def bench_keymaps(repeat=5, size=1024 * 1024):
+    """MB/s of text encoded to keyboard reports per keymap"""
+    results = {}
+    for name, keymap in KEYMAPS.items():
+        # every typeable character, with some repeats
+        chars = "".join(chr(c) for c in keymap.chars) + "aa  ll"
+        text = (chars * (size // len(chars) + 1))[:size]
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            reports = keymap.encode(text)
+            times.append(time.perf_counter() - t0)
+        seconds = sorted(times)[len(times) // 2]
+        results[name] = {
+            "chars": len(text),
+            "reports": len(reports) // 8,
+            "ms": seconds * 1000,
+            "mb_s": len(text.encode()) / seconds / 1e6,
+        }
+    return results
+
+
+def bench_main(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="gadgetcontroller-service.py bench",
+        description="Time gadget bring-up against a fake configfs tree",
+    )
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    parser.add_argument("--storage", default="1,2,4", help="mass_storage counts")
+    parser.add_argument("--json", metavar="FILE", help="write results as json")
+    parser.add_argument(
+        "--keymap", action="store_true", help="time text to HID report encoding"
+    )
+    parser.add_argument(
+        "--net", action="store_true", help="link throughput/latency over a veth pair"
+    )
+    parser.add_argument("--net-peer", metavar="ADDR", help="bench --net against ADDR")
+    parser.add_argument("--net-source", metavar="ADDR", help="local address to use")
+    parser.add_argument(
+        "--net-serve", metavar="ADDR", help="be the peer of bench --net on ADDR"
+    )
+    parser.add_argument("--mtu", default="1500", help="veth MTUs of bench --net")
+    parser.add_argument(
+        "--seconds", type=float, default=3.0, help="per net/storage-io test"
+    )
+    parser.add_argument(
+        "--storage-io", action="store_true", help="mass storage MB/s and IOPS"
+    )
+    parser.add_argument(
+        "--dir",
+        default="/tmp",
+        help="comma separated backing file directories of bench --storage-io",
+    )
+    parser.add_argument("--size", type=int, default=64, help="backing file MiB")
+    parser.add_argument(
+        "--simulate", action="store_true", help="read the backing file, no dummy_hcd"
+    )
+    parser.add_argument(
+        "--compare", metavar="FILE", help="print changes against an earlier --json"
+    )
+    args = parser.parse_args(argv)
+
+    if args.net_serve:
+        server = NetBenchServer(args.net_serve)
+        try:
+            server.serve_forever()
+        finally:
+            server.close()
+        return
+
+    if args.net or args.net_peer:
+        mtus = [int(n) for n in args.mtu.split(",") if n]
+        results = bench_net(mtus, args.seconds, args.net_peer, args.net_source)
+        print(
+            "%-10s %-7s %9s %7s %7s %7s"
+            % ("link", "test", "Mbit/s", "loss %", "cpu %", "self %")
+        )
+        for link, tests in results.items():
+            for test in ("tcp_tx", "tcp_rx", "udp_tx"):
+                r = tests[test]
+                cpu = "%7.1f" % r["cpu"] if r["cpu"] is not None else "%7s" % "-"
+                loss = "%7.2f" % r["loss"] if "loss" in r else "%7s" % "-"
+                print(
+                    "%-10s %-7s %9.1f %s %s %7.1f"
+                    % (link, test, r["mbit_s"], loss, cpu, r["cpu_self"])
+                )
+            r = tests["rtt"]
+            print(
+                "%-10s %-7s p50 %.3f ms  p99 %.3f ms  lost %d"
+                % (link, "rtt", r["p50_ms"], r["p99_ms"], r["lost"])
+            )
+        if args.json:
+            with open(args.json, "w") as jf:
+                json.dump(results, jf, indent=2)
+        return
+
+    if args.storage_io:
+        dirs = [d for d in args.dir.split(",") if d]
+        results = bench_storage(
+            dirs, args.size * 1024 * 1024, args.seconds, args.simulate
+        )
+        old = {}
+        if args.compare:
+            with open(args.compare, "r") as jf:
+                old = json.load(jf).get("results", {})
+        print("mode %s, %d MiB backing files" % (results["mode"], args.size))
+        for name, tests in results["results"].items():
+            print(name)
+            for test, r in tests.items():
+                if r is None:
+                    continue
+                key, unit = (
+                    ("mb_s", "MB/s") if test.startswith("seq") else ("iops", "IOPS")
+                )
+                line = "  %-10s %10.1f %s" % (test, r[key], unit)
+                before = (old.get(name) or {}).get(test)
+                if before:
+                    line += "  %+6.1f %%" % ((r[key] / before[key] - 1) * 100)
+                print(line)
+        if args.json:
+            with open(args.json, "w") as jf:
+                json.dump(results, jf, indent=2)
+        return
+
+    if args.keymap:
+        results = bench_keymaps(repeat=args.repeat)
+        print("%-6s %9s %9s %8s %8s" % ("keymap", "chars", "reports", "ms", "MB/s"))
+        for name, r in results.items():
+            print(
+                "%-6s %9d %9d %8.2f %8.1f"
+                % (name, r["chars"], r["reports"], r["ms"], r["mb_s"])
+            )
+        if args.json:
+            with open(args.json, "w") as jf:
+                json.dump(results, jf, indent=2)
+        return
+
+    storage = [int(n) for n in args.storage.split(",") if n]
+    results = benchmark(repeat=args.repeat, storage=storage)
+
+    print(
+        "%-10s %-9s %10s %9s %8s %7s %8s"
+        % ("mix", "phase", "ms", "syscalls", "spawned", "writes", "io ms")
+    )
+    for mix, phases in results.items():
+        for phase, r in phases.items():
+            print(
+                "%-10s %-9s %10.2f %9d %8d %7d %8.2f"
+                % (
+                    mix,
+                    phase,
+                    r["ms"],
+                    r["syscalls"],
+                    r["spawned"],
+                    r["writes"],
+                    r["io_ms"],
+                )
+            )
+        total = sum(r["ms"] for r in phases.values())
+        print("%-10s %-9s %10.2f" % (mix, "total", total))
+
+    if args.json:
+        with open(args.json, "w") as jf:
+            json.dump(results, jf, indent=2)
+
+
 if __name__ == "__main__":
-    if "stoptest" in sys.argv:
+    if "bench" in sys.argv:
+        bench_main(sys.argv[sys.argv.index("bench") + 1 :])
+    elif "stoptest" in sys.argv:
         g = Gadget(None)
         g.stop()
     elif "test" in sys.argv:
@@ -827,7 +5058,11 @@ if __name__ == "__main__":
 
     else:
         bus = SystemBus()
-        bus.publish(BUS_NAME, GadgetController())
+        controller = GadgetController()
+        bus.publish(BUS_NAME, controller)
+        controller.watch()
+        if HIDSOCKET:
+            HidSocket(controller).start()
         loop = GLib.MainLoop()
         loop.run()
 
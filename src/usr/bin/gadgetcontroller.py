@@ -4,6 +4,7 @@ import os
 import subprocess
 import tempfile
 import time
+import json
 from functools import partial
 import xml.etree.ElementTree as ET
 from pydbus import SystemBus
@@ -20,6 +21,8 @@ gi.require_version("Handy", "1")
 from gi.repository import Handy
 
 BUS_NAME = "de.beaerlin.GadgetController"
+# verify_image calls per main loop iteration
+VERIFY_BATCH = 8
 datapath = os.path.expanduser("~/.gadget")
 if not os.path.isdir(os.path.join(datapath, "iso")):
     os.makedirs(os.path.join(datapath, "iso"))
@@ -29,11 +32,188 @@ if not os.path.isdir(os.path.join(datapath, "config")):
     os.makedirs(os.path.join(datapath, "config"))
 
 
+class ImageCatalog:
+    """Index of the images in ~/.gadget with cached metadata.
+
+    Kept in catalog.json and updated from Gio file monitors (inotify), so
+    listing images does not stat every file again. Metadata of a file is
+    only read again when its size or mtime changed. Checksums come from
+    the service, verify(path) asks it to check an image and the result
+    arrives through set_verified().
+    """
+
+    dirs = {"image": ".img", "iso": ".iso"}
+
+    def __init__(self, root, changed=None, verify=None):
+        self.root = root
+        self.file = os.path.join(root, "catalog.json")
+        self.changed = changed
+        self.verify = verify
+        # "image/name.img" -> {"size", "mtime", "table", "bootable", "label",
+        # "verified", "digest"}
+        self.entries = {}
+        try:
+            with open(self.file, "r") as cfile:
+                self.entries = json.load(cfile)
+        except (OSError, ValueError):
+            pass
+        self.save_source = None
+        # images to ask the service about, sent a few at a time from an
+        # idle handler so a large catalog does not block the UI
+        self.verify_queue = []
+        self.verify_source = None
+
+        # catch up with what changed while we were not running
+        for sub, ext in self.dirs.items():
+            names = set(os.listdir(os.path.join(root, sub)))
+            for key in [k for k in self.entries if k.startswith(sub + "/")]:
+                if key[len(sub) + 1 :] not in names:
+                    del self.entries[key]
+            for name in names:
+                self._update(sub, name)
+        self._save_later()
+
+        self.monitors = []
+        for sub in self.dirs:
+            gfile = Gio.File.new_for_path(os.path.join(root, sub))
+            monitor = gfile.monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+            monitor.connect("changed", self._on_changed, sub)
+            self.monitors.append(monitor)
+
+    def list(self, sub):
+        """[(name, entry)] of one directory, sorted by name"""
+        prefix = sub + "/"
+        return sorted(
+            (key[len(prefix) :], entry)
+            for key, entry in self.entries.items()
+            if key.startswith(prefix)
+        )
+
+    def _on_changed(self, monitor, gfile, other, event, sub):
+        names = [gfile.get_basename()]
+        if other is not None and event == Gio.FileMonitorEvent.RENAMED:
+            names.append(other.get_basename())
+        if event in (
+            Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+            Gio.FileMonitorEvent.CREATED,
+            Gio.FileMonitorEvent.DELETED,
+            Gio.FileMonitorEvent.MOVED_IN,
+            Gio.FileMonitorEvent.MOVED_OUT,
+            Gio.FileMonitorEvent.RENAMED,
+        ):
+            if any([self._update(sub, name) for name in names]):
+                self._save_later()
+                if self.changed is not None:
+                    self.changed()
+
+    def _update(self, sub, name):
+        """Bring the entry of one file up to date, True if it changed"""
+        key = f"{sub}/{name}"
+        # hidden files are overlays and images still being created
+        if name.startswith(".") or not name.endswith(self.dirs[sub]):
+            return False
+        try:
+            st = os.stat(os.path.join(self.root, key))
+        except FileNotFoundError:
+            return self.entries.pop(key, None) is not None
+        entry = self.entries.get(key)
+        if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+            if entry.get("verified") in (None, "pending"):
+                self._request(key)
+            return False
+        entry = {"size": st.st_size, "mtime": st.st_mtime, "verified": None}
+        entry.update(self._inspect(os.path.join(self.root, key)))
+        self.entries[key] = entry
+        self._request(key)
+        return True
+
+    def _request(self, key):
+        if self.verify is None or key in self.verify_queue:
+            return
+        self.verify_queue.append(key)
+        if self.verify_source is None:
+            self.verify_source = GLib.idle_add(self._send_requests)
+
+    def _send_requests(self):
+        batch = self.verify_queue[:VERIFY_BATCH]
+        del self.verify_queue[:VERIFY_BATCH]
+        for key in batch:
+            if key not in self.entries:
+                continue
+            try:
+                response = self.verify(os.path.join(self.root, key))
+            except GLib.Error as e:
+                print("verify_image failed:", e)
+                continue
+            status, _, digest = response.partition(" ")
+            # the result itself arrives through set_verified()
+            if self.entries[key].get("verified") is None:
+                self.entries[key].update(verified=status, digest=digest)
+        if self.verify_queue:
+            return True
+        self.verify_source = None
+        return False
+
+    def set_verified(self, path, status, digest):
+        """Checksum result for an image, True if it is in the catalog"""
+        key = os.path.relpath(path, self.root)
+        entry = self.entries.get(key)
+        if entry is None:
+            return False
+        entry.update(verified=status, digest=digest)
+        self._save_later()
+        return True
+
+    def _inspect(self, path):
+        """Partition table, bootability and ISO volume label from the headers"""
+        try:
+            with open(path, "rb") as image:
+                head = image.read(36864)
+        except OSError:
+            return {"table": None, "bootable": False, "label": ""}
+        table = None
+        bootable = False
+        label = ""
+        if head[512:520] == b"EFI PART":
+            table = "gpt"
+        elif head[510:512] == b"\x55\xaa":
+            # a boot sector without partition table
+            if head[54:57] == b"FAT" or head[82:87] == b"FAT32":
+                table = "fat"
+            else:
+                table = "mbr"
+                flags = head[446:510:16]
+                bootable = b"\x80" in flags
+        if head[32769:32774] == b"CD001":
+            label = head[32808:32840].decode("ascii", "replace").strip()
+            # El Torito boot record in the descriptor after the primary one
+            if head[34817:34846] == b"CD001\x01EL TORITO SPECIFICATION":
+                bootable = True
+        return {"table": table, "bootable": bootable, "label": label}
+
+    def _save_later(self):
+        if self.save_source is None:
+            self.save_source = GLib.timeout_add_seconds(1, self.save)
+
+    def save(self):
+        self.save_source = None
+        tmp = self.file + ".tmp"
+        with open(tmp, "w") as cfile:
+            json.dump(self.entries, cfile, indent=1)
+        os.replace(tmp, self.file)
+        return False
+
+
 class GadgetWindow:
     def __init__(self, application):
         self.application = application
-        self.status = "Stopped"
+        # last state of the service, kept current by its StateChanged signal
+        self.status = None
         self.no_emmit = False
+        # create_image jobs, they report through Progress too
+        self.image_jobs = set()
+        # pending refill of the image lists after Verified signals
+        self.fill_source = None
         Handy.init()
 
         self.widgets = []
@@ -41,6 +221,9 @@ class GadgetWindow:
         if not UIDEV:
             bus = SystemBus()
             self.service = bus.get(BUS_NAME)
+            self.service.StateChanged.connect(self.on_service_state)
+            self.service.Progress.connect(self.on_service_progress)
+            self.service.Verified.connect(self.on_image_verified)
         self.xmlfile = os.path.join(datapath, "config", "current.xml")
         if os.path.isfile(self.xmlfile):
             with open(self.xmlfile, "rb") as xfile:
@@ -59,6 +242,12 @@ class GadgetWindow:
         self.stack = None
         self.back = None
 
+        self.catalog = ImageCatalog(
+            datapath,
+            changed=self._fill_stores,
+            verify=None if UIDEV else self.service.verify_image,
+        )
+
         self._create_window()
 
         self.add_flash()
@@ -452,6 +641,8 @@ class GadgetWindow:
         delete_button.connect("clicked", self.on_delete_iso)
         fbox.pack_start(delete_button, True, False, 0)
 
+        self._add_import(box, "iso", "Import ISO Image")
+
     def add_flash(self):
 
         page = "Flash Images"
@@ -556,6 +747,26 @@ class GadgetWindow:
         self.widgets.append(switch)
         rbox.pack_start(switch, False, False, 0)
 
+        sbox = Gtk.Box()
+        sbox.set_margin_top(8)
+        sbox.set_margin_bottom(8)
+        sbox.set_margin_left(8)
+        sbox.set_margin_right(8)
+        lbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_start(lbox, True, True, 0)
+        fbox.pack_start(sbox, False, True, 0)
+        rbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_end(rbox, False, False, 0)
+
+        label = Gtk.Label(label="Discard changes on stop", xalign=0.0)
+        lbox.pack_start(label, False, True, 0)
+
+        # picked up when the images are enabled
+        switch = Gtk.Switch()
+        self.flash_overlay_switch = switch
+        self.widgets.append(switch)
+        rbox.pack_start(switch, False, False, 0)
+
         frame = Gtk.Frame()
 
         frame.set_margin_top(12)
@@ -642,6 +853,50 @@ class GadgetWindow:
         rbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
         sbox.pack_end(rbox, False, False, 0)
 
+        label = Gtk.Label(label="Allocation", xalign=0.0)
+        label.set_margin_top(6)
+        lbox.pack_start(label, False, True, 0)
+
+        # preallocated images write faster on eMMC but take the space now
+        self.flash_create_alloc = Gtk.ComboBoxText()
+        self.flash_create_alloc.append("sparse", "Sparse")
+        self.flash_create_alloc.append("fallocate", "Preallocated")
+        self.flash_create_alloc.set_active_id("sparse")
+        rbox.pack_start(self.flash_create_alloc, False, False, 0)
+
+        sbox = Gtk.Box()
+        sbox.set_margin_top(8)
+        sbox.set_margin_bottom(8)
+        sbox.set_margin_left(8)
+        sbox.set_margin_right(8)
+        lbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_start(lbox, True, True, 0)
+        fbox.pack_start(sbox, False, True, 0)
+        rbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_end(rbox, False, False, 0)
+
+        label = Gtk.Label(label="Filesystem", xalign=0.0)
+        label.set_margin_top(6)
+        lbox.pack_start(label, False, True, 0)
+
+        self.flash_create_fs = Gtk.ComboBoxText()
+        self.flash_create_fs.append("", "None")
+        self.flash_create_fs.append("vfat", "FAT")
+        self.flash_create_fs.append("exfat", "exFAT")
+        self.flash_create_fs.set_active_id("")
+        rbox.pack_start(self.flash_create_fs, False, False, 0)
+
+        sbox = Gtk.Box()
+        sbox.set_margin_top(8)
+        sbox.set_margin_bottom(8)
+        sbox.set_margin_left(8)
+        sbox.set_margin_right(8)
+        lbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_start(lbox, True, True, 0)
+        fbox.pack_start(sbox, False, True, 0)
+        rbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_end(rbox, False, False, 0)
+
         create_button = Gtk.Button.new_with_label("Create")
         create_button.set_margin_bottom(8)
         create_button.set_margin_left(8)
@@ -715,6 +970,54 @@ class GadgetWindow:
 
         fbox.pack_start(delete_button, True, False, 0)
 
+        self._add_import(box, "image", "Import Flash Image")
+
+    def _add_import(self, box, sub, title):
+        label = Gtk.Label(label=title, xalign=0.0)
+        label.get_style_context().add_class("heading")
+        label.set_margin_bottom(8)
+        label.set_margin_top(8)
+        box.pack_start(label, False, True, 0)
+        frame = Gtk.Frame()
+        frame.get_style_context().add_class("view")
+        frame.set_margin_bottom(12)
+        box.pack_start(frame, False, True, 0)
+        fbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        frame.add(fbox)
+
+        entries = []
+        for text, hint in (
+            ("Path or URL", "https://.../image.iso.xz"),
+            ("Checksum", "sha256:... (optional)"),
+        ):
+            sbox = Gtk.Box()
+            sbox.set_margin_top(8)
+            sbox.set_margin_bottom(8)
+            sbox.set_margin_left(8)
+            sbox.set_margin_right(8)
+            lbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+            sbox.pack_start(lbox, True, True, 0)
+            fbox.pack_start(sbox, False, True, 0)
+            rbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+            sbox.pack_end(rbox, False, False, 0)
+
+            label = Gtk.Label(label=text, xalign=0.0)
+            label.set_margin_top(6)
+            lbox.pack_start(label, False, True, 0)
+
+            entry = Gtk.Entry()
+            entry.set_width_chars(26)
+            entry.set_placeholder_text(hint)
+            rbox.pack_start(entry, False, False, 0)
+            entries.append(entry)
+
+        import_button = Gtk.Button.new_with_label("Import")
+        import_button.set_margin_bottom(8)
+        import_button.set_margin_left(8)
+        import_button.set_margin_right(8)
+        import_button.connect("clicked", self.on_import, sub, *entries)
+        fbox.pack_start(import_button, True, False, 0)
+
     def add_soundcard(self):
 
         page = "Sound"
@@ -832,6 +1135,46 @@ class GadgetWindow:
         self.widgets.append(switch)
         rbox.pack_start(switch, False, False, 0)
 
+        sbox = Gtk.Box()
+        sbox.set_margin_top(8)
+        sbox.set_margin_bottom(8)
+        sbox.set_margin_left(8)
+        sbox.set_margin_right(8)
+        lbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_start(lbox, True, True, 0)
+        fbox.pack_start(sbox, False, True, 0)
+        rbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_end(rbox, False, False, 0)
+
+        label = Gtk.Label(label="Enable NCM (faster, Linux/macOS)", xalign=0.0)
+        lbox.pack_start(label, False, True, 0)
+
+        switch = Gtk.Switch()
+        self.ncm_switch = switch
+        switch.connect("notify::active", partial(self.on_activate, switch, "net_ncm"))
+        self.widgets.append(switch)
+        rbox.pack_start(switch, False, False, 0)
+
+        sbox = Gtk.Box()
+        sbox.set_margin_top(8)
+        sbox.set_margin_bottom(8)
+        sbox.set_margin_left(8)
+        sbox.set_margin_right(8)
+        lbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_start(lbox, True, True, 0)
+        fbox.pack_start(sbox, False, True, 0)
+        rbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_end(rbox, False, False, 0)
+
+        label = Gtk.Label(label="Enable RNDIS + NCM (Windows and Linux)", xalign=0.0)
+        lbox.pack_start(label, False, True, 0)
+
+        switch = Gtk.Switch()
+        self.dual_switch = switch
+        switch.connect("notify::active", partial(self.on_activate, switch, "net_dual"))
+        self.widgets.append(switch)
+        rbox.pack_start(switch, False, False, 0)
+
     def add_hid(self):
 
         page = "HID"
@@ -935,6 +1278,30 @@ class GadgetWindow:
 
         self.widgets.append(switch)
         rbox.pack_start(switch, False, False, 0)
+        sbox = Gtk.Box()
+        sbox.set_margin_top(8)
+        sbox.set_margin_bottom(8)
+        sbox.set_margin_left(8)
+        sbox.set_margin_right(8)
+        lbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_start(lbox, True, True, 0)
+        fbox.pack_start(sbox, False, True, 0)
+        rbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+        sbox.pack_end(rbox, False, False, 0)
+
+        label = Gtk.Label(
+            label="Enable Keyboard + Media + Mouse (one device)", xalign=0.0
+        )
+        lbox.pack_start(label, False, True, 0)
+
+        switch = Gtk.Switch()
+        self.composite_switch = switch
+        switch.connect(
+            "notify::active", partial(self.on_activate, switch, "hid_composite")
+        )
+
+        self.widgets.append(switch)
+        rbox.pack_start(switch, False, False, 0)
 
     def on_main_window_destroy(self, widget):
         Gtk.main_quit()
@@ -990,6 +1357,8 @@ class GadgetWindow:
                         s = ET.SubElement(self.root, "dev", type="storage_flash")
                         p = ET.SubElement(s, "path")
                         p.text = os.path.join(datapath, "image", treestore[x][0])
+                        if self.flash_overlay_switch.get_active():
+                            ET.SubElement(s, "overlay")
 
             else:
                 devs = self.root.findall("dev")
@@ -1031,6 +1400,12 @@ class GadgetWindow:
 
         self.show()
 
+        if self.status == "RUNNING" and not UIDEV:
+            # the service only rebuilds the functions that changed
+            response = self.service.set_config(xmlstr.decode("utf-8"))
+            print(response)
+            self._start_job(self.service.start_async())
+
     def on_load_preset(self, widget, *args):
         self._load_state()
 
@@ -1058,16 +1433,40 @@ class GadgetWindow:
 
         imgfile = os.path.join(datapath, "image", f"{filename}.img")
 
-        if os.path.isdir(imgfile):
+        if os.path.exists(imgfile) or UIDEV:
             return
 
         size = 1024 * 1024 * 1024 * int(self.flash_create_size.get_value())
 
-        with open(imgfile, "wb") as img:
-            img.truncate(size)
+        # the service allocates and formats in the background
+        job = self.service.create_image(
+            imgfile,
+            size,
+            self.flash_create_alloc.get_active_id(),
+            self.flash_create_fs.get_active_id(),
+        )
+        print(f"Image job {job}")
+        self.image_jobs.add(job)
+        self.message_revealer_label.set_text(f"Creating {filename}.img ...")
+        self.message_revealer.set_reveal_child(True)
+
+    def on_import(self, widget, sub, source_entry, checksum_entry):
+        source = source_entry.get_text().strip()
+        if len(source) == 0 or UIDEV:
+            return
 
-        os.system(f'chmod 777 "{imgfile}"')
-        self._load_state()
+        # downloaded and decompressed by the service, an interrupted
+        # import resumes when started again
+        job = self.service.import_image(
+            os.path.expanduser(source),
+            os.path.join(datapath, sub),
+            checksum_entry.get_text().strip(),
+        )
+        print(f"Import job {job}")
+        self.image_jobs.add(job)
+        name = os.path.basename(source)
+        self.message_revealer_label.set_text(f"Importing {name} ...")
+        self.message_revealer.set_reveal_child(True)
 
     def on_delete_iso(self, widget, *args):
         model = self.iso_delete_combo.get_model()
@@ -1111,6 +1510,9 @@ class GadgetWindow:
 
     def on_start_stop(self, widget, *args):
 
+        if self.no_emmit:
+            return
+
         if widget.get_active():
             print("activate")
 
@@ -1125,17 +1527,55 @@ class GadgetWindow:
 
             response = self.service.status()
             print(f'Service answered "{response}"')
-            response = self.service.start()
-            self.message_revealer_label.set_text(response)
-            print(f'Service answered "{response}"')
-            response = self.service.status()
-            print(f'Service answered "{response}"')
+            self._start_job(self.service.start_async())
         else:
             print("deactivate")
-            self.service.stop()
+            self._start_job(self.service.stop_async())
             # ~ self.status = "Stopped"
 
-        self._load_state()
+    def _start_job(self, job):
+        # the service works in the background and reports back via signals
+        print(f"Service job {job}")
+        if job == 0:
+            self.message_revealer_label.set_text("Service is busy")
+            self.message_revealer.set_reveal_child(True)
+            self._load_state()
+            return
+        self.mainswitch.set_sensitive(False)
+        self._widgets_disable(True)
+
+    def on_service_progress(self, job, phase, message):
+        print(f"Service job {job}: {phase} {message}")
+        if job in self.image_jobs:
+            if phase == "finished":
+                self.image_jobs.discard(job)
+                self.message_revealer_label.set_text(message)
+                self._load_state()
+            else:
+                self.message_revealer_label.set_text(
+                    f"{phase.capitalize()} {message} ..."
+                )
+            return
+        if phase == "finished":
+            self.mainswitch.set_sensitive(True)
+            self.message_revealer_label.set_text(message)
+            self.message_revealer.set_reveal_child(True)
+        else:
+            self.message_revealer_label.set_text(f"{phase.capitalize()} ...")
+
+    def on_image_verified(self, path, status, digest):
+        # results of a whole catalog can arrive at once, refill only once
+        if self.catalog.set_verified(path, status, digest) and not self.fill_source:
+            self.fill_source = GLib.idle_add(self._fill_stores_later)
+
+    def _fill_stores_later(self):
+        self.fill_source = None
+        self._fill_stores()
+        return False
+
+    def on_service_state(self, state):
+        print(f"Service state {state}")
+        self._load_state(state)
 
     def sizeof_fmt(self, num, suffix="B"):
         for unit in ["", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"]:
@@ -1144,19 +1584,31 @@ class GadgetWindow:
             num /= 1024.0
         return f"{num:.1f} Yi{suffix}"
 
-    def _load_state(self):
-
+    def _image_info(self, entry):
+        info = self.sizeof_fmt(entry["size"])
+        if entry.get("label"):
+            info = f'{entry["label"]}, {info}'
+        if entry.get("bootable"):
+            info += ", boot"
+        if entry.get("verified") == "ok":
+            info += ", verified"
+        elif entry.get("verified") == "mismatch":
+            info += ", CORRUPT"
+        return info
+
+    def _fill_stores(self):
+        # from the catalog, no file is touched here
         self.flash_store.clear()
-        for flash_image in os.listdir(os.path.join(datapath, "image")):
-            if flash_image.endswith(".img"):
-                size = os.path.getsize(os.path.join(datapath, "image", flash_image))
-                self.flash_store.append([flash_image, self.sizeof_fmt(size)])
+        for name, entry in self.catalog.list("image"):
+            self.flash_store.append([name, self._image_info(entry)])
 
         self.iso_store.clear()
-        for iso in os.listdir(os.path.join(datapath, "iso")):
-            if iso.endswith(".iso"):
-                size = os.path.getsize(os.path.join(datapath, "iso", iso))
-                self.iso_store.append([iso, self.sizeof_fmt(size)])
+        for name, entry in self.catalog.list("iso"):
+            self.iso_store.append([name, self._image_info(entry)])
+
+    def _load_state(self, status=None):
+
+        self._fill_stores()
 
         self.no_emmit = True
 
@@ -1165,6 +1617,8 @@ class GadgetWindow:
 
         if self.is_active("storage_flash"):
             self.flash_switch.set_state(True)
+            overlay = self.root.find("dev[@type='storage_flash']/overlay")
+            self.flash_overlay_switch.set_state(overlay is not None)
 
         if self.is_active("storage_iso"):
             self.iso_switch.set_state(True)
@@ -1175,6 +1629,12 @@ class GadgetWindow:
         if self.is_active("net_rndis"):
             self.rndis_switch.set_state(True)
 
+        if self.is_active("net_ncm"):
+            self.ncm_switch.set_state(True)
+
+        if self.is_active("net_dual"):
+            self.dual_switch.set_state(True)
+
         if self.is_active("hid_keyboard"):
             self.keyboard_switch.set_state(True)
 
@@ -1184,6 +1644,9 @@ class GadgetWindow:
         if self.is_active("hid_joystick"):
             self.joystick_switch.set_state(True)
 
+        if self.is_active("hid_composite"):
+            self.composite_switch.set_state(True)
+
         self.no_emmit = False
 
         self.preset_store.clear()
@@ -1193,19 +1656,27 @@ class GadgetWindow:
         for key in self.keys:
             # cell.set_width_chars(10)
             self.preset_store.append((key,))
-        if UIDEV:
-            status = "Stopped"
-        else:
-            status = self.service.status()
+        if status is None:
+            status = self.status
+        if status is None:
+            if UIDEV:
+                status = "Stopped"
+            else:
+                status = self.service.State
 
         print(status)
 
-        # ~ status = self.status
+        self.status = status
+        self.no_emmit = True
         if status == "RUNNING":
             # self.action_revealer.set_reveal_child(False)
             self.mainswitch.set_active(True)
             self.statlabel.set_markup("Service: <b>Enabled</b>")
-            print("Disable switches")
+            # switches stay usable, changes are applied to the running gadget
+            self._widgets_disable(False)
+
+        elif status in ("STARTING", "STOPPING"):
+            self.statlabel.set_markup(f"Service: <b>{status.capitalize()}</b>")
             self._widgets_disable(True)
 
         else:
@@ -1213,6 +1684,7 @@ class GadgetWindow:
             self.mainswitch.set_active(False)
             self.statlabel.set_markup("Service: <b>Disabled</b>")
             self._widgets_disable(False)
+        self.no_emmit = False
 
     def _indent(self, elem, level=0):
         i = "\n" + level * "  "
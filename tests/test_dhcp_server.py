@@ -0,0 +1,109 @@
+import importlib.util
+import ipaddress
+import os
+import struct
+import unittest
+
+SERVICE = os.path.join(
+    os.path.dirname(__file__), "..", "src", "usr", "bin", "gadgetcontroller-service.py"
+)
+spec = importlib.util.spec_from_file_location("gadgetcontroller_service", SERVICE)
+service = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(service)
+
+MAC = bytes.fromhex("020000000001")
+
+
+class FakeSocket:
+    """Hands out queued datagrams and records what is sent"""
+
+    def __init__(self, *datagrams):
+        self.inbox = list(datagrams)
+        self.sent = []
+
+    def recvfrom(self, size):
+        return self.inbox.pop(0), ("0.0.0.0", 68)
+
+    def sendto(self, data, address):
+        self.sent.append((data, address))
+
+
+def message(msgtype, options=b"", mac=MAC, xid=0x1234):
+    data = bytearray(240)
+    struct.pack_into("!BBBBI", data, 0, 1, 1, len(mac), 0, xid)
+    data[28 : 28 + len(mac)] = mac
+    data[236:240] = service.DHCP_MAGIC
+    if msgtype is not None:
+        data += bytes([service.DHCP_MESSAGE_TYPE, 1, msgtype])
+    return bytes(data + options + b"\xff")
+
+
+def reply_type(reply):
+    data = reply[0]
+    i = 240
+    while data[i] != 255:
+        if data[i] == service.DHCP_MESSAGE_TYPE:
+            return data[i + 2]
+        i += 2 + data[i + 1]
+    return None
+
+
+class DhcpServerTest(unittest.TestCase):
+    def serve(self, *datagrams):
+        sock = FakeSocket(*datagrams)
+        server = service.DhcpServer(sock=sock)
+        for _ in datagrams:
+            server.serve()
+        return server, sock.sent
+
+    def test_discover_request(self):
+        server, sent = self.serve(message(service.DHCPDISCOVER))
+        self.assertEqual(reply_type(sent[0]), service.DHCPOFFER)
+        offered = ipaddress.IPv4Address(sent[0][0][16:20])
+        self.assertEqual(str(offered), "10.0.0.10")
+        self.assertEqual(sent[0][1], ("255.255.255.255", 68))
+
+        requested = bytes([service.DHCP_REQUESTED_IP, 4]) + offered.packed
+        reply = server.handle(message(service.DHCPREQUEST, requested))
+        self.assertEqual(reply_type(reply), service.DHCPACK)
+        self.assertEqual(server.leases[MAC][0], offered)
+
+    def test_request_outside_pool(self):
+        requested = bytes([service.DHCP_REQUESTED_IP, 4, 192, 168, 1, 5])
+        _, sent = self.serve(message(service.DHCPREQUEST, requested))
+        self.assertEqual(reply_type(sent[0]), service.DHCPNAK)
+
+    def test_other_server(self):
+        server_id = bytes([service.DHCP_SERVER_ID, 4, 10, 0, 0, 2])
+        _, sent = self.serve(message(service.DHCPREQUEST, server_id))
+        self.assertEqual(sent, [])
+
+    def test_malformed(self):
+        bad = [
+            # short BOOTP header
+            message(service.DHCPDISCOVER)[:100],
+            # option length past the end of the datagram
+            message(None, bytes([service.DHCP_MESSAGE_TYPE, 8, 1]))[:-1],
+            # option code without a length
+            message(service.DHCPDISCOVER)[:-1] + bytes([service.DHCP_SERVER_ID]),
+            # empty message type
+            message(None, bytes([service.DHCP_MESSAGE_TYPE, 0])),
+            # requested address that is not 4 bytes
+            message(service.DHCPREQUEST, bytes([service.DHCP_REQUESTED_IP, 2, 10, 0])),
+        ]
+        # nothing is answered and a good message after them still is
+        _, sent = self.serve(*bad, message(service.DHCPDISCOVER))
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(reply_type(sent[0]), service.DHCPOFFER)
+
+    def test_socket_error(self):
+        class BrokenSocket(FakeSocket):
+            def recvfrom(self, size):
+                raise OSError("gone")
+
+        server = service.DhcpServer(sock=BrokenSocket())
+        server.serve()
+
+
+if __name__ == "__main__":
+    unittest.main()
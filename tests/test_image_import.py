@@ -0,0 +1,78 @@
+import hashlib
+import http.server
+import importlib.util
+import os
+import tempfile
+import threading
+import unittest
+
+SERVICE = os.path.join(
+    os.path.dirname(__file__), "..", "src", "usr", "bin", "gadgetcontroller-service.py"
+)
+spec = importlib.util.spec_from_file_location("gadgetcontroller_service", SERVICE)
+service = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(service)
+
+IMAGE = os.urandom(3 * 1024 * 1024)
+CUT = 1024 * 1024
+
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    """Drops the first download after CUT bytes, answers Range requests"""
+
+    requests = []
+
+    def do_GET(self):
+        ranged = self.headers.get("Range")
+        self.requests.append(ranged)
+        if ranged:
+            start = int(ranged.split("=")[1].rstrip("-"))
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes %d-%d/%d" % (start, len(IMAGE) - 1, len(IMAGE))
+            )
+            self.send_header("Content-Length", str(len(IMAGE) - start))
+            self.end_headers()
+            self.wfile.write(IMAGE[start:])
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(IMAGE)))
+        self.end_headers()
+        self.wfile.write(IMAGE[:CUT])
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        FlakyHandler.requests = []
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), FlakyHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def test_cut_download_resumes(self):
+        url = "http://127.0.0.1:%d/img.iso" % self.server.server_port
+        path = os.path.join(self.dir.name, "img.iso")
+        part = os.path.join(self.dir.name, ".img.iso.part")
+        checksum = "sha256:" + hashlib.sha256(IMAGE).hexdigest()
+        importer = service.ImageImporter()
+
+        with self.assertRaises(OSError):
+            importer.run(url, path, checksum)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(os.path.getsize(part), CUT)
+
+        self.assertEqual(importer.run(url, path, checksum), path)
+        self.assertEqual(FlakyHandler.requests, [None, "bytes=%d-" % CUT])
+        with open(path, "rb") as image:
+            self.assertEqual(image.read(), IMAGE)
+        self.assertFalse(os.path.exists(part))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import contextlib
+import importlib.util
+import io
+import os
+import tempfile
+import unittest
+
+SERVICE = os.path.join(
+    os.path.dirname(__file__), "..", "src", "usr", "bin", "gadgetcontroller-service.py"
+)
+spec = importlib.util.spec_from_file_location("gadgetcontroller_service", SERVICE)
+service = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(service)
+
+
+class FailingConfigFS(service.FakeConfigFS):
+    """Fails the next attribute write below fail"""
+
+    fail = None
+
+    def write(self, path, attrs):
+        if self.fail is not None and path.endswith(self.fail):
+            self.fail = None
+            raise OSError(5, "Input/output error", path)
+        return super().write(path, attrs)
+
+
+class ReconfigureTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = tmp.name
+        for d in ("usb_gadget", "udc/fake-udc.0", "systemd/getty.target.wants"):
+            os.makedirs(os.path.join(root, d))
+        self.configfs = FailingConfigFS(os.path.join(root, "usb_gadget"))
+        self.gadget = service.Gadget(
+            None,
+            configfs=self.configfs,
+            udcdir=os.path.join(root, "udc"),
+            systemddir=os.path.join(root, "systemd"),
+            host=service.HostRecorder(),
+            monitor=service.ReadyMonitor,
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.gadget.prepaire()
+            self.gadget.add_hid(htype="keyboard")
+            self.assertEqual(self.gadget.start(), "OK")
+
+    def reconfigure(self, *htypes):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return self.gadget.reconfigure(
+                [("add_hid", {"htype": htype}) for htype in htypes]
+            )
+
+    def functions(self):
+        return sorted(os.listdir(os.path.join(self.gadget.fullpath, "functions")))
+
+    def test_failed_function_is_undone(self):
+        self.configfs.fail = "functions/hid.usb1"
+        with self.assertRaises(OSError):
+            self.reconfigure("keyboard", "mouse")
+        # the half built function is gone, the old layout is bound again
+        self.assertEqual(self.functions(), ["hid.usb0"])
+        self.assertEqual(list(self.gadget.functions), ["hid.usb0"])
+        with open(os.path.join(self.gadget.fullpath, "UDC")) as udc:
+            self.assertEqual(udc.read().strip(), "fake-udc.0")
+
+        self.assertEqual(self.reconfigure("keyboard", "mouse"), "OK")
+        self.assertEqual(self.functions(), ["hid.usb0", "hid.usb1"])
+
+
+if __name__ == "__main__":
+    unittest.main()